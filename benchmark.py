@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks and bit-for-bit equivalence checks for the capture and conversion
+hot paths, on fixed synthetic 1280x720 frames from fake_carla.
+
+Every stage is timed for the previous implementation (reference) and the
+current one (optimised), and their outputs are compared as the PNG bytes
+cv.imwrite would write. raw_to_bgra has no earlier implementation and is
+timed against a plain numpy view, so that --baseline catches a slowdown of
+the conversion every rgb and depth frame goes through. Results can be
+stored as JSON and compared against an earlier run to flag regressions:
+
+    python benchmark.py --save _out/benchmark.json
+    python benchmark.py --baseline _out/benchmark.json
+
+The exit code is 1 if any output differs or any stage is slower than the
+baseline by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime
+
+import cv2 as cv
+import numpy as np
+
+import depth_treshold
+import fake_carla
+import frame_processor
+import image_converter
+from frame_processor import FrameProcessor
+from image_writer import ImageWriter
+
+_WIDTH = 1280
+_HEIGHT = 720
+_FOV = 120
+
+
+# ==============================================================================
+# -- reference implementations -------------------------------------------------
+# ==============================================================================
+
+
+def _reference_to_bgra_array(image):
+    # the plain view to_bgra_array wraps; kept so its per-frame cost is tracked against --baseline
+    return np.frombuffer(image.raw_data, dtype=np.uint8).reshape((image.height, image.width, 4))
+
+
+def _reference_labels_to_cityscapes_palette(image):
+    # one numpy.where pass per class into a float64 frame
+    classes = image_converter.CITYSCAPES_CLASSES['legacy']
+    array = image_converter.labels_to_array(image)
+    result = np.zeros((array.shape[0], array.shape[1], 3))
+    for key, value in classes.items():
+        result[np.where(array == key)] = value
+    return result
+
+
+def _reference_frame(image, depth_as_rgb, semseg_raw):
+    # the per-tick conversions of im_seq_roundabout.main before FrameProcessor
+    depth = image_converter.depth_to_array(depth_as_rgb)
+    depth_sixteen = depth * 65535
+    depth_sixteen = depth_sixteen.astype(np.uint16)
+    depth *= 255
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        depth_mask = depth_treshold._create_mask_iterative(depth)
+    depth_mat = image_converter.to_bgra_array(image)
+    masked_rgb = cv.bitwise_and(depth_mat, depth_mat, mask=depth_mask)
+    depth_log = image_converter.depth_to_logarithmic_grayscale(depth_as_rgb)
+    bgr = image_converter.to_bgra_array(image)
+    semseg_orig = _reference_labels_to_cityscapes_palette(semseg_raw)
+    semseg_mask = np.copy(semseg_orig)
+    semseg_mask[semseg_mask == 0] = np.inf
+    semseg_mask[semseg_mask != np.inf] = 0
+    semseg_mask[semseg_mask == np.inf] = 1
+    semseg_mask_2 = np.stack((semseg_mask[:, :, 0],
+                              semseg_mask[:, :, 0],
+                              semseg_mask[:, :, 0],
+                              semseg_mask[:, :, 0]),
+                             axis=2,
+                             )
+    final_masked_rgb = np.multiply(masked_rgb, semseg_mask_2)
+    return {
+        'depth_16': depth_sixteen,
+        'depth': depth_log,
+        'masked_rgb': masked_rgb,
+        'rgb': bgr,
+        'semseg_masked': final_masked_rgb,
+        'semseg': semseg_orig,
+    }
+
+
+def _optimised_frame(processor, image, depth_as_rgb, semseg_raw):
+    frame = processor.process(image, depth_as_rgb, semseg_raw)
+    return {
+        'depth_16': frame.depth_16,
+        'depth': frame.depth_log,
+        'masked_rgb': frame.masked_rgb,
+        'rgb': frame.rgb,
+        'semseg_masked': frame.semseg_masked,
+        'semseg': frame.semseg,
+    }
+
+
+def _reference_write(products, export_basepath, tick):
+    for name, image in products.items():
+        cv.imwrite(f'{export_basepath}/{name}/{tick}.png', image)
+
+
+def _optimised_write(writer, products, export_basepath, tick):
+    for name, image in products.items():
+        writer.write(f'{export_basepath}/{name}/{tick}.png', image)
+
+
+# ==============================================================================
+# -- measurement ---------------------------------------------------------------
+# ==============================================================================
+
+
+def _png(image):
+    # what cv.imwrite would put on disk, float images included
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return cv.imencode('.png', image)[1].tobytes()
+
+
+def _identical(reference, optimised):
+    reference, optimised = np.asarray(reference), np.asarray(optimised)
+    if reference.dtype == optimised.dtype:
+        return np.array_equal(reference, optimised)
+    return _png(reference) == _png(optimised)
+
+
+def _same_files(reference_basepath, optimised_basepath):
+    """Whether both directories hold the same files with the same bytes."""
+    names = sorted(os.path.relpath(os.path.join(directory, name), reference_basepath)
+                   for directory, _, files in os.walk(reference_basepath) for name in files)
+    optimised_names = sorted(os.path.relpath(os.path.join(directory, name), optimised_basepath)
+                             for directory, _, files in os.walk(optimised_basepath) for name in files)
+    if not names or names != optimised_names:
+        return False
+    for name in names:
+        with open(os.path.join(reference_basepath, name), 'rb') as reference, \
+                open(os.path.join(optimised_basepath, name), 'rb') as optimised:
+            if reference.read() != optimised.read():
+                return False
+    return True
+
+
+def _time(function, repeats):
+    """Median wall time of function() in milliseconds."""
+    function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def run(repeats=5, frames=4):
+    """Time every stage and check its outputs; returns the results dict."""
+    images = fake_carla.synthetic_images('sensor.camera.rgb', _WIDTH, _HEIGHT, _FOV, frames)
+    depths = fake_carla.synthetic_images('sensor.camera.depth', _WIDTH, _HEIGHT, _FOV, frames)
+    semsegs = fake_carla.synthetic_images('sensor.camera.semantic_segmentation', _WIDTH, _HEIGHT, _FOV, frames)
+    processor = FrameProcessor(_WIDTH, _HEIGHT)
+    log_depth_lut = frame_processor._get_log_depth_lut()
+
+    def decode_depth(depth_image):
+        # the decode FrameProcessor fuses into its pass
+        bgra = image_converter.to_bgra_array(depth_image)
+        code = bgra.view(np.uint32)[:, :, 0].byteswap() >> 8
+        return code, code / (256.0 * 256.0 * 256.0 - 1.0)
+
+    def log_depth(depth_image):
+        code, _ = decode_depth(depth_image)
+        return cv.merge([log_depth_lut[code]] * 3)
+
+    def depth_255(depth_image):
+        return image_converter.depth_to_array(depth_image) * 255
+
+    stages = {
+        'raw_to_bgra': (_reference_to_bgra_array, image_converter.to_bgra_array, images),
+        'depth_decode': (image_converter.depth_to_array, lambda d: decode_depth(d)[1], depths),
+        'log_depth': (image_converter.depth_to_logarithmic_grayscale, log_depth, depths),
+        'palette': (_reference_labels_to_cityscapes_palette, image_converter.labels_to_cityscapes_palette,
+                    semsegs),
+        'mask': (depth_treshold._create_mask_iterative, depth_treshold.create_mask,
+                 [depth_255(d) for d in depths]),
+    }
+
+    results = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for name, (reference, optimised, inputs) in stages.items():
+            results[name] = {
+                'reference_ms': _time(lambda: [reference(x) for x in inputs], repeats) / frames,
+                'optimised_ms': _time(lambda: [optimised(x) for x in inputs], repeats) / frames,
+                'identical': all(_identical(reference(x), optimised(x)) for x in inputs),
+            }
+
+    ticks = list(zip(images, depths, semsegs))
+    identical = True
+    for tick in ticks:
+        reference = _reference_frame(*tick)
+        optimised = _optimised_frame(processor, *tick)
+        identical &= all(_identical(reference[name], optimised[name]) for name in reference)
+    results['convert_frame'] = {
+        'reference_ms': _time(lambda: [_reference_frame(*tick) for tick in ticks], repeats) / frames,
+        'optimised_ms': _time(lambda: [_optimised_frame(processor, *tick) for tick in ticks], repeats) / frames,
+        'identical': identical,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference_basepath = f'{tmp_dir}/reference'
+        optimised_basepath = f'{tmp_dir}/optimised'
+        products = _reference_frame(*ticks[0])
+        for basepath in (reference_basepath, optimised_basepath):
+            for name in products:
+                os.makedirs(f'{basepath}/{name}')
+        writer = ImageWriter()
+
+        def write_reference():
+            for tick in range(frames):
+                _reference_write(products, reference_basepath, tick)
+
+        def write_optimised():
+            for tick in range(frames):
+                _optimised_write(writer, products, optimised_basepath, tick)
+            writer.flush()
+
+        results['encode_write'] = {
+            'reference_ms': _time(write_reference, repeats) / frames,
+            'optimised_ms': _time(write_optimised, repeats) / frames,
+            'identical': _same_files(reference_basepath, optimised_basepath),
+        }
+
+        def end_to_end_reference():
+            for tick, data in enumerate(ticks):
+                _reference_write(_reference_frame(*data), reference_basepath, tick)
+
+        def end_to_end_optimised():
+            for tick, data in enumerate(ticks):
+                _optimised_write(writer, _optimised_frame(processor, *data), optimised_basepath, tick)
+            writer.flush()
+
+        results['end_to_end'] = {
+            'reference_ms': _time(end_to_end_reference, repeats) / frames,
+            'optimised_ms': _time(end_to_end_optimised, repeats) / frames,
+            'identical': _same_files(reference_basepath, optimised_basepath),
+        }
+        writer.close()
+
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'frame': {'width': _WIDTH, 'height': _HEIGHT, 'frames': frames, 'repeats': repeats},
+        'stages': results,
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """Stages whose optimised time grew by more than tolerance (a fraction) over the baseline."""
+    regressions = []
+    for name, stage in results['stages'].items():
+        previous = baseline['stages'].get(name)
+        if previous is not None and stage['optimised_ms'] > previous['optimised_ms'] * (1 + tolerance):
+            regressions.append((name, previous['optimised_ms'], stage['optimised_ms']))
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--repeats', type=int, default=5, help='timed repetitions per stage')
+    argparser.add_argument('--frames', type=int, default=4, help='synthetic frames per repetition')
+    argparser.add_argument('--save', help='write the results to this JSON file')
+    argparser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    argparser.add_argument('--tolerance', type=float, default=0.2,
+                           help='allowed slowdown against the baseline, as a fraction')
+    args = argparser.parse_args()
+
+    results = run(args.repeats, args.frames)
+
+    print(f"{'stage':>14} {'reference':>12} {'optimised':>12} {'speedup':>8}  identical")
+    for name, stage in results['stages'].items():
+        print(f"{name:>14} {stage['reference_ms']:9.2f} ms {stage['optimised_ms']:9.2f} ms "
+              f"{stage['reference_ms'] / stage['optimised_ms']:7.1f}x  {stage['identical']}")
+
+    failed = not all(stage['identical'] for stage in results['stages'].values())
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, before, after in find_regressions(results, baseline, args.tolerance):
+            print(f'REGRESSION {name}: {before:.2f} ms -> {after:.2f} ms')
+            failed = True
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Synchronous-mode helper shared by the capture scripts.
+"""
+
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+from datetime import datetime
+
+import carla
+
+
+class _SensorSlot(object):
+    """
+    Frame-indexed buffer for the measurements of one sensor (or the world
+    snapshots). Holds at most `capacity` frames; older ones are dropped.
+    """
+
+    def __init__(self, name, capacity, condition):
+        self.name = name
+        self.capacity = capacity
+        self.dropped_frames = 0
+        self.late_frames = 0
+        self._condition = condition
+        self._data = collections.OrderedDict()
+        self._next_frame = 0
+
+    def put(self, data):
+        with self._condition:
+            if data.frame < self._next_frame:
+                # the tick this belongs to has already been returned or given up
+                self.late_frames += 1
+                return
+            self._data[data.frame] = data
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.dropped_frames += 1
+            self._condition.notify_all()
+
+    def has(self, frame):
+        return frame in self._data
+
+    def release(self, frame):
+        """Pop the data of frame and discard everything up to it."""
+        data = self._data.pop(frame, None)
+        while self._data:
+            oldest = next(iter(self._data))
+            if oldest > frame:
+                break
+            del self._data[oldest]
+            self.dropped_frames += 1
+        self._next_frame = max(self._next_frame, frame + 1)
+        return data
+
+
+class CarlaSyncMode(object):
+    """
+    Context manager to synchronize output from different sensors. Synchronous
+    mode is enabled as long as we are inside this context
+
+        with CarlaSyncMode(world, sensors) as sync_mode:
+            while True:
+                data = sync_mode.tick(timeout=1.0)
+
+    Every sensor gets a bounded slot indexed by frame, so a slow consumer
+    never makes the measurements pile up in memory. tick() waits for all
+    sensors against a single deadline and raises queue.Empty if it passes.
+    Frames dropped from a full slot and measurements arriving after their
+    tick are counted in dropped_frames and late_frames.
+
+    With pipelined=True the next world tick is requested as soon as a frame
+    has been collected, so the server simulates and renders frame N+1 while
+    the caller processes frame N. The returned measurements still all belong
+    to frame N, but anything read from the world meanwhile (e.g.
+    actor.get_transform()) may already reflect frame N+1.
+    """
+
+    def __init__(self, world, *sensors, **kwargs):
+        self.world = world
+        self.sensors = sensors
+        self.frame = None
+        self.delta_seconds = 1.0 / kwargs.get('fps', 20)
+        self.pipelined = kwargs.get('pipelined', False)
+        self.max_pending = kwargs.get('max_pending', 3 if self.pipelined else 2)
+        self.timestamp = datetime.now()
+        self.missed_ticks = 0
+        self._condition = threading.Condition()
+        self._slots = []
+        self._on_tick_id = None
+        self._settings = None
+        self._executor = None
+        self._next_tick = None
+
+    @property
+    def dropped_frames(self):
+        return sum(slot.dropped_frames for slot in self._slots)
+
+    @property
+    def late_frames(self):
+        return sum(slot.late_frames for slot in self._slots)
+
+    def __enter__(self):
+        self._settings = self.world.get_settings()
+        self.frame = self.world.apply_settings(carla.WorldSettings(no_rendering_mode=False,
+                                                                   synchronous_mode=True,
+                                                                   fixed_delta_seconds=self.delta_seconds,
+                                                                   )
+                                               )
+
+        world_slot = _SensorSlot('world', self.max_pending, self._condition)
+        self._slots.append(world_slot)
+        self._on_tick_id = self.world.on_tick(world_slot.put)
+        for sensor in self.sensors:
+            slot = _SensorSlot(sensor.type_id, self.max_pending, self._condition)
+            self._slots.append(slot)
+            sensor.listen(slot.put)
+
+        if self.pipelined:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self
+
+    def tick(self, timeout):
+        deadline = time.monotonic() + timeout
+        if not self.pipelined:
+            self.frame = self.world.tick()
+            return self._retrieve_data(self.frame, deadline)
+
+        if self._next_tick is None:
+            self._next_tick = self._executor.submit(self.world.tick)
+        try:
+            self.frame = self._next_tick.result(timeout=max(0.0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            self.missed_ticks += 1
+            raise queue.Empty('world.tick() did not return in time')
+        finally:
+            if self._next_tick.done():
+                self._next_tick = None
+        data = self._retrieve_data(self.frame, deadline)
+        # let the server work on the next frame while this one is processed
+        self._next_tick = self._executor.submit(self.world.tick)
+        return data
+
+    def __exit__(self, *args, **kwargs):
+        if self._executor is not None:
+            if self._next_tick is not None:
+                concurrent.futures.wait([self._next_tick])
+                self._next_tick = None
+            self._executor.shutdown()
+            self._executor = None
+        if self._on_tick_id is not None:
+            self.world.remove_on_tick(self._on_tick_id)
+        self.world.apply_settings(self._settings)
+        if self.dropped_frames or self.late_frames or self.missed_ticks:
+            print(f'CarlaSyncMode: {self.missed_ticks} missed ticks, '
+                  f'{self.dropped_frames} dropped and {self.late_frames} late frames')
+
+    def _retrieve_data(self, frame, deadline):
+        with self._condition:
+            while True:
+                missing = [slot.name for slot in self._slots if not slot.has(frame)]
+                if not missing:
+                    return [slot.release(frame) for slot in self._slots]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    for slot in self._slots:
+                        if slot.release(frame) is not None:
+                            slot.dropped_frames += 1
+                    self.missed_ticks += 1
+                    raise queue.Empty(f'frame {frame} timed out waiting for {", ".join(missing)}')
+                self._condition.wait(remaining)
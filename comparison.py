@@ -1 +1,380 @@
-import
\ No newline at end of file
+#!/usr/bin/env python
+
+"""
+Cloud-to-cloud comparison of a reconstructed point cloud against ground truth.
+
+    python comparison.py _out/mono.ply _out/pointcloud.pcd --thresholds 0.05 0.1 0.2 0.5
+
+Every point of each cloud is matched to its nearest neighbour in the other
+one, which gives:
+
+  - accuracy: distances reconstruction -> ground truth, and the fraction of
+    reconstructed points within each threshold (precision)
+  - completeness: distances ground truth -> reconstruction, and the fraction
+    of ground truth points within each threshold (recall), plus the F-score
+  - chamfer distance: mean accuracy + mean completeness distance, and the
+    same for squared distances
+
+Both clouds are streamed, --chunk-points at a time, into the cells of a
+common grid just fine enough that no cell of either cloud holds more than
+--chunk-points / 27 points (down to 1/128 of the extent per axis). Every
+cell gets its own KD-tree. The cells and trees are cached in --cache-dir and
+reused as long as neither cloud file changes. The queries run cell by cell
+on a process pool. A query cell is searched in the trees of the cells
+around it, ring by ring, until no point could have a closer neighbour
+further out. So the nearest neighbours are exact. A worker holds one cell's
+queries and the trees of the cells around it. Its memory is therefore
+bounded by the chunk size, not by the clouds, except where a finest cell
+holds more points than that. The per-point distances are written to
+accuracy.npy and completeness.npy in --errors-dir, in the order in which
+the points were read. .npy files (memory mapped), .ply files and
+point_tiles directories are streamed; other formats such as .pcd are loaded
+whole with open3d while they are split into cells.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import open3d as o3d
+from scipy.spatial import cKDTree
+
+from ply_to_pcd import iter_vertices
+from point_tiles import TileReader
+
+_DIRECTIONS = {
+    # name: (query cloud, tree cloud)
+    'accuracy': ('reconstruction', 'ground_truth'),
+    'completeness': ('ground_truth', 'reconstruction'),
+}
+_RECORD_DTYPE = np.dtype([('xyz', np.float64, (3,)), ('index', np.int64)])
+_META = 'meta.json'
+# the finest grid has 2^7 cells per axis
+_MAX_BITS = 7
+# a query cell searches at least the 3 x 3 x 3 cells around it
+_BLOCK_CELLS = 27
+
+# per process state: the meta.json of each cell directory and the last loaded trees
+_metas = {}
+_trees = OrderedDict()
+
+
+def iter_points(path, chunk_points=1000000):
+    """Yields (index of the first point, (n, 3) float64 points) of a cloud, chunk_points at a time."""
+    if os.path.isdir(path):
+        reader = TileReader(path)
+        start = 0
+        for name in reader.select():
+            xyz = reader.read_tile(name)['xyz']
+            for offset in range(0, len(xyz), chunk_points):
+                points = np.asarray(xyz[offset:offset + chunk_points], dtype=np.float64)
+                yield start, points
+                start += len(points)
+    elif path.endswith('.npy'):
+        points = np.load(path, mmap_mode='r')
+        if points.ndim != 2 or points.shape[1] < 3:
+            raise ValueError(f'expected an (N, 3) array in {path}, got {points.shape}')
+        for start in range(0, len(points), chunk_points):
+            yield start, np.asarray(points[start:start + chunk_points, :3], dtype=np.float64)
+    elif path.lower().endswith('.ply'):
+        start = 0
+        for _, _, vertices in iter_vertices(path, chunk_points):
+            points = np.column_stack([vertices['x'], vertices['y'], vertices['z']]).astype(np.float64)
+            yield start, points
+            start += len(points)
+    else:
+        cloud = o3d.io.read_point_cloud(path)
+        if not cloud.has_points():
+            raise IOError(f'no points read from {path}')
+        points = np.asarray(cloud.points)
+        for start in range(0, len(points), chunk_points):
+            yield start, points[start:start + chunk_points]
+
+
+def _cells(points, origin, size, bits):
+    cells = 1 << bits
+    return np.clip(np.floor((points - origin) / (size / cells)).astype(np.int64), 0, cells - 1)
+
+
+def _pack(cells, bits):
+    return (cells[..., 0] << (2 * bits)) | (cells[..., 1] << bits) | cells[..., 2]
+
+
+def _unpack(keys, bits):
+    keys = np.asarray(keys, dtype=np.int64)
+    mask = (1 << bits) - 1
+    return np.stack([keys >> (2 * bits), (keys >> bits) & mask, keys & mask], axis=-1)
+
+
+def _cloud_key(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, 'meta.json')
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def _choose_bits(paths, origin, size, chunk_points):
+    # the coarsest grid whose fullest cell holds at most chunk_points / 27 points of either cloud
+    fine = 1 << _MAX_BITS
+    histograms = []
+    for path in paths.values():
+        histogram = np.zeros(fine ** 3, dtype=np.int64)
+        for _, points in iter_points(path, chunk_points):
+            histogram += np.bincount(_pack(_cells(points, origin, size, _MAX_BITS), _MAX_BITS),
+                                     minlength=fine ** 3)
+        histograms.append(histogram.reshape((fine, fine, fine)))
+    budget = max(chunk_points // _BLOCK_CELLS, 1)
+    for bits in range(_MAX_BITS + 1):
+        cells, merge = 1 << bits, 1 << (_MAX_BITS - bits)
+        fullest = max(histogram.reshape((cells, merge, cells, merge, cells, merge)).sum(axis=(1, 3, 5)).max()
+                      for histogram in histograms)
+        if fullest <= budget:
+            return bits
+    return _MAX_BITS
+
+
+def _build_tree(directory, name, key, leafsize):
+    records = np.fromfile(os.path.join(directory, name, f'{key}.bin'), dtype=_RECORD_DTYPE)
+    tree = cKDTree(records['xyz'], leafsize=leafsize, balanced_tree=False)
+    with open(os.path.join(directory, name, f'{key}.kdtree'), 'wb') as f:
+        pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def partition(paths, cache_dir='_out/kdtree_cache', chunk_points=1000000, leafsize=16, executor=None):
+    """
+    Directory in cache_dir with the clouds of paths ({name: path}) split
+    into the cells of a common grid, <name>/<cell>.bin records of xyz and
+    point index, and a pickled <name>/<cell>.kdtree per cell. It is built
+    once and reused while the cloud files do not change.
+    """
+    key = ';'.join(f'{name}={_cloud_key(path)}' for name, path in sorted(paths.items()))
+    key = f'{key};{chunk_points};{leafsize}'
+    directory = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+    if os.path.isfile(os.path.join(directory, _META)):
+        return directory
+
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for path in paths.values():
+        for _, points in iter_points(path, chunk_points):
+            if len(points):
+                low = np.minimum(low, points.min(axis=0))
+                high = np.maximum(high, points.max(axis=0))
+    if not np.all(np.isfinite(low)):
+        raise ValueError(f'no points in {", ".join(paths.values())}')
+    size = float((high - low).max()) * (1 + 1e-6) or 1.0
+    bits = _choose_bits(paths, low, size, chunk_points)
+
+    tmp_dir = f'{directory}.tmp'
+    for stale in (directory, tmp_dir):
+        if os.path.isdir(stale):
+            shutil.rmtree(stale)
+    counts = {}
+    for name, path in paths.items():
+        os.makedirs(os.path.join(tmp_dir, name))
+        counts[name] = {}
+        for start, points in iter_points(path, chunk_points):
+            keys = _pack(_cells(points, low, size, bits), bits)
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            records = np.empty(len(points), dtype=_RECORD_DTYPE)
+            records['xyz'] = points[order]
+            records['index'] = start + order
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else []
+            for first, stop in zip(starts, np.r_[starts[1:], len(keys)]):
+                cell = str(keys[first])
+                with open(os.path.join(tmp_dir, name, f'{cell}.bin'), 'ab') as f:
+                    records[first:stop].tofile(f)
+                counts[name][cell] = counts[name].get(cell, 0) + int(stop - first)
+        if not counts[name]:
+            raise ValueError(f'no points in {path}')
+
+    jobs = [(tmp_dir, name, cell, leafsize) for name in counts for cell in counts[name]]
+    if executor is None:
+        for job in jobs:
+            _build_tree(*job)
+    else:
+        list(executor.map(_build_tree, *zip(*jobs), chunksize=16))
+
+    meta = {'origin': low.tolist(), 'size': size, 'bits': bits, 'counts': counts,
+            'points': {name: sum(cells.values()) for name, cells in counts.items()}}
+    with open(os.path.join(tmp_dir, _META), 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_dir, directory)
+    return directory
+
+
+def _meta(directory):
+    if directory not in _metas:
+        with open(os.path.join(directory, _META)) as f:
+            meta = json.load(f)
+        meta['origin'] = np.array(meta['origin'])
+        meta['cells'] = {name: np.array([int(cell) for cell in cells], dtype=np.int64)
+                         for name, cells in meta['counts'].items()}
+        _metas[directory] = meta
+    return _metas[directory]
+
+
+def _tree(directory, name, key):
+    # the trees of the last block of cells stay loaded for the neighbouring query cells
+    path = os.path.join(directory, name, f'{key}.kdtree')
+    if path in _trees:
+        _trees.move_to_end(path)
+    else:
+        with open(path, 'rb') as f:
+            _trees[path] = pickle.load(f)
+        while len(_trees) > _BLOCK_CELLS:
+            _trees.popitem(last=False)
+    return _trees[path]
+
+
+def _query_cell(directory, direction, key, thresholds, errors_path):
+    query_name, tree_name = _DIRECTIONS[direction]
+    meta = _meta(directory)
+    bits, origin = meta['bits'], meta['origin']
+    cells, cell_size = 1 << bits, meta['size'] / (1 << bits)
+    records = np.fromfile(os.path.join(directory, query_name, f'{key}.bin'), dtype=_RECORD_DTYPE)
+    points = records['xyz']
+    cell = _unpack(key, bits)
+
+    # the tree cells by their ring around the query cell (Chebyshev distance in cells)
+    tree_keys = meta['cells'][tree_name]
+    rings = np.abs(_unpack(tree_keys, bits) - cell).max(axis=1)
+    order = np.argsort(rings, kind='stable')
+    tree_keys, rings = tree_keys[order], rings[order]
+    ring_starts = np.flatnonzero(np.r_[True, rings[1:] != rings[:-1]])
+    ring_stops = np.r_[ring_starts[1:], len(rings)]
+
+    distances = np.full(len(points), np.inf)
+    unresolved = np.arange(len(points))
+    for first, stop in zip(ring_starts, ring_stops):
+        for tree_key in tree_keys[first:stop]:
+            found, _ = _tree(directory, tree_name, tree_key).query(points[unresolved], k=1)
+            distances[unresolved] = np.minimum(distances[unresolved], found)
+        # every cell up to the ring before the next non-empty one has been searched
+        if stop == len(rings):
+            break
+        radius = rings[stop] - 1
+        block_low = origin + (cell - radius) * cell_size
+        block_high = origin + (cell + radius + 1) * cell_size
+        block_low[cell - radius <= 0] = -np.inf
+        block_high[cell + radius + 1 >= cells] = np.inf
+        margin = np.minimum((points[unresolved] - block_low).min(axis=1),
+                            (block_high - points[unresolved]).min(axis=1))
+        unresolved = unresolved[distances[unresolved] > margin]
+        if not len(unresolved):
+            break
+
+    if errors_path is not None:
+        errors = np.load(errors_path, mmap_mode='r+')
+        errors[records['index']] = distances
+        errors.flush()
+        del errors
+    return {
+        'direction': direction,
+        'count': len(distances),
+        'sum': float(distances.sum()),
+        'sum_squared': float(np.square(distances).sum()),
+        'max': float(distances.max()) if len(distances) else 0.0,
+        'within': [int(np.count_nonzero(distances <= threshold)) for threshold in thresholds],
+    }
+
+
+def compare(reconstruction_path, ground_truth_path, thresholds=(0.05, 0.1, 0.2, 0.5), chunk_points=1000000,
+            workers=None, errors_dir=None, cache_dir='_out/kdtree_cache'):
+    """Compare the two clouds; returns the report dict."""
+    paths = {'reconstruction': reconstruction_path, 'ground_truth': ground_truth_path}
+    totals = {direction: {'count': 0, 'sum': 0.0, 'sum_squared': 0.0, 'max': 0.0,
+                          'within': [0] * len(thresholds)} for direction in _DIRECTIONS}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        directory = partition(paths, cache_dir, chunk_points, executor=executor)
+        with open(os.path.join(directory, _META)) as f:
+            meta = json.load(f)
+
+        errors_paths = {}
+        if errors_dir is not None:
+            os.makedirs(errors_dir, exist_ok=True)
+            for direction, (query_name, _) in _DIRECTIONS.items():
+                errors_paths[direction] = os.path.join(errors_dir, f'{direction}.npy')
+                np.lib.format.open_memmap(errors_paths[direction], mode='w+', dtype=np.float32,
+                                          shape=(meta['points'][query_name],)).flush()
+
+        jobs = [(directory, direction, int(cell), list(thresholds), errors_paths.get(direction))
+                for direction, (query_name, _) in _DIRECTIONS.items()
+                for cell in sorted(meta['counts'][query_name], key=int)]
+        for result in executor.map(_query_cell, *zip(*jobs), chunksize=4):
+            total = totals[result['direction']]
+            total['count'] += result['count']
+            total['sum'] += result['sum']
+            total['sum_squared'] += result['sum_squared']
+            total['max'] = max(total['max'], result['max'])
+            total['within'] = [a + b for a, b in zip(total['within'], result['within'])]
+
+    report = {'reconstruction': reconstruction_path, 'ground_truth': ground_truth_path,
+              'grid_cells': 1 << meta['bits']}
+    for direction, total in totals.items():
+        count = max(total['count'], 1)
+        report[direction] = {
+            'points': total['count'],
+            'mean': total['sum'] / count,
+            'rms': float(np.sqrt(total['sum_squared'] / count)),
+            'max': total['max'],
+            'within': {str(threshold): within / count for threshold, within in zip(thresholds, total['within'])},
+        }
+    report['chamfer'] = report['accuracy']['mean'] + report['completeness']['mean']
+    report['chamfer_squared'] = report['accuracy']['rms'] ** 2 + report['completeness']['rms'] ** 2
+    report['f_score'] = {}
+    for threshold in map(str, thresholds):
+        precision = report['accuracy']['within'][threshold]
+        recall = report['completeness']['within'][threshold]
+        report['f_score'][threshold] = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    if errors_dir is not None:
+        report['errors'] = errors_paths
+    return report
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('reconstruction', help='reconstructed cloud (.pcd, .ply, .npy or point_tiles directory)')
+    argparser.add_argument('ground_truth', help='ground truth cloud, e.g. _out/pointcloud.pcd')
+    argparser.add_argument('--thresholds', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.5],
+                           help='distance thresholds in metres')
+    argparser.add_argument('--chunk-points', type=int, default=1000000,
+                           help='points read at a time; a cell holds at most 1/27 of them')
+    argparser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    argparser.add_argument('--errors-dir', default='_out/comparison', help='where to write the per-point distances')
+    argparser.add_argument('--cache-dir', default='_out/kdtree_cache', help='cell and KD-tree cache directory')
+    argparser.add_argument('--save', help='write the report to this JSON file')
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    report = compare(args.reconstruction, args.ground_truth, args.thresholds, args.chunk_points, args.workers,
+                     args.errors_dir, args.cache_dir)
+    elapsed = time.perf_counter() - start
+
+    for direction in _DIRECTIONS:
+        result = report[direction]
+        print(f"{direction:>12}: {result['points']} points, mean {result['mean']:.4f} m, "
+              f"rms {result['rms']:.4f} m, max {result['max']:.4f} m")
+    print(f"     chamfer: {report['chamfer']:.4f} m, squared {report['chamfer_squared']:.6f} m^2")
+    print(f"{'threshold':>12} {'accuracy':>9} {'complete':>9} {'f-score':>8}")
+    for threshold in report['f_score']:
+        print(f"{threshold:>12} {report['accuracy']['within'][threshold]:9.3f} "
+              f"{report['completeness']['within'][threshold]:9.3f} {report['f_score'][threshold]:8.3f}")
+    print(f'compared in {elapsed:.1f} s ({report["grid_cells"]}^3 grid)')
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
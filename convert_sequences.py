@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+Offline conversion of recorded sequences on all cores.
+
+    python convert_sequences.py _out/sequences/<timestamp>
+    python convert_sequences.py _out/sequences/<timestamp>/1_1 --workers 8 --force
+
+Every run below the given directory is converted:
+
+  - runs with a raw dump (raw/, export_format = "raw" in im_seq_roundabout.py)
+    get all six products, identical to the ones written during capture
+  - runs exported as PNG with depth_16 get masked_rgb and semseg_masked
+    recomputed from rgb, depth_16 and semseg, e.g. after changing
+    depth_treshold.create_mask; the depth comes from the 16 bit export, so
+    the mask can differ slightly from the one made at capture time
+
+The frames of each run are split into chunks that a process pool works
+through. An output is skipped when it is newer than its inputs and than the
+conversion code (frame_processor, image_converter, depth_treshold), so a
+changed threshold reconverts everything and an interrupted run resumes.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2 as cv
+import numpy as np
+
+import depth_treshold
+import frame_processor
+import image_converter
+from frame_processor import FrameProcessor
+from sequence_store import SequenceReader
+
+# FrameProcessor attribute -> output path, relative to the run directory
+_PRODUCTS = {
+    'depth_16': 'depth_16/{tick}_depth.png',
+    'depth_log': 'depth/{tick}_depth.png',
+    'masked_rgb': 'masked_rgb/{tick}_masked.png',
+    'rgb': 'rgb/{tick}.png',
+    'semseg_masked': 'semseg_masked/{tick}_semseg_masked.png',
+    'semseg': 'semseg/{tick}_semseg.png',
+}
+_REMASKED = ('masked_rgb', 'semseg_masked')
+# directories inside a run that are never runs themselves
+_RUN_CONTENTS = {'raw', 'store'} | {path.split('/')[0] for path in _PRODUCTS.values()}
+
+# per worker process state
+_processors = {}
+_readers = {}
+
+
+def _code_mtime():
+    return max(os.path.getmtime(module.__file__)
+               for module in (frame_processor, image_converter, depth_treshold))
+
+
+def _up_to_date(paths, newest_input):
+    for path in paths:
+        try:
+            if os.path.getmtime(path) < newest_input:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _outputs(run, names, tick):
+    return [os.path.join(run, _PRODUCTS[name].format(tick=tick)) for name in names]
+
+
+def _imwrite(path, image):
+    # write next to the target and rename, so an interrupted write never
+    # leaves a file that looks up to date
+    base, ext = os.path.splitext(path)
+    tmp_path = f'{base}.tmp{ext}'
+    if not cv.imwrite(tmp_path, image):
+        raise IOError(f'could not write {path}')
+    os.replace(tmp_path, path)
+
+
+def find_runs(root):
+    """(run directory, kind) of every convertible run below root, kind being 'raw' or 'png'."""
+    runs = []
+    for directory, subdirs, files in os.walk(root):
+        if os.path.isfile(os.path.join(directory, 'raw', 'meta.json')):
+            runs.append((directory, 'raw'))
+        elif all(name in subdirs for name in ('rgb', 'depth_16', 'semseg')):
+            runs.append((directory, 'png'))
+        subdirs[:] = [name for name in subdirs if name not in _RUN_CONTENTS]
+    return sorted(runs)
+
+
+def _png_ticks(run):
+    ticks = []
+    for name in os.listdir(os.path.join(run, 'rgb')):
+        stem, ext = os.path.splitext(name)
+        if ext == '.png' and stem.isdigit():
+            tick = int(stem)
+            if all(os.path.isfile(path) for path in _outputs(run, ('depth_16', 'semseg'), tick)):
+                ticks.append(tick)
+    return sorted(ticks)
+
+
+def plan(root, chunk_frames=16, force=False):
+    """Chunks of (kind, run, ticks) that still need converting."""
+    code_mtime = _code_mtime()
+    jobs = []
+    for run, kind in find_runs(root):
+        if kind == 'raw':
+            raw_path = os.path.join(run, 'raw')
+            newest = max([code_mtime] + [os.path.getmtime(os.path.join(raw_path, name))
+                                         for name in os.listdir(raw_path)])
+            ticks = [int(tick) for tick in SequenceReader(raw_path).frames]
+            pending = [tick for tick in ticks
+                       if force or not _up_to_date(_outputs(run, _PRODUCTS, tick), newest)]
+        else:
+            pending = []
+            for tick in _png_ticks(run):
+                newest = max([code_mtime] + [os.path.getmtime(path) for path in
+                                             _outputs(run, ('rgb', 'depth_16', 'semseg'), tick)])
+                if force or not _up_to_date(_outputs(run, _REMASKED, tick), newest):
+                    pending.append(tick)
+        for start in range(0, len(pending), chunk_frames):
+            jobs.append((kind, run, pending[start:start + chunk_frames]))
+    return jobs
+
+
+def _init_worker():
+    # one process per core, so keep OpenCV from starting threads of its own
+    cv.setNumThreads(1)
+
+
+def _convert_raw(run, ticks):
+    raw_path = os.path.join(run, 'raw')
+    reader = _readers.get(raw_path)
+    if reader is None:
+        reader = _readers[raw_path] = SequenceReader(raw_path)
+    height, width, _ = reader.streams['rgb_raw'][0]
+    processor = _processors.get((width, height))
+    if processor is None:
+        processor = _processors[(width, height)] = FrameProcessor(width, height)
+
+    for tick in ticks:
+        position = reader.position(tick)
+        processor.process_arrays(reader['rgb_raw'][position],
+                                 reader['depth_raw'][position],
+                                 reader['semseg_raw'][position])
+        for name in _PRODUCTS:
+            path = os.path.join(run, _PRODUCTS[name].format(tick=tick))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _imwrite(path, getattr(processor, name))
+
+
+def _convert_png(run, ticks):
+    for name in _REMASKED:
+        os.makedirs(os.path.dirname(os.path.join(run, _PRODUCTS[name])), exist_ok=True)
+    for tick in ticks:
+        rgb_path, depth_path, semseg_path = _outputs(run, ('rgb', 'depth_16', 'semseg'), tick)
+        bgra = cv.imread(rgb_path, cv.IMREAD_UNCHANGED)
+        depth = cv.imread(depth_path, cv.IMREAD_UNCHANGED) * (255.0 / 65535.0)
+        semseg = cv.imread(semseg_path, cv.IMREAD_COLOR)
+
+        depth_mask = depth_treshold.create_mask(depth)
+        masked_rgb = cv.bitwise_and(bgra, bgra, mask=depth_mask)
+        # the palette is stored in RGB order, classes with a red of 0 are kept
+        keep = (semseg[:, :, 0] == 0).astype(np.uint8)
+        np.bitwise_and(keep, depth_mask, out=keep)
+        semseg_masked = cv.bitwise_and(bgra, bgra, mask=keep)
+
+        masked_path, semseg_masked_path = _outputs(run, _REMASKED, tick)
+        _imwrite(masked_path, masked_rgb)
+        _imwrite(semseg_masked_path, semseg_masked)
+
+
+def _convert(job):
+    kind, run, ticks = job
+    if kind == 'raw':
+        _convert_raw(run, ticks)
+    else:
+        _convert_png(run, ticks)
+    return len(ticks)
+
+
+def convert(root, workers=None, chunk_frames=16, force=False):
+    """Convert every pending frame below root; returns the number of frames converted."""
+    jobs = plan(root, chunk_frames, force)
+    total = sum(len(ticks) for _, _, ticks in jobs)
+    if not jobs:
+        return 0
+
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(_convert, job) for job in jobs]
+        for future in as_completed(futures):
+            done += future.result()
+            print(f'\r{done}/{total} frames', end='', flush=True)
+    print()
+    return done
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('root', help='sequence directory, e.g. _out/sequences/<timestamp>')
+    argparser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    argparser.add_argument('--chunk-frames', type=int, default=16, help='frames per work item')
+    argparser.add_argument('--force', action='store_true', help='convert up to date outputs too')
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    converted = convert(args.root, args.workers, args.chunk_frames, args.force)
+    elapsed = time.perf_counter() - start
+    rate = f', {converted / elapsed:.1f} frames/s' if converted else ''
+    print(f'{converted} frames converted in {elapsed:.1f} s{rate}')
+
+
+if __name__ == '__main__':
+    main()
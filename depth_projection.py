@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+Back-projection of captured depth images into world coordinate point clouds.
+
+Every pixel of a W x H camera with focal length f looks along a fixed ray,
+which in CARLA camera axes (x forward, y right, z up) is
+
+    (1, (u - W / 2) / f, -(v - H / 2) / f)
+
+CARLA depth is the distance along x, so the camera point of a pixel is its
+ray times its depth. The rays of each (width, height, focal) are computed
+once and cached, and a frame becomes world points with one matrix product
+with the camera pose from camera.txt (x, y, z, roll, yaw, pitch):
+
+    points = backproject(depth_metres, pose_matrix(pose), focal)
+
+backproject_run() does this for a whole run exported by the capture scripts
+(depth_16/, rgb/, semseg/, camera.txt, focal.txt, or a sequence_store in
+store/), reading the frames ahead on a thread pool:
+
+    python depth_projection.py _out/sequences/<timestamp>/1_1 --output _out/1_1.pcd --classes 7 --colour
+"""
+
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+import image_converter
+from lidar_accumulator import VoxelAccumulator, write_point_cloud
+from point_tiles import write_tiles
+from sequence_store import SequenceReader
+
+# CARLA depth cameras see at most 1000 m; the sky is at the far plane
+_FAR = 1000.0
+
+_ray_tables = {}
+
+
+def ray_table(width, height, focal):
+    """Read-only (H, W, 3) float32 camera ray of every pixel, depth 1 along x."""
+    key = (width, height, float(focal))
+    rays = _ray_tables.get(key)
+    if rays is None:
+        v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+        rays = np.empty((height, width, 3), dtype=np.float32)
+        rays[:, :, 0] = 1.0
+        rays[:, :, 1] = (u - width / 2.0) / focal
+        rays[:, :, 2] = -(v - height / 2.0) / focal
+        rays.flags.writeable = False
+        _ray_tables[key] = rays
+    return rays
+
+
+def pose_matrix(pose):
+    """4x4 camera-to-world matrix of an x, y, z, roll, yaw, pitch row of camera.txt (CARLA convention)."""
+    x, y, z, roll, yaw, pitch = (float(value) for value in pose)
+    cy, sy = np.cos(np.radians(yaw)), np.sin(np.radians(yaw))
+    cr, sr = np.cos(np.radians(roll)), np.sin(np.radians(roll))
+    cp, sp = np.cos(np.radians(pitch)), np.sin(np.radians(pitch))
+    return np.array([[cp * cy, cy * sp * sr - sy * cr, -cy * sp * cr - sy * sr, x],
+                     [cp * sy, sy * sp * sr + cy * cr, -sy * sp * cr + cy * sr, y],
+                     [sp, -cp * sr, cp * cr, z],
+                     [0.0, 0.0, 0.0, 1.0]])
+
+
+def depth_16_to_metres(depth_16):
+    """Metric depth of a depth_16 export (normalized depth * 65535)."""
+    return depth_16.astype(np.float32) * np.float32(_FAR / 65535.0)
+
+
+def palette_to_labels(semseg, version='legacy'):
+    """Labels of a semseg export (Cityscapes palette in RGB order); unknown colours become 0."""
+    classes = image_converter.CITYSCAPES_CLASSES[version]
+    labels = np.array(sorted(classes), dtype=np.uint8)
+    codes = np.array([(r << 16) | (g << 8) | b for r, g, b in (classes[label] for label in labels)])
+    order = np.argsort(codes)
+    codes, labels = codes[order], labels[order]
+    semseg = semseg.astype(np.int64)
+    pixel_codes = (semseg[:, :, 0] << 16) | (semseg[:, :, 1] << 8) | semseg[:, :, 2]
+    positions = np.clip(np.searchsorted(codes, pixel_codes), 0, len(codes) - 1)
+    return np.where(codes[positions] == pixel_codes, labels[positions], 0).astype(np.uint8)
+
+
+def backproject(depth, matrix, focal, mask=None):
+    """
+    (M, 3) float32 world points of the pixels of a (H, W) metric depth image
+    where mask is nonzero (default: every pixel), in row-major pixel order.
+    """
+    height, width = depth.shape
+    rays = ray_table(width, height, focal).reshape((-1, 3))
+    depth = depth.reshape(-1)
+    if mask is not None:
+        selected = np.flatnonzero(mask.reshape(-1))
+        rays, depth = rays[selected], depth[selected]
+    matrix = np.asarray(matrix, dtype=np.float32)
+    points = rays * depth[:, None]
+    points = np.matmul(points, matrix[:3, :3].T, out=points)
+    points += matrix[:3, 3]
+    return points
+
+
+def _prefetch(function, items, ahead):
+    # map function over items on a thread pool, at most `ahead` items in flight
+    with ThreadPoolExecutor(max_workers=ahead) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_run(run):
+    """ticks, (N, 6) poses and focal length of a run directory, and whether it is a sequence_store run."""
+    focal = float(np.loadtxt(os.path.join(run, 'focal.txt')))
+    store_path = os.path.join(run, 'store')
+    if os.path.isfile(os.path.join(store_path, 'meta.json')):
+        store = SequenceReader(store_path)
+        return [int(tick) for tick in store.frames], np.asarray(store.poses), focal, True
+
+    ticks = sorted(int(name.split('_')[0]) for name in os.listdir(os.path.join(run, 'depth_16'))
+                   if name.endswith('_depth.png'))
+    if os.path.isfile(os.path.join(run, 'camera.npy')):
+        records = np.load(os.path.join(run, 'camera.npy'))
+        poses = dict(zip(records['tick'].tolist(), records['pose']))
+        ticks = [tick for tick in ticks if tick in poses]
+        return ticks, np.array([poses[tick] for tick in ticks]), focal, False
+    # camera.txt has one row per exported tick, in order
+    poses = np.loadtxt(os.path.join(run, 'camera.txt'), ndmin=2)
+    if len(poses) != len(ticks):
+        raise ValueError(f'{run}: {len(ticks)} depth images but {len(poses)} poses in camera.txt')
+    return ticks, poses, focal, False
+
+
+def run_frames(run, stride=1, colour=False, with_labels=False, palette_version='legacy', prefetch=8):
+    """
+    Yield (tick, camera-to-world matrix, metric depth, BGR image or None,
+    labels or None) for every stride-th frame of a run, reading ahead on a
+    thread pool.
+    """
+    ticks, poses, _, is_store = read_run(run)
+    store = SequenceReader(os.path.join(run, 'store')) if is_store else None
+    frames = list(zip(ticks, poses))[::stride]
+
+    def load(frame):
+        tick, pose = frame
+        bgr = labels = None
+        if store is not None:
+            position = store.position(tick)
+            depth = depth_16_to_metres(store['depth_16'][position])
+            if colour:
+                bgr = store['rgb'][position][:, :, :3]
+            if with_labels:
+                labels = store['semseg'][position]
+        else:
+            depth = depth_16_to_metres(cv.imread(os.path.join(run, 'depth_16', f'{tick}_depth.png'),
+                                                 cv.IMREAD_UNCHANGED))
+            if colour:
+                bgr = cv.imread(os.path.join(run, 'rgb', f'{tick}.png'), cv.IMREAD_COLOR)
+            if with_labels:
+                semseg = cv.imread(os.path.join(run, 'semseg', f'{tick}_semseg.png'), cv.IMREAD_COLOR)
+                labels = palette_to_labels(semseg, palette_version)
+        return tick, pose_matrix(pose), depth, bgr, labels
+
+    return _prefetch(load, frames, prefetch)
+
+
+def backproject_run(run, stride=1, max_depth=_FAR * 0.99, classes=None, colour=False, palette_version='legacy',
+                    prefetch=8):
+    """
+    Yield (tick, points, colors) for every stride-th frame of a run. Pixels at
+    max_depth or beyond (the sky) are skipped, and with classes only pixels
+    of those semantic labels are kept. colors is an (M, 3) uint8 RGB array
+    with colour, else None.
+    """
+    focal = read_run(run)[2]
+    for tick, matrix, depth, bgr, labels in run_frames(run, stride, colour, classes is not None, palette_version,
+                                                       prefetch):
+        mask = depth < max_depth
+        if labels is not None:
+            mask &= np.isin(labels, classes)
+        points = backproject(depth, matrix, focal, mask)
+        colors = None
+        if bgr is not None:
+            colors = bgr.reshape((-1, 3))[np.flatnonzero(mask.reshape(-1)), ::-1]
+        yield tick, points, colors
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('run', help='run directory, e.g. _out/sequences/<timestamp>/1_1')
+    argparser.add_argument('--output', default=None,
+                           help='.npy (CARLA coordinates), a point_tiles directory (ending in /) or an open3d '
+                                'cloud file (y negated like the LiDAR export); default <run>/depth_cloud.pcd')
+    argparser.add_argument('--stride', type=int, default=1, help='use every n-th frame')
+    argparser.add_argument('--max-depth', type=float, default=_FAR * 0.99, help='skip pixels this far or farther')
+    argparser.add_argument('--classes', type=int, nargs='+', default=None, help='keep only these semantic labels')
+    argparser.add_argument('--colour', action='store_true', help='colour the points from rgb/')
+    argparser.add_argument('--voxel-size', type=float, default=None,
+                           help='merge the frames into voxels of this size in metres')
+    args = argparser.parse_args()
+
+    output = args.output or os.path.join(args.run, 'depth_cloud.pcd')
+    if args.colour and output.endswith('.npy'):
+        argparser.error('--colour needs a point_tiles or open3d output, .npy only holds the points')
+    voxels = None if args.voxel_size is None else VoxelAccumulator(args.voxel_size, colors=args.colour)
+    all_points, all_colors = [], []
+    for tick, points, colors in backproject_run(args.run, args.stride, args.max_depth, args.classes, args.colour):
+        if voxels is not None:
+            voxels.add_points(points, colors=colors)
+        else:
+            all_points.append(points)
+            all_colors.append(colors)
+        print(f'\rframe {tick}', end='', flush=True)
+    print()
+
+    if voxels is not None:
+        points, colors = voxels.points, voxels.colors if args.colour else None
+    else:
+        points = np.concatenate(all_points) if all_points else np.empty((0, 3), dtype=np.float32)
+        colors = np.concatenate(all_colors) if args.colour and all_colors else None
+
+    if output.endswith('.npy'):
+        np.save(output, points)
+    elif output.endswith('/') or os.path.isdir(output):
+        write_tiles(output, points, {} if colors is None else {'rgb': colors})
+    else:
+        write_point_cloud(output, points, colors)
+    print(f'{len(points)} points written to {output}')
+
+
+if __name__ == '__main__':
+    main()
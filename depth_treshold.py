@@ -1,8 +1,80 @@
+import time
+import warnings
+
 import cv2 as cv
 import numpy as np
 
+# number of distinct depth levels peeled off the far end of the image
+_PEEL_STEPS = 20
+# steps to back off when peeling empties the image
+_FALLBACK_STEPS = 5
+# depth values below this are ignored when picking the threshold
+_MIN_DEPTH = 3
+
+
+def create_mask(depth, back_off=False):
+    """
+    Mask out the far end of a depth image given in [0, 255].
+
+    The farthest integer depth level is peeled off repeatedly (up to 20
+    times), then the threshold is the largest remaining depth of at least 3;
+    pixels deeper than it are masked out. Returns a uint8 mask of 0 and 255.
+
+    Only the 256 integer depth levels matter, so the peeling runs on a
+    histogram of the image instead of on the image itself, and the mask is
+    identical to the one of the previous, iterative implementation.
+
+    When peeling empties the image, the iterative implementation meant to
+    back off five steps, but it kept references to a single mutated array,
+    so the fallback always ended with an all-NaN array and, through
+    cv.threshold(nan), an empty mask. This happens whenever the image has
+    fewer than about 40 depth levels, e.g. sky plus a scene within ~150 m.
+    The empty mask is kept by default so existing sequences stay
+    reproducible; back_off=True applies the intended five-step back-off.
+    """
+    depth_img = depth.astype(np.uint8)
+    counts = np.bincount(depth_img.ravel(), minlength=256)
+    if np.issubdtype(depth.dtype, np.integer):
+        exact = counts > 0
+    else:
+        # does depth == level occur, for every integer level
+        exact = np.bincount(depth_img[depth == depth_img], minlength=256) > 0
+
+    def level_at_most(limit):
+        # integer part of the largest depth <= limit, or -1 if there is none
+        if limit < 0:
+            return -1
+        if exact[limit]:
+            return limit
+        below = np.flatnonzero(counts[:limit])
+        return below[-1] if len(below) else -1
+
+    # limits[j]: before peeling step j every depth > limits[j] is removed
+    limits = [255]
+    level = level_at_most(255)
+    for i in range(_PEEL_STEPS):
+        limit = level - 1
+        level = level_at_most(limit)
+        if level < 0:
+            if not back_off:
+                # same as thresholding with NaN: everything is masked out
+                limit = -1
+            else:
+                limit = limits[i - _FALLBACK_STEPS if i > _FALLBACK_STEPS else max(i - 1, 0)]
+            break
+        limits.append(limit)
+
+    threshold = level_at_most(limit)
+    if threshold < _MIN_DEPTH:
+        threshold = -1
+
+    _, thresh = cv.threshold(depth_img, threshold, 255, cv.THRESH_BINARY_INV)
+
+    return thresh
+
 
-def create_mask(depth):
+def _create_mask_iterative(depth):
+    # previous implementation of create_mask, kept as a benchmark reference
 
     depth_non_extreme = depth.copy()
     prev_dept_non_extreme_array = []
@@ -15,9 +87,7 @@ def create_mask(depth):
             break
     depth_non_extreme[depth < 3] = np.nan
 
-    #non_extreme_median_depth = np.nanmedian(depth_non_extreme)
     non_extreme_max_depth = np.nanmax(depth_non_extreme)
-    #non_extreme_mean_depth = np.nanmean(depth_non_extreme)
 
     t = non_extreme_max_depth
 
@@ -25,5 +95,40 @@ def create_mask(depth):
 
     _, thresh = cv.threshold(depth_img, t, 255, cv.THRESH_BINARY_INV)
 
-
     return thresh
+
+
+def main():
+    # benchmark create_mask against the previous implementation on synthetic
+    # 1280x720 depth images (normalized depth * 255, as the capture scripts use)
+    rng = np.random.default_rng(0)
+    height, width = 720, 1280
+    rows, cols = np.mgrid[0:height, 0:width]
+    scenes = {
+        'road': (1.0 + 200.0 * rows / height + 30.0 * cols / width) / 1000.0,
+        'road with sky': np.where(rows < 200, 1.0, (1.0 + 200.0 * rows / height) / 1000.0),
+        'noise': rng.random((height, width)),
+        'close wall': (2.0 + 10.0 * cols / width) / 1000.0,
+    }
+    repeats = 10
+    for name, normalized in scenes.items():
+        # quantize like the 24 bit CARLA depth encoding
+        depth = np.round(normalized * (256.0 ** 3 - 1)) / (256.0 ** 3 - 1) * 255
+        timings = []
+        for function in (_create_mask_iterative, create_mask):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                with warnings.catch_warnings():
+                    # the iterative version warns about its all-NaN fallback
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    mask = function(depth)
+            timings.append(((time.perf_counter() - start) / repeats, mask))
+        (old_time, old_mask), (new_time, new_mask) = timings
+        fallback = (create_mask(depth, back_off=True) != new_mask).any()
+        print(f'{name:>14}: iterative {old_time * 1000:7.2f} ms, histogram {new_time * 1000:6.2f} ms, '
+              f'speedup {old_time / new_time:5.1f}x, identical: {np.array_equal(old_mask, new_mask)}, '
+              f'fallback: {fallback}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,747 @@
+#!/usr/bin/env python
+
+"""
+Offline stand-in for the subset of the carla Python API used by the capture
+scripts, so the pipeline can be profiled and regression-tested without a
+simulator or a GPU.
+
+Sensors produce deterministic synthetic RGB, depth, semantic segmentation and
+LiDAR buffers. World.tick() blocks for tick_latency seconds (the server
+simulating and rendering) and sensor data is delivered from a separate thread
+after sensor_latency seconds, like the real client does.
+
+    import fake_carla
+    fake_carla.install(tick_latency=0.01)   # registers itself as `carla`
+    import im_seq_roundabout
+    im_seq_roundabout.main()
+
+or from the command line
+
+    python fake_carla.py im_seq_roundabout --tick-latency 0.01
+"""
+
+import argparse
+import fnmatch
+import importlib
+import itertools
+import math
+import queue
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+_VERSION = '0.9.13'
+
+_config = {
+    'tick_latency': 0.0,
+    'sensor_latency': 0.0,
+    'seed': 0,
+    # distinct synthetic frames per sensor, cycled by frame number
+    'variants': 8,
+}
+
+_actor_ids = itertools.count(1)
+
+
+def install(**kwargs):
+    """Register this module as `carla` (and `carla.command`) and configure it."""
+    configure(**kwargs)
+    module = sys.modules[__name__]
+    sys.modules['carla'] = module
+    sys.modules['carla.command'] = command
+    return module
+
+
+def configure(**kwargs):
+    """Set tick_latency, sensor_latency, seed and variants."""
+    for key, value in kwargs.items():
+        if key not in _config:
+            raise TypeError(f'unknown option {key!r}')
+        _config[key] = value
+
+
+# ==============================================================================
+# -- geometry ------------------------------------------------------------------
+# ==============================================================================
+
+
+class Vector3D(object):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = float(x)
+        self.y = float(y)
+        self.z = float(z)
+
+    def __add__(self, other):
+        return type(self)(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return type(self)(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def distance(self, other):
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
+
+    def __repr__(self):
+        return f'{type(self).__name__}(x={self.x:.6f}, y={self.y:.6f}, z={self.z:.6f})'
+
+
+class Location(Vector3D):
+    pass
+
+
+class Rotation(object):
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch = float(pitch)
+        self.yaw = float(yaw)
+        self.roll = float(roll)
+
+    def get_forward_vector(self):
+        cp, sp = math.cos(math.radians(self.pitch)), math.sin(math.radians(self.pitch))
+        cy, sy = math.cos(math.radians(self.yaw)), math.sin(math.radians(self.yaw))
+        return Vector3D(cp * cy, cp * sy, sp)
+
+    def __repr__(self):
+        return f'Rotation(pitch={self.pitch:.6f}, yaw={self.yaw:.6f}, roll={self.roll:.6f})'
+
+
+class Transform(object):
+    def __init__(self, location=None, rotation=None):
+        self.location = location if location is not None else Location()
+        self.rotation = rotation if rotation is not None else Rotation()
+
+    def get_matrix(self):
+        """Local to world 4x4 matrix, with CARLA's rotation convention."""
+        cy, sy = math.cos(math.radians(self.rotation.yaw)), math.sin(math.radians(self.rotation.yaw))
+        cr, sr = math.cos(math.radians(self.rotation.roll)), math.sin(math.radians(self.rotation.roll))
+        cp, sp = math.cos(math.radians(self.rotation.pitch)), math.sin(math.radians(self.rotation.pitch))
+        return [[cp * cy, cy * sp * sr - sy * cr, -cy * sp * cr - sy * sr, self.location.x],
+                [cp * sy, sy * sp * sr + cy * cr, -sy * sp * cr + cy * sr, self.location.y],
+                [sp, -cp * sr, cp * cr, self.location.z],
+                [0.0, 0.0, 0.0, 1.0]]
+
+    def transform(self, location):
+        m = self.get_matrix()
+        return Location(*(m[i][0] * location.x + m[i][1] * location.y + m[i][2] * location.z + m[i][3]
+                          for i in range(3)))
+
+    def get_forward_vector(self):
+        return self.rotation.get_forward_vector()
+
+    def __repr__(self):
+        return f'Transform({self.location!r}, {self.rotation!r})'
+
+
+def _compose(parent, relative):
+    return Transform(parent.transform(relative.location),
+                     Rotation(pitch=parent.rotation.pitch + relative.rotation.pitch,
+                              yaw=parent.rotation.yaw + relative.rotation.yaw,
+                              roll=parent.rotation.roll + relative.rotation.roll))
+
+
+# ==============================================================================
+# -- settings, weather, commands -----------------------------------------------
+# ==============================================================================
+
+
+class WorldSettings(object):
+    def __init__(self, synchronous_mode=False, no_rendering_mode=False, fixed_delta_seconds=None, **kwargs):
+        self.synchronous_mode = synchronous_mode
+        self.no_rendering_mode = no_rendering_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.__dict__.update(kwargs)
+
+
+class WeatherParameters(object):
+    def __init__(self, **kwargs):
+        self.cloudiness = 0.0
+        self.precipitation = 0.0
+        self.precipitation_deposits = 0.0
+        self.wind_intensity = 0.0
+        self.sun_azimuth_angle = 0.0
+        self.sun_altitude_angle = 0.0
+        self.fog_density = 0.0
+        self.fog_distance = 0.0
+        self.fog_falloff = 0.0
+        self.wetness = 0.0
+        self.scattering_intensity = 0.0
+        self.mie_scattering_scale = 0.0
+        self.rayleigh_scattering_scale = 0.0331
+        self.__dict__.update(kwargs)
+
+
+class TrafficLightState(object):
+    Red = 0
+    Yellow = 1
+    Green = 2
+    Off = 3
+    Unknown = 4
+
+
+class _DestroyActor(object):
+    def __init__(self, actor):
+        self.actor_id = actor if isinstance(actor, int) else actor.id
+
+
+command = types.ModuleType('carla.command')
+command.DestroyActor = _DestroyActor
+
+
+class Timestamp(object):
+    def __init__(self, frame, elapsed_seconds, delta_seconds):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.delta_seconds = delta_seconds
+        self.platform_timestamp = time.time()
+
+
+class WorldSnapshot(object):
+    def __init__(self, frame, timestamp):
+        self.id = 0
+        self.frame = frame
+        self.timestamp = timestamp
+
+
+# ==============================================================================
+# -- blueprints ----------------------------------------------------------------
+# ==============================================================================
+
+
+class ActorAttribute(object):
+    def __init__(self, id, value, recommended_values=()):
+        self.id = id
+        self.recommended_values = list(recommended_values)
+        self._value = str(value)
+
+    def as_str(self):
+        return self._value
+
+    def as_int(self):
+        return int(float(self._value))
+
+    def as_float(self):
+        return float(self._value)
+
+    def __str__(self):
+        return self._value
+
+
+class ActorBlueprint(object):
+    def __init__(self, id, attributes):
+        self.id = id
+        self.tags = id.split('.')
+        self._attributes = {key: ActorAttribute(key, *value) for key, value in attributes.items()}
+
+    def has_attribute(self, id):
+        return id in self._attributes
+
+    def get_attribute(self, id):
+        return self._attributes[id]
+
+    def set_attribute(self, id, value):
+        if id not in self._attributes:
+            raise IndexError(f'blueprint {self.id} has no attribute {id}')
+        self._attributes[id]._value = str(value)
+
+    def __iter__(self):
+        return iter(self._attributes.values())
+
+    def _copy(self):
+        return ActorBlueprint(self.id, {key: (attribute._value, attribute.recommended_values)
+                                        for key, attribute in self._attributes.items()})
+
+
+_CAMERA_ATTRIBUTES = {'image_size_x': ('800',), 'image_size_y': ('600',), 'fov': ('90',),
+                      'sensor_tick': ('0.0',)}
+
+_BLUEPRINTS = {
+    'vehicle.tesla.model3': {'color': ('17,37,103', ['17,37,103', '255,255,255', '0,0,0', '200,20,20']),
+                             'role_name': ('autopilot',)},
+    'sensor.camera.rgb': _CAMERA_ATTRIBUTES,
+    'sensor.camera.depth': _CAMERA_ATTRIBUTES,
+    'sensor.camera.semantic_segmentation': _CAMERA_ATTRIBUTES,
+    'sensor.lidar.ray_cast': {'range': ('10.0',), 'channels': ('32',), 'points_per_second': ('56000',),
+                              'rotation_frequency': ('10.0',), 'upper_fov': ('10.0',),
+                              'lower_fov': ('-30.0',), 'sensor_tick': ('0.0',)},
+}
+
+
+class BlueprintLibrary(object):
+    def __init__(self):
+        self._blueprints = [ActorBlueprint(id, attributes) for id, attributes in _BLUEPRINTS.items()]
+
+    def find(self, id):
+        for blueprint in self._blueprints:
+            if blueprint.id == id:
+                return blueprint._copy()
+        raise IndexError(f'blueprint {id} not found')
+
+    def filter(self, wildcard_pattern):
+        return [blueprint._copy() for blueprint in self._blueprints
+                if fnmatch.fnmatch(blueprint.id, wildcard_pattern)]
+
+    def __iter__(self):
+        return iter(self.filter('*'))
+
+    def __len__(self):
+        return len(self._blueprints)
+
+
+# ==============================================================================
+# -- actors --------------------------------------------------------------------
+# ==============================================================================
+
+
+class Actor(object):
+    def __init__(self, world, type_id, transform, parent=None, attributes=None):
+        self.id = next(_actor_ids)
+        self.type_id = type_id
+        self.parent = parent
+        self.attributes = attributes or {}
+        self.is_alive = True
+        self._world = world
+        self._transform = transform
+
+    def get_world(self):
+        return self._world
+
+    def get_transform(self):
+        if self.parent is not None:
+            return _compose(self.parent.get_transform(), self._transform)
+        return Transform(Location(self._transform.location.x, self._transform.location.y,
+                                  self._transform.location.z),
+                         Rotation(self._transform.rotation.pitch, self._transform.rotation.yaw,
+                                  self._transform.rotation.roll))
+
+    def get_location(self):
+        return self.get_transform().location
+
+    def set_transform(self, transform):
+        self._transform = transform
+
+    def set_location(self, location):
+        self._transform = Transform(location, self._transform.rotation)
+
+    def destroy(self):
+        if not self.is_alive:
+            return False
+        self.is_alive = False
+        self._world._remove(self)
+        return True
+
+    def __repr__(self):
+        return f'Actor(id={self.id}, type={self.type_id})'
+
+
+class Vehicle(Actor):
+    # speed of the fake autopilot, m/s
+    _AUTOPILOT_SPEED = 8.0
+
+    def __init__(self, *args, **kwargs):
+        super(Vehicle, self).__init__(*args, **kwargs)
+        self._autopilot = False
+
+    def set_autopilot(self, enabled=True, tm_port=8000):
+        self._autopilot = enabled
+
+    def _step(self, delta_seconds):
+        if self._autopilot:
+            forward = self._transform.rotation.get_forward_vector()
+            distance = self._AUTOPILOT_SPEED * delta_seconds
+            self._transform.location = self._transform.location + Location(forward.x * distance,
+                                                                           forward.y * distance, 0.0)
+            # drive a wide circle so the view keeps changing
+            self._transform.rotation.yaw += 2.0 * delta_seconds
+
+
+class TrafficLight(Actor):
+    def __init__(self, *args, **kwargs):
+        super(TrafficLight, self).__init__(*args, **kwargs)
+        self._state = TrafficLightState.Red
+
+    def set_state(self, state):
+        self._state = state
+
+    def get_state(self):
+        return self._state
+
+    state = property(get_state)
+
+
+class Sensor(Actor):
+    def __init__(self, *args, **kwargs):
+        super(Sensor, self).__init__(*args, **kwargs)
+        self._callback = None
+        self._buffers = None
+
+    @property
+    def is_listening(self):
+        return self._callback is not None
+
+    def listen(self, callback):
+        self._callback = callback
+
+    def stop(self):
+        self._callback = None
+
+    def _measure(self, frame, timestamp):
+        if self._buffers is None:
+            self._buffers = _synthetic_buffers(self.type_id, self.attributes, _config['variants'],
+                                               _config['seed'] + self.id)
+        buffer = self._buffers[frame % len(self._buffers)]
+        transform = self.get_transform()
+        if self.type_id == 'sensor.lidar.ray_cast':
+            return LidarMeasurement(frame, timestamp.elapsed_seconds, transform, buffer,
+                                    int(self.attributes['channels']))
+        height, width = buffer.shape[:2]
+        return Image(frame, timestamp.elapsed_seconds, transform, buffer, width, height,
+                     float(self.attributes['fov']))
+
+
+class SensorData(object):
+    def __init__(self, frame, timestamp, transform):
+        self.frame = frame
+        self.frame_number = frame
+        self.timestamp = timestamp
+        self.transform = transform
+
+
+class Image(SensorData):
+    def __init__(self, frame, timestamp, transform, buffer, width, height, fov):
+        super(Image, self).__init__(frame, timestamp, transform)
+        self.width = width
+        self.height = height
+        self.fov = fov
+        self.raw_data = memoryview(buffer).cast('B')
+
+    def save_to_disk(self, path, color_converter=None):
+        import cv2 as cv
+        array = np.frombuffer(self.raw_data, dtype=np.uint8).reshape((self.height, self.width, 4))
+        cv.imwrite(path, array)
+
+
+class LidarMeasurement(SensorData):
+    def __init__(self, frame, timestamp, transform, buffer, channels):
+        super(LidarMeasurement, self).__init__(frame, timestamp, transform)
+        self.channels = channels
+        self.horizontal_angle = 0.0
+        self.raw_data = memoryview(buffer).cast('B')
+
+    def __len__(self):
+        return len(self.raw_data) // 16
+
+    def save_to_disk(self, path):
+        points = np.frombuffer(self.raw_data, dtype=np.float32).reshape((-1, 4))
+        header = (f'ply\nformat ascii 1.0\nelement vertex {len(points)}\n'
+                  'property float32 x\nproperty float32 y\nproperty float32 z\nproperty float32 I\nend_header')
+        np.savetxt(path, points, fmt='%.4f', header=header, comments='')
+
+
+# ==============================================================================
+# -- synthetic sensor data -----------------------------------------------------
+# ==============================================================================
+
+
+def _synthetic_scene(width, height, fov):
+    """
+    Planar depth in metres and legacy semantic labels of a straight road seen
+    from 2.4 m, between two 20 m high building fronts 15 m to either side.
+    """
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float64)
+    focal = width / (2 * np.tan(fov * np.pi / 360))
+    u = (cols - width / 2) / focal
+    v = (rows - 0.45 * height) / focal
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ground = np.where(v > 0, 2.4 / v, np.inf)
+        wall = 15.0 / np.abs(u)
+        wall = np.where(2.4 - v * wall < 20.0, wall, np.inf)
+        lateral = np.abs(u * ground)
+    depth = np.minimum(np.minimum(ground, wall), 1000.0)
+
+    labels = np.zeros((height, width), dtype=np.uint8)      # sky / none
+    on_ground = ground <= np.minimum(wall, 1000.0)
+    labels[on_ground & (lateral < 4.0)] = 7                  # roads
+    labels[on_ground & (lateral >= 4.0)] = 8                 # sidewalks
+    labels[on_ground & (np.abs(lateral - 1.75) < 0.1)] = 6   # road lines
+    labels[~on_ground & (wall < 1000.0)] = 1                 # buildings
+    return depth, labels
+
+
+def _synthetic_buffers(type_id, attributes, variants, seed):
+    rng = np.random.default_rng(seed)
+    if type_id == 'sensor.lidar.ray_cast':
+        channels = int(attributes['channels'])
+        points = int(float(attributes['points_per_second']) / float(attributes['rotation_frequency']))
+        lidar_range = float(attributes['range'])
+        upper, lower = float(attributes['upper_fov']), float(attributes['lower_fov'])
+        buffers = []
+        for _ in range(variants):
+            azimuth = rng.uniform(-np.pi, np.pi, points)
+            elevation = np.radians(lower + (upper - lower) * rng.integers(0, channels, points) / max(channels - 1, 1))
+            distance = rng.uniform(1.0, lidar_range, points)
+            cloud = np.empty((points, 4), dtype=np.float32)
+            cloud[:, 0] = distance * np.cos(elevation) * np.cos(azimuth)
+            cloud[:, 1] = distance * np.cos(elevation) * np.sin(azimuth)
+            cloud[:, 2] = distance * np.sin(elevation)
+            cloud[:, 3] = np.exp(-0.004 * distance)
+            buffers.append(cloud)
+        return buffers
+
+    width, height = int(attributes['image_size_x']), int(attributes['image_size_y'])
+    depth, labels = _synthetic_scene(width, height, float(attributes['fov']))
+    buffers = []
+    for variant in range(variants):
+        # shift the scene sideways a little per variant so frames differ
+        shift = variant * max(width // 64, 1)
+        bgra = np.empty((height, width, 4), dtype=np.uint8)
+        if type_id == 'sensor.camera.depth':
+            code = np.round(np.roll(depth, shift, axis=1) / 1000.0 * (256.0 ** 3 - 1)).astype(np.uint32)
+            bgra[:, :, 0] = code >> 16
+            bgra[:, :, 1] = (code >> 8) & 255
+            bgra[:, :, 2] = code & 255
+        elif type_id == 'sensor.camera.semantic_segmentation':
+            bgra[:, :, :2] = 0
+            bgra[:, :, 2] = np.roll(labels, shift, axis=1)
+        else:
+            shade = (255.0 * np.exp(-np.roll(depth, shift, axis=1) / 200.0)).astype(np.uint8)
+            for channel in range(3):
+                bgra[:, :, channel] = shade // (channel + 1) + rng.integers(0, 32, (height, width), dtype=np.uint8)
+        bgra[:, :, 3] = 255
+        buffers.append(bgra)
+    return buffers
+
+
+def synthetic_images(type_id, width=1280, height=720, fov=120, variants=1, seed=0):
+    """
+    Return `variants` deterministic camera images of type_id, numbered as
+    frames 0, 1, ..., without spawning anything. Handy as test fixtures.
+    """
+    attributes = {'image_size_x': str(width), 'image_size_y': str(height), 'fov': str(fov)}
+    return [Image(frame, 0.0, Transform(), buffer, width, height, float(fov))
+            for frame, buffer in enumerate(_synthetic_buffers(type_id, attributes, variants, seed))]
+
+
+# ==============================================================================
+# -- world, map, client --------------------------------------------------------
+# ==============================================================================
+
+
+class Waypoint(object):
+    def __init__(self, transform, road_id=0, section_id=0, lane_id=0, s=0.0):
+        self.transform = transform
+        self.road_id = road_id
+        self.section_id = section_id
+        self.lane_id = lane_id
+        self.s = float(s)
+
+
+class Map(object):
+    def __init__(self, name, seed=0):
+        self.name = name if '/' in name else f'Carla/Maps/{name}'
+        rng = np.random.default_rng(sum(map(ord, self.name)) + seed)
+        # spawn points on a jittered grid; enough for the indices used by the scripts
+        self._spawn_points = [Transform(Location(float(x), float(y), 0.5), Rotation(yaw=float(yaw)))
+                              for x, y, yaw in zip(rng.uniform(-200, 200, 300),
+                                                   rng.uniform(-200, 200, 300),
+                                                   rng.choice([-90.0, 0.0, 90.0, 180.0], 300))]
+
+    def get_spawn_points(self):
+        return [Transform(Location(t.location.x, t.location.y, t.location.z),
+                          Rotation(t.rotation.pitch, t.rotation.yaw, t.rotation.roll))
+                for t in self._spawn_points]
+
+    def generate_waypoints(self, distance):
+        # one straight two-lane road along x through the origin
+        return [Waypoint(Transform(Location(s - 200.0, 1.75 * lane_id, 0.0),
+                                   Rotation(yaw=0.0 if lane_id > 0 else 180.0)),
+                         road_id=0, lane_id=lane_id, s=s)
+                for lane_id in (-1, 1) for s in np.arange(0.0, 400.0, distance)]
+
+    def __str__(self):
+        return f'Map(name={self.name})'
+
+
+class World(object):
+    def __init__(self, map_name):
+        self.id = next(_actor_ids)
+        self._map = Map(map_name, _config['seed'])
+        self._settings = WorldSettings()
+        self._weather = WeatherParameters()
+        self._frame = 0
+        self._elapsed_seconds = 0.0
+        self._actors = []
+        self._on_tick = {}
+        self._on_tick_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._delivery = queue.Queue()
+        threading.Thread(target=self._deliver, daemon=True).start()
+        self._spectator = Actor(self, 'spectator', Transform(Location(0, 0, 50), Rotation(pitch=-90)))
+        self._actors.append(self._spectator)
+        for i in range(12):
+            self._actors.append(TrafficLight(self, 'traffic.traffic_light',
+                                             Transform(Location(20.0 * i - 120.0, 10.0, 0.0))))
+
+    def get_map(self):
+        return self._map
+
+    def get_settings(self):
+        return WorldSettings(**vars(self._settings))
+
+    def apply_settings(self, settings):
+        self._settings = WorldSettings(**vars(settings))
+        return self._frame
+
+    def get_weather(self):
+        return WeatherParameters(**vars(self._weather))
+
+    def set_weather(self, weather):
+        self._weather = WeatherParameters(**vars(weather))
+
+    def get_blueprint_library(self):
+        return BlueprintLibrary()
+
+    def get_spectator(self):
+        return self._spectator
+
+    def get_actors(self, actor_ids=None):
+        with self._lock:
+            actors = list(self._actors)
+        if actor_ids is not None:
+            actors = [actor for actor in actors if actor.id in set(actor_ids)]
+        return actors
+
+    def get_actor(self, actor_id):
+        for actor in self.get_actors():
+            if actor.id == actor_id:
+                return actor
+        return None
+
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        attributes = {attribute.id: attribute.as_str() for attribute in blueprint}
+        if blueprint.id.startswith('vehicle.'):
+            cls = Vehicle
+        elif blueprint.id.startswith('sensor.'):
+            cls = Sensor
+        else:
+            cls = Actor
+        actor = cls(self, blueprint.id, transform, parent=attach_to, attributes=attributes)
+        with self._lock:
+            self._actors.append(actor)
+        return actor
+
+    def try_spawn_actor(self, blueprint, transform, attach_to=None):
+        return self.spawn_actor(blueprint, transform, attach_to)
+
+    def on_tick(self, callback):
+        callback_id = next(self._on_tick_ids)
+        self._on_tick[callback_id] = callback
+        return callback_id
+
+    def remove_on_tick(self, callback_id):
+        self._on_tick.pop(callback_id, None)
+
+    def get_snapshot(self):
+        return WorldSnapshot(self._frame, self._timestamp())
+
+    def wait_for_tick(self, seconds=10.0):
+        return self.get_snapshot()
+
+    def tick(self, seconds=10.0):
+        if _config['tick_latency']:
+            time.sleep(_config['tick_latency'])
+        delta = self._settings.fixed_delta_seconds or 0.05
+        self._frame += 1
+        self._elapsed_seconds += delta
+        for actor in self.get_actors():
+            if isinstance(actor, Vehicle):
+                actor._step(delta)
+
+        timestamp = self._timestamp()
+        deliveries = [(callback, WorldSnapshot(self._frame, timestamp)) for callback in self._on_tick.values()]
+        for actor in self.get_actors():
+            if isinstance(actor, Sensor) and actor.is_listening:
+                deliveries.append((actor._callback, actor._measure(self._frame, timestamp)))
+        self._delivery.put((time.monotonic() + _config['sensor_latency'], deliveries))
+        return self._frame
+
+    def _timestamp(self):
+        return Timestamp(self._frame, self._elapsed_seconds, self._settings.fixed_delta_seconds or 0.05)
+
+    def _deliver(self):
+        while True:
+            due, deliveries = self._delivery.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for callback, data in deliveries:
+                try:
+                    callback(data)
+                except Exception as e:
+                    print(f'fake_carla: sensor callback raised {e!r}')
+
+    def _remove(self, actor):
+        with self._lock:
+            if actor in self._actors:
+                self._actors.remove(actor)
+
+
+class Client(object):
+    _world = None
+
+    def __init__(self, host='127.0.0.1', port=2000, worker_threads=0):
+        self.host = host
+        self.port = port
+        self._timeout = 5.0
+        if Client._world is None:
+            Client._world = World('Town10HD_Opt')
+
+    def set_timeout(self, seconds):
+        self._timeout = seconds
+
+    def get_client_version(self):
+        return _VERSION
+
+    def get_server_version(self):
+        return _VERSION
+
+    def get_world(self):
+        return Client._world
+
+    def get_available_maps(self):
+        return [f'/Game/Carla/Maps/{name}' for name in ('Town01', 'Town02', 'Town03', 'Town10HD_Opt')]
+
+    def load_world(self, map_name, reset_settings=True):
+        Client._world = World(map_name.rsplit('/', 1)[-1])
+        return Client._world
+
+    def reload_world(self, reset_settings=True):
+        return self.load_world(Client._world.get_map().name, reset_settings)
+
+    def apply_batch(self, commands):
+        for cmd in commands:
+            actor = Client._world.get_actor(cmd.actor_id)
+            if actor is not None:
+                actor.destroy()
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        self.apply_batch(commands)
+        if do_tick:
+            Client._world.tick()
+        return []
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Run a capture script against the offline CARLA stand-in.')
+    argparser.add_argument('script', help='module name of the script, e.g. im_seq_roundabout')
+    argparser.add_argument('--tick-latency', type=float, default=0.0, help='seconds world.tick() blocks')
+    argparser.add_argument('--sensor-latency', type=float, default=0.0, help='seconds until sensor data arrives')
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+
+    install(tick_latency=args.tick_latency, sensor_latency=args.sensor_latency, seed=args.seed)
+    importlib.import_module(args.script).main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Fused per-tick processing of the synchronised RGB, depth and semantic
+segmentation camera images.
+
+The capture loops used to call the image_converter helpers one by one, which
+decoded the depth image twice and allocated a handful of float64 frames per
+tick. FrameProcessor decodes each sensor buffer once into preallocated buffers
+and derives every exported product from them. The results are identical to
+the ones produced by the image_converter / depth_treshold chain.
+"""
+
+import cv2 as cv
+import numpy as np
+
+import image_converter
+import depth_treshold
+
+# CARLA encodes depth as (R + G * 256 + B * 256 * 256) / (256 * 256 * 256 - 1)
+_DEPTH_CODES = 256 * 256 * 256
+_DEPTH_SCALE = _DEPTH_CODES - 1.0
+
+_log_depth_lut = None
+
+
+def _get_log_depth_lut():
+    """
+    Return the uint8 logarithmic grayscale value of every 24 bit depth code, as
+    depth_to_logarithmic_grayscale computes it and cv.imwrite rounds it.
+    """
+    global _log_depth_lut
+    if _log_depth_lut is None:
+        lut = np.empty(_DEPTH_CODES, dtype=np.uint8)
+        chunk = 1 << 20
+        with np.errstate(divide='ignore'):
+            for start in range(0, _DEPTH_CODES, chunk):
+                grayscale = np.arange(start, start + chunk, dtype=np.float64) / _DEPTH_SCALE
+                logdepth = np.ones(grayscale.shape) + (np.log(grayscale) / 5.70378)
+                logdepth = np.clip(logdepth, 0.0, 1.0)
+                logdepth *= 255.0
+                lut[start:start + chunk] = np.rint(logdepth)
+        lut.flags.writeable = False
+        _log_depth_lut = lut
+    return _log_depth_lut
+
+
+class FrameProcessor(object):
+    """
+    Turns the camera images of one tick into every exported product with a
+    single decode per sensor. The output buffers are allocated once and
+    overwritten on every call, so write or copy them before the next tick.
+
+        processor = FrameProcessor(im_width, im_height)
+        with CarlaSyncMode(world, *sensors) as sync_mode:
+            while True:
+                _, image, depth_as_rgb, semseg_raw = sync_mode.tick(timeout=2.0)
+                processor.process(image, depth_as_rgb, semseg_raw)
+                cv.imwrite('masked.png', processor.masked_rgb)
+
+    After process() the following attributes hold the current frame:
+        rgb            BGRA view of the RGB camera image
+        depth_16       uint16 depth, normalized to [0, 65535]
+        depth          float64 depth, normalized to [0.0, 255.0]
+        depth_log      uint8 logarithmic grayscale depth, three channels
+        depth_mask     uint8 depth mask from depth_treshold.create_mask
+        masked_rgb     BGRA image masked with depth_mask
+        semseg_labels  uint8 semantic segmentation labels
+        semseg         uint8 Cityscapes palette (RGB order)
+        semseg_masked  masked_rgb further masked with the semseg palette
+    """
+
+    def __init__(self, width, height, palette_version='legacy', create_mask=depth_treshold.create_mask):
+        self.width = width
+        self.height = height
+        self.create_mask = create_mask
+
+        palette_lut = image_converter.cityscapes_palette_lut(palette_version)
+        self._palette_lut = np.ascontiguousarray(palette_lut.reshape(256, 1, 3))
+        # the semseg mask keeps the pixels whose palette colour has no red component
+        self._semseg_keep_lut = np.where(palette_lut[:, 0] == 0, 255, 0).astype(np.uint8)
+        self._log_depth_lut = _get_log_depth_lut()
+
+        shape = (height, width)
+        self._code = np.empty(shape, dtype=np.uint32)
+        self._normalized = np.empty(shape, dtype=np.float64)
+        self._log_depth = np.empty(shape, dtype=np.uint8)
+        self._labels_3 = np.empty(shape + (3,), dtype=np.uint8)
+        self._semseg_keep = np.empty(shape, dtype=np.uint8)
+
+        self.rgb = None
+        self.depth_16 = np.empty(shape, dtype=np.uint16)
+        self.depth = np.empty(shape, dtype=np.float64)
+        self.depth_log = np.empty(shape + (3,), dtype=np.uint8)
+        self.depth_mask = None
+        self.masked_rgb = np.empty(shape + (4,), dtype=np.uint8)
+        self.semseg_labels = np.empty(shape, dtype=np.uint8)
+        self.semseg = np.empty(shape + (3,), dtype=np.uint8)
+        self.semseg_masked = np.empty(shape + (4,), dtype=np.uint8)
+
+    def process(self, image, depth_image, semseg_image):
+        """Process the CARLA images of one tick."""
+        return self.process_arrays(image_converter.to_bgra_array(image),
+                                   image_converter.to_bgra_array(depth_image),
+                                   image_converter.to_bgra_array(semseg_image))
+
+    def process_arrays(self, bgra, depth_bgra, semseg_bgra):
+        """Process the BGRA arrays of one tick."""
+        expected = (self.height, self.width, 4)
+        for array in (bgra, depth_bgra, semseg_bgra):
+            if array.shape != expected:
+                raise ValueError(f'expected an image of shape {expected}, got {array.shape}')
+
+        self.rgb = bgra
+
+        # depth code B * 256 * 256 + G * 256 + R: the little-endian BGRA word
+        # byte-swapped to RGBA and shifted past the alpha byte
+        code = self._code
+        np.copyto(code, depth_bgra.view(np.uint32)[:, :, 0])
+        code.byteswap(inplace=True)
+        code >>= 8
+
+        np.divide(code, _DEPTH_SCALE, out=self._normalized)
+        np.multiply(self._normalized, 65535, out=self.depth_16, casting='unsafe')
+        np.multiply(self._normalized, 255, out=self.depth)
+        np.take(self._log_depth_lut, code, out=self._log_depth, mode='clip')
+        cv.merge([self._log_depth] * 3, self.depth_log)
+
+        self.depth_mask = self.create_mask(self.depth)
+        self.masked_rgb.fill(0)
+        cv.bitwise_and(bgra, bgra, dst=self.masked_rgb, mask=self.depth_mask)
+
+        cv.extractChannel(semseg_bgra, 2, self.semseg_labels)
+        cv.merge([self.semseg_labels] * 3, self._labels_3)
+        cv.LUT(self._labels_3, self._palette_lut, self.semseg)
+        cv.LUT(self.semseg_labels, self._semseg_keep_lut, self._semseg_keep)
+        np.bitwise_and(self._semseg_keep, self.depth_mask, out=self._semseg_keep)
+        self.semseg_masked.fill(0)
+        cv.bitwise_and(bgra, bgra, dst=self.semseg_masked, mask=self._semseg_keep)
+        return self
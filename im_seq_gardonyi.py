@@ -14,9 +14,6 @@ import glob
 import os
 import sys
 from datetime import datetime
-import queue
-
-import numpy
 
 try:
     sys.path.append(glob.glob('/opt/carla-simulator/PythonAPI/carla/dist/carla-*%d.%d-%s.egg' % (
@@ -41,60 +38,9 @@ import time
 
 import image_converter
 import depth_treshold
-
-class CarlaSyncMode(object):
-    """
-    Context manager to synchronize output from different sensors. Synchronous
-    mode is enabled as long as we are inside this context
-
-        with CarlaSyncMode(world, sensors) as sync_mode:
-            while True:
-                data = sync_mode.tick(timeout=1.0)
-
-    """
-
-    def __init__(self, world, *sensors, **kwargs):
-        self.world = world
-        self.sensors = sensors
-        self.frame = None
-        self.delta_seconds = 1.0 / kwargs.get('fps', 20)
-        self.timestamp = datetime.now()
-        self._queues = []
-        self._settings = None
-
-    def __enter__(self):
-        self._settings = self.world.get_settings()
-        self.frame = self.world.apply_settings(carla.WorldSettings(
-                                                    no_rendering_mode=False,
-                                                    synchronous_mode=True,
-                                                    fixed_delta_seconds=self.delta_seconds,
-                                                                   )
-                                               )
-
-        def make_queue(register_event):
-            q = queue.Queue()
-            register_event(q.put)
-            self._queues.append(q)
-
-        make_queue(self.world.on_tick)
-        for sensor in self.sensors:
-            make_queue(sensor.listen)
-        return self
-
-    def tick(self, timeout):
-        self.frame = self.world.tick()
-        data = [self._retrieve_data(q, timeout) for q in self._queues]
-        assert all(x.frame == self.frame for x in data)
-        return data
-
-    def __exit__(self, *args, **kwargs):
-        self.world.apply_settings(self._settings)
-
-    def _retrieve_data(self, sensor_queue, timeout):
-        while True:
-            data = sensor_queue.get(timeout=timeout)
-            if data.frame == self.frame:
-                return data
+from carla_sync import CarlaSyncMode
+from map_cache import MapCache
+from pose_log import PoseLog
 
 
 def main():
@@ -128,6 +74,8 @@ def main():
 
         # retrieve world
         world = client.get_world()
+        # spawn points, blueprints and traffic lights, fetched once per map
+        maps = MapCache(client)
 
         """
         Setting up map and weather:
@@ -176,14 +124,15 @@ def main():
                 sensor_list = []
 
                 # Setting up and spawning vehicle
-                blueprint_library = world.get_blueprint_library()
-                bp = world.get_blueprint_library().find('vehicle.tesla.model3')
+                metadata = maps.get(world)
+                blueprint_library = maps.blueprints(world)
+                bp = blueprint_library.find('vehicle.tesla.model3')
 
                 if bp.has_attribute('color'):
                     color = random.choice(bp.get_attribute('color').recommended_values)
                     bp.set_attribute('color', color)
 
-                spawn_points = world.get_map().get_spawn_points()
+                spawn_points = metadata.spawn_points
                 vehicle = world.spawn_actor(bp, carla.Transform(location=carla.Location(x=-65.61803436279297,
                                                                                         y=39.20486831665039,
                                                                                         z=1,
@@ -247,9 +196,8 @@ def main():
                 os.makedirs(export_basepath)
 
                 # turn all traffic lights green
-                for actor in world.get_actors():
-                    if actor.type_id == "traffic.traffic_light":
-                        actor.set_state(carla.TrafficLightState.Green)
+                for actor in metadata.traffic_lights(world):
+                    actor.set_state(carla.TrafficLightState.Green)
 
                 # create directories for image export
                 # os.makedirs(f'{export_basepath}/masked_rgb/')
@@ -257,7 +205,7 @@ def main():
                 os.makedirs(f'{export_basepath}/rgb/')
                 os.makedirs(f'{export_basepath}/semseg/')
 
-                camera_positions = []
+                poses = PoseLog(capacity=len_run)
 
                 # instantiate CarlaSyncMode and start exporting images on ticks
                 # print(f"before instantiation: {world.get_settings().fixed_delta_seconds}")
@@ -314,18 +262,13 @@ def main():
 
                         cv.imwrite(f'{export_basepath}/semseg/{tick}.png', semseg_mask)
 
-                        camera_positions.append([camera.get_transform().location.x,
-                                                 camera.get_transform().location.y,
-                                                 camera.get_transform().location.z,
-                                                 camera.get_transform().rotation.roll,
-                                                 camera.get_transform().rotation.yaw,
-                                                 camera.get_transform().rotation.pitch,
-                                                 ])
+                        # camera pose of this frame, as delivered with the rgb image
+                        poses.append(tick, image)
 
                         tick += 1
 
                         if tick > len_run - 1:
-                            numpy.savetxt(fname=f'{export_basepath}/camera.txt', X=camera_positions)
+                            poses.save(export_basepath)
                             break
 
                 print('destroying actors')
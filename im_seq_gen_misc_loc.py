@@ -14,7 +14,6 @@ import glob
 import os
 import sys
 from datetime import datetime
-import queue
 
 import numpy
 
@@ -34,68 +33,16 @@ except IndexError:
         pass
 
 import carla
-import cv2 as cv
 import numpy as np
 
 import random
 import time
 
-import image_converter
-import depth_treshold
-
-
-class CarlaSyncMode(object):
-    """
-    Context manager to synchronize output from different sensors. Synchronous
-    mode is enabled as long as we are inside this context
-
-        with CarlaSyncMode(world, sensors) as sync_mode:
-            while True:
-                data = sync_mode.tick(timeout=1.0)
-
-    """
-
-    def __init__(self, world, *sensors, **kwargs):
-        self.world = world
-        self.sensors = sensors
-        self.frame = None
-        self.delta_seconds = 1.0 / kwargs.get('fps', 20)
-        self.timestamp = datetime.now()
-        self._queues = []
-        self._settings = None
-
-    def __enter__(self):
-        self._settings = self.world.get_settings()
-        self.frame = self.world.apply_settings(carla.WorldSettings(no_rendering_mode=False,
-                                                                   synchronous_mode=True,
-                                                                   fixed_delta_seconds=self.delta_seconds,
-                                                                   )
-                                               )
-
-        def make_queue(register_event):
-            q = queue.Queue()
-            register_event(q.put)
-            self._queues.append(q)
-
-        make_queue(self.world.on_tick)
-        for sensor in self.sensors:
-            make_queue(sensor.listen)
-        return self
-
-    def tick(self, timeout):
-        self.frame = self.world.tick()
-        data = [self._retrieve_data(q, timeout) for q in self._queues]
-        assert all(x.frame == self.frame for x in data)
-        return data
-
-    def __exit__(self, *args, **kwargs):
-        self.world.apply_settings(self._settings)
-
-    def _retrieve_data(self, sensor_queue, timeout):
-        while True:
-            data = sensor_queue.get(timeout=timeout)
-            if data.frame == self.frame:
-                return data
+from carla_sync import CarlaSyncMode
+from frame_processor import FrameProcessor
+from image_writer import ImageWriter
+from map_cache import MapCache
+from pose_log import PoseLog
 
 
 def main():
@@ -107,6 +54,12 @@ def main():
     im_width = 1280
     camera_fov = 120
 
+    # buffers for the per-tick image conversions, reused across runs
+    processor = FrameProcessor(im_width, im_height)
+
+    # PNG encoding and writing happens on background threads
+    writer = ImageWriter()
+
     # set up number of runs per spawn position
     num_runs = 4
 
@@ -129,6 +82,8 @@ def main():
 
         # retrieve world
         world = client.get_world()
+        # spawn points, blueprints and traffic lights, fetched once per map
+        maps = MapCache(client)
 
         """
         Setting up map and weather:
@@ -176,14 +131,15 @@ def main():
                 sensor_list = []
 
                 # Setting up and spawning vehicle
-                blueprint_library = world.get_blueprint_library()
-                bp = world.get_blueprint_library().find('vehicle.tesla.model3')
+                metadata = maps.get(world)
+                blueprint_library = maps.blueprints(world)
+                bp = blueprint_library.find('vehicle.tesla.model3')
 
                 if bp.has_attribute('color'):
                     color = random.choice(bp.get_attribute('color').recommended_values)
                     bp.set_attribute('color', color)
 
-                spawn_points = world.get_map().get_spawn_points()
+                spawn_points = metadata.spawn_points
                 vehicle = world.spawn_actor(bp, spawn_points[spawn_position])
 
                 actor_list.append(vehicle)
@@ -241,9 +197,8 @@ def main():
                 os.makedirs(export_basepath)
 
                 # turn all traffic lights green
-                for actor in world.get_actors():
-                    if actor.type_id == "traffic.traffic_light":
-                        actor.set_state(carla.TrafficLightState.Green)
+                for actor in metadata.traffic_lights(world):
+                    actor.set_state(carla.TrafficLightState.Green)
 
                 # create directories for image export
                 os.makedirs(f'{export_basepath}/masked_rgb/')
@@ -252,7 +207,7 @@ def main():
                 os.makedirs(f'{export_basepath}/semseg_masked/')
                 os.makedirs(f'{export_basepath}/semseg/')
 
-                camera_positions = []
+                poses = PoseLog(capacity=len_run)
 
                 # instantiate CarlaSyncMode and start exporting images on ticks
                 # print(f"before instantiation: {world.get_settings().fixed_delta_seconds}")
@@ -271,54 +226,32 @@ def main():
                             tick += 1
                             continue
 
-                        # mask image with depth
-                        depth = image_converter.depth_to_array(depth_as_rgb)
-                        depth *= 255
-                        depth_mask = depth_treshold.create_mask(depth)
-
-                        depth_mat = image_converter.to_bgra_array(image)
-                        masked_rgb = cv.bitwise_and(depth_mat, depth_mat, mask=depth_mask)
+                        # decode all sensors once and derive every exported image
+                        frame = processor.process(image, depth_as_rgb, semseg_raw)
 
                         # export images
                         # depth
-                        depth = image_converter.depth_to_logarithmic_grayscale(depth_as_rgb)
-                        cv.imwrite(f'{export_basepath}/depth/{tick}_depth.png', depth)
+                        writer.write(f'{export_basepath}/depth/{tick}_depth.png', frame.depth_log)
 
                         # depth masked
-                        cv.imwrite(f'{export_basepath}/masked_rgb/{tick}_masked.png', masked_rgb)
+                        writer.write(f'{export_basepath}/masked_rgb/{tick}_masked.png', frame.masked_rgb)
 
                         # rgb
                         image.save_to_disk(path=f'{export_basepath}/rgb/{tick}.png')
 
                         # semseg
-                        semseg_orig = image_converter.labels_to_cityscapes_palette(semseg_raw)
-                        semseg_mask = np.copy(semseg_orig)
-                        semseg_mask[semseg_mask == 0] = np.Inf
-                        semseg_mask[semseg_mask != np.Inf] = 0
-                        semseg_mask[semseg_mask == np.Inf] = 1
-                        semseg_mask_2 = np.stack((semseg_mask[:, :, 0],
-                                                  semseg_mask[:, :, 0],
-                                                  semseg_mask[:, :, 0],
-                                                  semseg_mask[:, :, 0]),
-                                                 axis=2,
-                                                 )
-
-                        final_masked_rgb = np.multiply(masked_rgb, semseg_mask_2)
-
-                        cv.imwrite(f'{export_basepath}/semseg_masked/{tick}_semseg_masked.png', final_masked_rgb)
-                        cv.imwrite(f'{export_basepath}/semseg/{tick}_semseg.png', semseg_orig)
-
-                        camera_positions.append([camera.get_transform().location.x,
-                                                 camera.get_transform().location.y,
-                                                 camera.get_transform().location.z,
-                                                 camera.get_transform().rotation.roll,
-                                                 camera.get_transform().rotation.yaw,
-                                                 camera.get_transform().rotation.pitch])
+                        writer.write(f'{export_basepath}/semseg_masked/{tick}_semseg_masked.png', frame.semseg_masked)
+                        writer.write(f'{export_basepath}/semseg/{tick}_semseg.png', frame.semseg)
+
+                        # camera pose of this frame, as delivered with the rgb image
+                        poses.append(tick, image)
 
                         tick += 1
 
                         if tick > len_run - 1:
-                            np.savetxt(fname=f'{export_basepath}/camera.txt', X=camera_positions)
+                            # wait for the images of this run before closing it
+                            writer.flush()
+                            poses.save(export_basepath)
                             break
 
                 print('destroying actors')
@@ -332,6 +265,7 @@ def main():
         print(e)
 
     finally:
+        writer.close()
         elapsed_time = datetime.now() - synchronizer.timestamp
         print(f"Done. Total time elapsed: {elapsed_time}")
 
@@ -14,7 +14,6 @@ import glob
 import os
 import sys
 from datetime import datetime
-import queue
 
 try:
     sys.path.append(glob.glob('/opt/carla-simulator/PythonAPI/carla/dist/carla-*%d.%d-%s.egg' % (
@@ -32,68 +31,17 @@ except IndexError:
         pass
 
 import carla
-import cv2 as cv
 import numpy as np
 
 import random
 import time
 
-import image_converter
-import depth_treshold
-
-
-class CarlaSyncMode(object):
-    """
-    Context manager to synchronize output from different sensors. Synchronous
-    mode is enabled as long as we are inside this context
-
-        with CarlaSyncMode(world, sensors) as sync_mode:
-            while True:
-                data = sync_mode.tick(timeout=1.0)
-
-    """
-
-    def __init__(self, world, *sensors, **kwargs):
-        self.world = world
-        self.sensors = sensors
-        self.frame = None
-        self.delta_seconds = 1.0 / kwargs.get('fps', 20)
-        self.timestamp = datetime.now()
-        self._queues = []
-        self._settings = None
-
-    def __enter__(self):
-        self._settings = self.world.get_settings()
-        self.frame = self.world.apply_settings(carla.WorldSettings(no_rendering_mode=False,
-                                                                   synchronous_mode=True,
-                                                                   fixed_delta_seconds=self.delta_seconds,
-                                                                   )
-                                               )
-
-        def make_queue(register_event):
-            q = queue.Queue()
-            register_event(q.put)
-            self._queues.append(q)
-
-        make_queue(self.world.on_tick)
-        for sensor in self.sensors:
-            make_queue(sensor.listen)
-        return self
-
-    def tick(self, timeout):
-        self.frame = self.world.tick()
-        data = [self._retrieve_data(q, timeout) for q in self._queues]
-        assert all(x.frame == self.frame for x in data)
-        return data
-
-    def __exit__(self, *args, **kwargs):
-        self.world.apply_settings(self._settings)
-
-    def _retrieve_data(self, sensor_queue, timeout):
-        while True:
-            data = sensor_queue.get(timeout=timeout)
-            if data.frame == self.frame:
-                return data
+from carla_sync import CarlaSyncMode
+from frame_processor import FrameProcessor
+from image_writer import ImageWriter
+from map_cache import MapCache
+from pose_log import PoseLog
+from sequence_store import SequenceWriter
 
 
 def main():
@@ -105,6 +53,18 @@ def main():
     im_width = 1280
     camera_fov = 120
 
+    # buffers for the per-tick image conversions, reused across runs
+    processor = FrameProcessor(im_width, im_height)
+
+    # PNG encoding and writing happens on background threads
+    writer = ImageWriter()
+
+    # "png" writes one image per stream and tick, "store" writes one
+    # memory-mapped sequence_store per run (see sequence_store.py), "raw" only
+    # dumps the sensor buffers into a store and leaves every conversion to
+    # a later offline pass
+    export_format = "png"
+
     # set up number of runs per spawn position
     num_runs = 6
 
@@ -127,6 +87,8 @@ def main():
 
         # retrieve world
         world = client.get_world()
+        # spawn points, blueprints and traffic lights, fetched once per map
+        maps = MapCache(client)
 
         """
         Setting up map and weather:
@@ -221,14 +183,15 @@ def main():
                 sensor_list = []
 
                 # Setting up and spawning vehicle
-                blueprint_library = world.get_blueprint_library()
-                bp = world.get_blueprint_library().find('vehicle.tesla.model3')
+                metadata = maps.get(world)
+                blueprint_library = maps.blueprints(world)
+                bp = blueprint_library.find('vehicle.tesla.model3')
 
                 if bp.has_attribute('color'):
                     color = random.choice(bp.get_attribute('color').recommended_values)
                     bp.set_attribute('color', color)
 
-                spawn_points = world.get_map().get_spawn_points()
+                spawn_points = metadata.spawn_points
                 vehicle = world.spawn_actor(bp, spawn_points[spawn_position])
 
                 actor_list.append(vehicle)
@@ -286,96 +249,115 @@ def main():
                 os.makedirs(export_basepath)
 
                 # turn all traffic lights green
-                for actor in world.get_actors():
-                    if actor.type_id == "traffic.traffic_light":
-                        actor.set_state(carla.TrafficLightState.Green)
-
-                # create directories for image export
-                os.makedirs(f'{export_basepath}/masked_rgb/')
-                os.makedirs(f'{export_basepath}/depth')
-                os.makedirs(f'{export_basepath}/depth_16')
-                os.makedirs(f'{export_basepath}/rgb/')
-                os.makedirs(f'{export_basepath}/semseg_masked/')
-                os.makedirs(f'{export_basepath}/semseg/')
-
-                camera_positions = []
+                for actor in metadata.traffic_lights(world):
+                    actor.set_state(carla.TrafficLightState.Green)
+
+                recording_start = 100 if spawn_position == 257 else 50
+
+                store = None
+                if export_format == "raw":
+                    # BGRA as delivered by the sensors, with the frame id, timestamp
+                    # and transform of the rgb measurement
+                    store = SequenceWriter(f'{export_basepath}/raw', {
+                        'rgb_raw': ((im_height, im_width, 4), 'uint8'),
+                        'depth_raw': ((im_height, im_width, 4), 'uint8'),
+                        'semseg_raw': ((im_height, im_width, 4), 'uint8'),
+                        'carla_frame': ((), 'int64'),
+                        'timestamp': ((), 'float64'),
+                    }, capacity=len_run - recording_start)
+                elif export_format == "store":
+                    # the masked images can be rebuilt from rgb, depth_mask and semseg
+                    store = SequenceWriter(f'{export_basepath}/store', {
+                        'rgb': ((im_height, im_width, 4), 'uint8'),
+                        'depth_16': ((im_height, im_width), 'uint16'),
+                        'semseg': ((im_height, im_width), 'uint8'),
+                        'depth_mask': ((im_height, im_width), 'uint8'),
+                    }, capacity=len_run - recording_start)
+                else:
+                    # create directories for image export
+                    os.makedirs(f'{export_basepath}/masked_rgb/')
+                    os.makedirs(f'{export_basepath}/depth')
+                    os.makedirs(f'{export_basepath}/depth_16')
+                    os.makedirs(f'{export_basepath}/rgb/')
+                    os.makedirs(f'{export_basepath}/semseg_masked/')
+                    os.makedirs(f'{export_basepath}/semseg/')
+
+                poses = PoseLog(capacity=len_run - recording_start)
 
                 # instantiate CarlaSyncMode and start exporting images on ticks
                 # print(f"before instantiation: {world.get_settings().fixed_delta_seconds}")
-                with CarlaSyncMode(world, *sensor_list, fps=30) as synchronizer:
-                    tick = 0
-                    # print(f"after instantiation: {world.get_settings().fixed_delta_seconds}")
-
-                    # print focal length to focal.txt
-                    focal = im_width / (2 * np.tan(camera_fov * np.pi / 360))
-                    np.savetxt(fname=f'{export_basepath}/focal.txt', X=np.array([focal]))
-
-                    recording_start = 100 if spawn_position == 257 else 50
+                # nothing in the loop reads the world state, so the next tick can
+                # already run while this one is processed
+                try:
+                    with CarlaSyncMode(world, *sensor_list, fps=30, pipelined=True) as synchronizer:
+                        tick = 0
+                        # print(f"after instantiation: {world.get_settings().fixed_delta_seconds}")
+
+                        # print focal length to focal.txt
+                        focal = im_width / (2 * np.tan(camera_fov * np.pi / 360))
+                        np.savetxt(fname=f'{export_basepath}/focal.txt', X=np.array([focal]))
+
+                        while True:
+                            _, image, depth_as_rgb, semseg_raw = synchronizer.tick(timeout=2.0)
+
+                            if tick < recording_start:
+                                tick += 1
+                                continue
+
+                            # camera pose of this frame, as delivered with the rgb image
+                            pose = poses.append(tick, image)
+
+                            if export_format == "raw":
+                                # copy the buffers as they are, views only until then
+                                store.append(tick, pose,
+                                             rgb_raw=np.frombuffer(image.raw_data, dtype=np.uint8)
+                                             .reshape((im_height, im_width, 4)),
+                                             depth_raw=np.frombuffer(depth_as_rgb.raw_data, dtype=np.uint8)
+                                             .reshape((im_height, im_width, 4)),
+                                             semseg_raw=np.frombuffer(semseg_raw.raw_data, dtype=np.uint8)
+                                             .reshape((im_height, im_width, 4)),
+                                             carla_frame=image.frame,
+                                             timestamp=image.timestamp)
+                            else:
+                                # decode all sensors once and derive every exported image
+                                frame = processor.process(image, depth_as_rgb, semseg_raw)
+
+                                if store is not None:
+                                    store.append(tick, pose,
+                                                 rgb=frame.rgb,
+                                                 depth_16=frame.depth_16,
+                                                 semseg=frame.semseg_labels,
+                                                 depth_mask=frame.depth_mask)
+                                else:
+                                    # export images
+                                    # 16 bit depth
+                                    writer.write(f'{export_basepath}/depth_16/{tick}_depth.png', frame.depth_16)
+
+                                    # depth
+                                    writer.write(f'{export_basepath}/depth/{tick}_depth.png', frame.depth_log)
+
+                                    # depth masked
+                                    writer.write(f'{export_basepath}/masked_rgb/{tick}_masked.png', frame.masked_rgb)
+
+                                    # color image
+                                    writer.write(f'{export_basepath}/rgb/{tick}.png', frame.rgb)
+
+                                    # semseg
+                                    writer.write(f'{export_basepath}/semseg_masked/{tick}_semseg_masked.png',
+                                                 frame.semseg_masked)
+                                    writer.write(f'{export_basepath}/semseg/{tick}_semseg.png', frame.semseg)
 
-                    while True:
-                        _, image, depth_as_rgb, semseg_raw = synchronizer.tick(timeout=2.0)
-
-                        if tick < recording_start:
                             tick += 1
-                            continue
-
-                        # get image depth
-                        depth = image_converter.depth_to_array(depth_as_rgb)
-                        depth_sixteen = depth * 65535
-                        depth_sixteen = depth_sixteen.astype(np.uint16)
-                        # write 16 bit depth
-                        cv.imwrite(f'{export_basepath}/depth_16/{tick}_depth.png', depth_sixteen)
-
-                        depth *= 255    # 8 bit conversion
-
-                        # mask with image depth
-                        depth_mask = depth_treshold.create_mask(depth)
-
-                        depth_mat = image_converter.to_bgra_array(image)
-                        masked_rgb = cv.bitwise_and(depth_mat, depth_mat, mask=depth_mask)
-
-                        # export images
-                        # depth
-                        depth = image_converter.depth_to_logarithmic_grayscale(depth_as_rgb)
-                        cv.imwrite(f'{export_basepath}/depth/{tick}_depth.png', depth)
-
-                        # depth masked
-                        cv.imwrite(f'{export_basepath}/masked_rgb/{tick}_masked.png', masked_rgb)
-
-                        # color image
-                        bgr = image_converter.to_bgra_array(image)
-                        cv.imwrite(f'{export_basepath}/rgb/{tick}.png', bgr)
-
-                        # semseg
-                        semseg_orig = image_converter.labels_to_cityscapes_palette(semseg_raw)
-                        semseg_mask = np.copy(semseg_orig)
-                        semseg_mask[semseg_mask == 0] = np.Inf
-                        semseg_mask[semseg_mask != np.Inf] = 0
-                        semseg_mask[semseg_mask == np.Inf] = 1
-                        semseg_mask_2 = np.stack((semseg_mask[:, :, 0],
-                                                  semseg_mask[:, :, 0],
-                                                  semseg_mask[:, :, 0],
-                                                  semseg_mask[:, :, 0]),
-                                                 axis=2,
-                                                 )
-
-                        final_masked_rgb = np.multiply(masked_rgb, semseg_mask_2)
-
-                        cv.imwrite(f'{export_basepath}/semseg_masked/{tick}_semseg_masked.png', final_masked_rgb)
-                        cv.imwrite(f'{export_basepath}/semseg/{tick}_semseg.png', semseg_orig)
-
-                        camera_positions.append([camera.get_transform().location.x,
-                                                 camera.get_transform().location.y,
-                                                 camera.get_transform().location.z,
-                                                 camera.get_transform().rotation.roll,
-                                                 camera.get_transform().rotation.yaw,
-                                                 camera.get_transform().rotation.pitch])
-
-                        tick += 1
-
-                        if tick > len_run - 1:
-                            np.savetxt(fname=f'{export_basepath}/camera.txt', X=camera_positions)
-                            break
+
+                            if tick > len_run - 1:
+                                # wait for the images of this run before closing it
+                                writer.flush()
+                                poses.save(export_basepath)
+                                break
+                finally:
+                    # a failed run keeps the frames it captured
+                    if store is not None:
+                        store.close()
 
                 print('destroying actors')
                 camera.destroy()
@@ -388,6 +370,7 @@ def main():
         print(e)
 
     finally:
+        writer.close()
         elapsed_time = datetime.now() - start_time
         print(f"Done. Total time elapsed: {elapsed_time}")
 
@@ -44,12 +44,11 @@ def labels_to_array(image):
     return to_bgra_array(image)[:, :, 2]
 
 
-def labels_to_cityscapes_palette(image):
-    """
-    Convert an image containing CARLA semantic segmentation labels to
-    Cityscapes palette.
-    """
-    classes = {
+# Cityscapes colours (RGB) of the CARLA semantic tags, per CARLA release.
+# "legacy" is the 13-class table this module has always used and stays the
+# default so that existing sequences keep their colours.
+CITYSCAPES_CLASSES = {
+    'legacy': {
         0: [0, 0, 0],        # None
         1: [70, 70, 70],     # Buildings
         2: [190, 153, 153],  # Fences
@@ -63,12 +62,106 @@ def labels_to_cityscapes_palette(image):
         10: [0, 0, 255],     # Vehicles
         11: [102, 102, 156], # Walls
         12: [220, 220, 0]    # TrafficSigns
+    },
+    '0.9.13': {
+        0: [0, 0, 0],        # Unlabeled
+        1: [70, 70, 70],     # Building
+        2: [100, 40, 40],    # Fence
+        3: [55, 90, 80],     # Other
+        4: [220, 20, 60],    # Pedestrian
+        5: [153, 153, 153],  # Pole
+        6: [157, 234, 50],   # RoadLine
+        7: [128, 64, 128],   # Road
+        8: [244, 35, 232],   # SideWalk
+        9: [107, 142, 35],   # Vegetation
+        10: [0, 0, 142],     # Vehicles
+        11: [102, 102, 156], # Wall
+        12: [220, 220, 0],   # TrafficSign
+        13: [70, 130, 180],  # Sky
+        14: [81, 0, 81],     # Ground
+        15: [150, 100, 100], # Bridge
+        16: [230, 150, 140], # RailTrack
+        17: [180, 165, 180], # GuardRail
+        18: [250, 170, 30],  # TrafficLight
+        19: [110, 190, 160], # Static
+        20: [170, 120, 50],  # Dynamic
+        21: [45, 60, 150],   # Water
+        22: [145, 170, 100]  # Terrain
+    },
+    '0.9.14': {
+        0: [0, 0, 0],        # Unlabeled
+        1: [128, 64, 128],   # Roads
+        2: [244, 35, 232],   # SideWalks
+        3: [70, 70, 70],     # Building
+        4: [102, 102, 156],  # Wall
+        5: [190, 153, 153],  # Fence
+        6: [153, 153, 153],  # Pole
+        7: [250, 170, 30],   # TrafficLight
+        8: [220, 220, 0],    # TrafficSign
+        9: [107, 142, 35],   # Vegetation
+        10: [152, 251, 152], # Terrain
+        11: [70, 130, 180],  # Sky
+        12: [220, 20, 60],   # Pedestrian
+        13: [255, 0, 0],     # Rider
+        14: [0, 0, 142],     # Car
+        15: [0, 0, 70],      # Truck
+        16: [0, 60, 100],    # Bus
+        17: [0, 80, 100],    # Train
+        18: [0, 0, 230],     # Motorcycle
+        19: [119, 11, 32],   # Bicycle
+        20: [110, 190, 160], # Static
+        21: [170, 120, 50],  # Dynamic
+        22: [55, 90, 80],    # Other
+        23: [45, 60, 150],   # Water
+        24: [157, 234, 50],  # RoadLine
+        25: [81, 0, 81],     # Ground
+        26: [150, 100, 100], # Bridge
+        27: [230, 150, 140], # RailTrack
+        28: [180, 165, 180]  # GuardRail
     }
-    array = labels_to_array(image)
-    result = numpy.zeros((array.shape[0], array.shape[1], 3))
-    for key, value in classes.items():
-        result[numpy.where(array == key)] = value
-    return result
+}
+
+_palette_luts = {}
+
+
+def cityscapes_palette_lut(version='legacy'):
+    """
+    Return a read-only (256, 3) uint8 lookup table mapping every possible label
+    code to its Cityscapes colour. Codes missing from the class table map to
+    black.
+    """
+    lut = _palette_luts.get(version)
+    if lut is None:
+        if version not in CITYSCAPES_CLASSES:
+            raise ValueError('unknown CARLA version %r, expected one of %s'
+                             % (version, ', '.join(CITYSCAPES_CLASSES)))
+        lut = numpy.zeros((256, 3), dtype=numpy.uint8)
+        for key, value in CITYSCAPES_CLASSES[version].items():
+            lut[key] = value
+        lut.flags.writeable = False
+        _palette_luts[version] = lut
+    return lut
+
+
+def labels_array_to_cityscapes_palette(labels, version='legacy', out=None):
+    """
+    Convert an uint8 array of CARLA semantic segmentation labels of any shape,
+    e.g. a single (H, W) frame or a (N, H, W) stack of frames, to a
+    (..., 3) uint8 array in Cityscapes palette with a single table lookup.
+    """
+    labels = numpy.asarray(labels)
+    if labels.dtype != numpy.uint8:
+        raise TypeError('labels must be uint8, got %s' % labels.dtype)
+    return numpy.take(cityscapes_palette_lut(version), labels, axis=0, out=out,
+                      mode='clip')
+
+
+def labels_to_cityscapes_palette(image, version='legacy'):
+    """
+    Convert an image containing CARLA semantic segmentation labels to
+    Cityscapes palette.
+    """
+    return labels_array_to_cityscapes_palette(labels_to_array(image), version)
 
 
 def depth_to_array(image):
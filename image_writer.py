@@ -0,0 +1,99 @@
+"""
+Background PNG export for the capture loops.
+
+cv.imwrite spends most of its time in zlib, which releases the GIL, so a few
+worker threads keep the encoding off the thread that ticks the simulator
+without the cost of shipping frames to other processes.
+"""
+
+import os
+import queue
+import threading
+
+import cv2 as cv
+import numpy as np
+
+
+class ImageWriter(object):
+    """
+    Pool of worker threads writing images with cv.imwrite. write() blocks once
+    max_pending images are waiting, so a slow disk throttles the capture loop
+    instead of filling the memory. Errors raised by the workers are re-raised
+    by the next write(), flush() or close() call.
+
+        with ImageWriter() as writer:
+            while True:
+                ...
+                writer.write(f'{export_basepath}/rgb/{tick}.png', bgr)
+            writer.flush()
+            poses.save(export_basepath)
+    """
+
+    def __init__(self, num_workers=None, max_pending=24):
+        if num_workers is None:
+            num_workers = min(6, os.cpu_count() or 1)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._lock = threading.Lock()
+        self._workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def write(self, path, image, copy=True):
+        """
+        Queue image to be written to path. The image is copied unless copy is
+        False, so reused buffers can be overwritten as soon as this returns.
+        """
+        self._raise_error()
+        if not self._workers:
+            raise RuntimeError('ImageWriter is closed')
+        if copy:
+            image = np.array(image, copy=True)
+        self._queue.put((path, image))
+
+    def flush(self):
+        """Wait until every queued image is written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Flush the queue and stop the workers."""
+        try:
+            self._queue.join()
+        finally:
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._workers = []
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, image = item
+                if not cv.imwrite(path, image):
+                    raise IOError(f'could not write {path}')
+            except Exception as e:
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
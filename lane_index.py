@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Snaps poses to the nearest lane of an OpenDRIVE map, without CARLA.
+
+The centrelines of the map's lanes are sampled every spacing metres with
+opendrive.OpenDriveMap and put into a spawn_index.SpawnPointIndex (a KD-tree)
+in CARLA coordinates; every lane section also gets a sample at its end. A
+batch of (x, y[, yaw]) queries is answered with one tree query for a few
+candidate samples each, which are refined to the closest point of the lane
+segments on either side of them, so the snapped position does not depend on
+the spacing. With yaws and yaw_weight, lanes heading the other
+way count as 2 * yaw_weight metres further away, so a pose on a two-way road
+snaps to the lane it is driving in.
+
+    lanes = LaneIndex.load('opendrive_maps/gardonyiter/gardonyiter.xodr')
+    snapped = lanes.snap(np.array([[-65.6, 39.2]]), yaws=[-50.0])   # SNAP_DTYPE
+    transform = pose_to_transform(snapped['pose'][0])                  # map_cache.pose_to_transform
+
+    python lane_index.py opendrive_maps/gardonyiter/gardonyiter.xodr --query -65.6 39.2 -50
+    python lane_index.py <map>.xodr --locations locations_to_spawn --output _out/snapped.txt
+"""
+
+import argparse
+import re
+import time
+
+import numpy as np
+
+from opendrive import OpenDriveMap, carla_poses
+from spawn_index import SpawnPointIndex, locations_array
+
+SNAP_DTYPE = np.dtype([
+    ('road_id', np.int32),
+    ('section', np.int32),
+    ('lane_id', np.int16),
+    ('s', np.float32),
+    # x, y, z, roll, yaw, pitch in CARLA coordinates, yaw along the lane
+    ('pose', np.float32, (6,)),
+    ('distance', np.float32),
+    # query yaw minus lane yaw in degrees, nan without yaws
+    ('yaw_error', np.float32),
+])
+
+_NUMBER = r'[-+0-9.eE]+'
+_LOCATION = re.compile(rf'\(x,\s*y,\s*z\)\s*=\s*\(({_NUMBER}),\s*({_NUMBER}),\s*({_NUMBER})\)')
+_ROTATION = re.compile(rf'\(pitch,\s*yaw,\s*roll\)\s*=\s*\(({_NUMBER}),\s*({_NUMBER}),\s*({_NUMBER})\)')
+
+
+def read_locations(path):
+    """(N, 6) x, y, z, roll, yaw, pitch of a spectator log like locations_to_spawn."""
+    with open(path) as f:
+        text = f.read()
+    locations = [tuple(map(float, match)) for match in _LOCATION.findall(text)]
+    rotations = [tuple(map(float, match)) for match in _ROTATION.findall(text)]
+    if len(locations) != len(rotations):
+        raise ValueError(f'{path}: {len(locations)} locations but {len(rotations)} rotations')
+    return np.array([(x, y, z, roll, yaw, pitch) for (x, y, z), (pitch, yaw, roll) in zip(locations, rotations)],
+                    dtype=np.float64).reshape((-1, 6))
+
+
+def _wrap_degrees(angles):
+    return (angles + 180.0) % 360.0 - 180.0
+
+
+class LaneIndex(object):
+    """Nearest lane queries over the centreline samples of an OpenDriveMap."""
+
+    def __init__(self, xodr, spacing=0.5, lane_types=('driving',), junctions=True, yaw_weight=2.0):
+        samples = xodr.lane_centrelines(spacing, lane_types, junctions, ends=True)
+        # consecutive samples of a lane next to each other
+        samples = samples[np.lexsort((samples['s'], samples['lane_id'], samples['section']))]
+        self.samples = samples
+        self.poses = carla_poses(samples)
+        self.yaw_weight = yaw_weight
+        self._index = SpawnPointIndex(self.poses)
+
+        same_lane = (samples['section'][1:] == samples['section'][:-1]) & \
+                    (samples['lane_id'][1:] == samples['lane_id'][:-1])
+        positions = np.arange(len(samples))
+        self._previous = positions.copy()
+        self._previous[1:][same_lane] = positions[:-1][same_lane]
+        self._next = positions.copy()
+        self._next[:-1][same_lane] = positions[1:][same_lane]
+
+    def __len__(self):
+        return len(self.samples)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Index of the lanes of an .xodr file; kwargs as for LaneIndex()."""
+        return cls(OpenDriveMap.load(path), **kwargs)
+
+    def snap(self, locations, yaws=None, yaw_weight=None, candidates=4):
+        """
+        SNAP_DTYPE record of the nearest lane point of every location (an
+        (M, 2+) array of CARLA x, y[, z] or carla.Location / carla.Transform
+        objects). yaws (degrees, default those of transforms) prefer lanes
+        heading the same way, weighted by yaw_weight (default the index's).
+        The candidates nearest samples are refined to the segments around them.
+        """
+        positions, transform_yaws = locations_array(locations)
+        if yaws is None:
+            yaws = transform_yaws
+        else:
+            yaws = np.asarray(yaws, dtype=np.float64).reshape(-1)
+        weight = (self.yaw_weight if yaw_weight is None else yaw_weight) if yaws is not None else 0.0
+        snapped = np.empty(len(positions), dtype=SNAP_DTYPE)
+        if len(positions) == 0:
+            return snapped
+        candidates = min(candidates, len(self.samples))
+        nearest = self._index.query(positions, candidates, 2, yaws, weight)[1].reshape((len(positions), candidates))
+
+        # every candidate moves to the closer of the segments to its previous and next sample
+        query = np.repeat(positions[:, :2], candidates, axis=0)
+        nearest = nearest.reshape(-1)
+        best = None
+        for neighbour in (self._previous[nearest], self._next[nearest]):
+            start = self.poses[nearest, :2].astype(np.float64)
+            step = self.poses[neighbour, :2] - start
+            lengths = np.einsum('ij,ij->i', step, step)
+            t = np.divide(np.einsum('ij,ij->i', query - start, step), lengths, out=np.zeros(len(query)),
+                          where=lengths > 0)
+            t = np.clip(t, 0.0, 1.0)
+            distances = np.linalg.norm(query - (start + t[:, None] * step), axis=1)
+            if best is None:
+                best = (distances, neighbour, t)
+            else:
+                closer = distances < best[0]
+                best = tuple(np.where(closer, new, old) for new, old in zip((distances, neighbour, t), best))
+        distances, neighbour, t = best
+
+        first, second = self.poses[nearest], self.poses[neighbour]
+        pose = first + t[:, None] * (second - first)
+        pose[:, 4] = _wrap_degrees(first[:, 4] + t * _wrap_degrees(second[:, 4] - first[:, 4]))
+        # the candidate with the least distance and heading cost
+        cost = np.square(distances)
+        if weight:
+            turn = np.radians(np.repeat(yaws, candidates) - pose[:, 4])
+            cost += np.square(2 * weight * np.sin(turn / 2))
+        chosen = np.arange(len(positions)) * candidates + np.argmin(cost.reshape((-1, candidates)), axis=1)
+        nearest, neighbour, t, pose = nearest[chosen], neighbour[chosen], t[chosen], pose[chosen]
+
+        samples = self.samples
+        snapped['road_id'] = samples['road_id'][nearest]
+        snapped['section'] = samples['section'][nearest]
+        snapped['lane_id'] = samples['lane_id'][nearest]
+        snapped['s'] = samples['s'][nearest] + t * (samples['s'][neighbour] - samples['s'][nearest])
+        snapped['pose'] = pose
+        snapped['distance'] = distances[chosen]
+        snapped['yaw_error'] = np.nan if yaws is None else _wrap_degrees(yaws - pose[:, 4])
+        return snapped
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('xodr', help='OpenDRIVE file, e.g. opendrive_maps/gardonyiter/gardonyiter.xodr')
+    argparser.add_argument('--locations', default=None, help='spectator log in the format of locations_to_spawn')
+    argparser.add_argument('--poses', default=None, help='text file of x y z roll yaw pitch rows, like camera.txt')
+    argparser.add_argument('--query', type=float, nargs='+', action='append', default=[], metavar='X Y [YAW]',
+                           help='a CARLA x, y and optional yaw to snap; may be repeated')
+    argparser.add_argument('--spacing', type=float, default=0.5, help='metres between lane samples')
+    argparser.add_argument('--yaw-weight', type=float, default=2.0, help='metres a reversed heading adds / 2')
+    argparser.add_argument('--output', default=None, help='write the snapped x y z roll yaw pitch rows here')
+    args = argparser.parse_args()
+
+    poses = []
+    if args.locations:
+        poses.append(read_locations(args.locations))
+    if args.poses:
+        poses.append(np.loadtxt(args.poses, ndmin=2)[:, :6])
+    for query in args.query:
+        if len(query) not in (2, 3):
+            argparser.error('--query takes X Y [YAW]')
+        poses.append(np.array([[query[0], query[1], 0.0, 0.0, query[2] if len(query) == 3 else np.nan, 0.0]]))
+    if not poses:
+        argparser.error('nothing to snap: give --locations, --poses or --query')
+    poses = np.concatenate(poses)
+
+    start = time.perf_counter()
+    lanes = LaneIndex.load(args.xodr, spacing=args.spacing, yaw_weight=args.yaw_weight)
+    built = time.perf_counter()
+    # queries without a yaw are snapped by distance alone
+    has_yaw = ~np.isnan(poses[:, 4])
+    snapped = np.empty(len(poses), dtype=SNAP_DTYPE)
+    snapped[has_yaw] = lanes.snap(poses[has_yaw, :3], poses[has_yaw, 4])
+    snapped[~has_yaw] = lanes.snap(poses[~has_yaw, :3])
+    done = time.perf_counter()
+
+    print(f'{len(lanes)} lane samples indexed in {1000 * (built - start):.1f} ms, '
+          f'{len(poses)} poses snapped in {1000 * (done - built):.1f} ms')
+    for query, match in zip(poses, snapped):
+        x, y, z, _, yaw, _ = match['pose']
+        print(f"({query[0]:.2f}, {query[1]:.2f}) -> road {match['road_id']} lane {match['lane_id']} "
+              f"s {match['s']:.2f}: ({x:.2f}, {y:.2f}, {z:.2f}) yaw {yaw:.1f}, "
+              f"{match['distance']:.2f} m away, yaw error {match['yaw_error']:.1f}")
+    if args.output:
+        np.savetxt(args.output, snapped['pose'])
+        print(f'written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
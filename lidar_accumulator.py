@@ -0,0 +1,250 @@
+"""
+Accumulates LiDAR sweeps in memory, in world coordinates.
+
+Each sweep's raw_data is read as an (N, 4) float32 view of x, y, z and
+intensity and transformed with the sensor transform of the measurement in
+one matrix product. LidarAccumulator keeps every point in a preallocated
+buffer that doubles when it fills up; VoxelAccumulator merges the points
+into voxels as they arrive, so its memory follows the occupied volume
+instead of the recording length. The merged cloud is written once at the end:
+
+    accumulator = LidarAccumulator()          # or VoxelAccumulator(0.05)
+    with CarlaSyncMode(world, lidar) as sync:
+        for i in range(number_of_records):
+            accumulator.add(sync.tick(timeout=2.0)[1])
+    accumulator.write('_out/pointcloud.pcd')
+
+CARLA coordinates are left-handed; like the previous export, the written
+clouds have y negated.
+"""
+
+import numpy as np
+import open3d as o3d
+
+# voxel indices are packed into one int64 key, 21 bits per axis
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+
+
+def pack_voxels(indices):
+    """One int64 key per row of (N, 3) integer voxel indices, ordered like the indices."""
+    indices = indices + _KEY_OFFSET
+    if len(indices) and (indices.min() < 0 or indices.max() >= 1 << _KEY_BITS):
+        raise ValueError('points are too far from the origin for the voxel size')
+    return (indices[:, 0] << (2 * _KEY_BITS)) | (indices[:, 1] << _KEY_BITS) | indices[:, 2]
+
+
+def unpack_voxels(keys):
+    """(N, 3) integer voxel indices of keys made by pack_voxels."""
+    mask = (1 << _KEY_BITS) - 1
+    return np.stack([(keys >> (2 * _KEY_BITS)) & mask,
+                     (keys >> _KEY_BITS) & mask,
+                     keys & mask], axis=1) - _KEY_OFFSET
+
+
+def lidar_points(measurement):
+    """(N, 4) float32 x, y, z, intensity view of a carla.LidarMeasurement, no copy."""
+    return np.frombuffer(measurement.raw_data, dtype=np.float32).reshape((-1, 4))
+
+
+def transform_points(points, transform, out=None):
+    """Apply a carla.Transform to (N, 3) points, into out if given."""
+    matrix = np.asarray(transform.get_matrix(), dtype=np.float32)
+    out = np.matmul(points, matrix[:3, :3].T, out=out)
+    out += matrix[:3, 3]
+    return out
+
+
+def to_point_cloud(points, colors=None):
+    """open3d PointCloud of (N, 3) points, y negated, with optional (N, 3) uint8 RGB colors."""
+    points = np.array(points, dtype=np.float64)
+    points[:, 1] *= -1
+    cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    if colors is not None:
+        cloud.colors = o3d.utility.Vector3dVector(np.asarray(colors, dtype=np.float64) / 255.0)
+    return cloud
+
+
+def write_point_cloud(path, points, colors=None):
+    """Write (N, 3) points with open3d, y negated, format by extension."""
+    if not o3d.io.write_point_cloud(path, to_point_cloud(points, colors)):
+        raise IOError(f'could not write {path}')
+
+
+class LidarAccumulator(object):
+    """Growable (N, 4) float32 buffer of world coordinate points and their intensity."""
+
+    def __init__(self, capacity=1 << 20):
+        self._buffer = np.empty((capacity, 4), dtype=np.float32)
+        self.count = 0
+        self.sweeps = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def points(self):
+        """(count, 3) view of the world coordinates."""
+        return self._buffer[:self.count, :3]
+
+    @property
+    def intensity(self):
+        return self._buffer[:self.count, 3]
+
+    def add(self, measurement, transform=None):
+        """
+        Append a sweep, transformed to world coordinates with transform
+        (default: the sensor transform attached to the measurement). Returns
+        the (N, 4) sweep as a view into the buffer, valid until the next add.
+        """
+        points = lidar_points(measurement)
+        start = self.count
+        stop = start + len(points)
+        self._reserve(stop)
+        out = self._buffer[start:stop]
+        transform_points(points[:, :3], measurement.transform if transform is None else transform, out[:, :3])
+        out[:, 3] = points[:, 3]
+        self.count = stop
+        self.sweeps += 1
+        return out
+
+    def to_point_cloud(self):
+        return to_point_cloud(self.points)
+
+    def write(self, path):
+        write_point_cloud(path, self.points)
+
+    def _reserve(self, size):
+        if size > len(self._buffer):
+            buffer = np.empty((max(size, 2 * len(self._buffer)), 4), dtype=np.float32)
+            buffer[:self.count] = self._buffer[:self.count]
+            self._buffer = buffer
+
+
+class VoxelAccumulator(object):
+    """
+    Streaming voxel grid: every occupied voxel of voxel_size metres keeps the
+    centroid, point count and mean intensity of its points, with colors set
+    their mean colour and, with num_labels set, a histogram of their labels. Voxels are kept sorted by
+    their packed index, so merging a sweep costs one sort of the sweep and
+    one pass over the occupied voxels. Coordinates must stay within
+    2^20 voxels of the origin (about 52 km at 5 cm).
+    """
+
+    def __init__(self, voxel_size=0.05, num_labels=None, colors=False):
+        self.voxel_size = float(voxel_size)
+        self.num_labels = num_labels
+        self.sweeps = 0
+        self.total_points = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._sums = np.empty((0, 3), dtype=np.float64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._intensity_sums = np.empty(0, dtype=np.float64)
+        self._label_counts = None if num_labels is None else np.empty((0, num_labels), dtype=np.uint32)
+        self._color_sums = np.empty((0, 3), dtype=np.float64) if colors else None
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def points(self):
+        """(voxels, 3) float32 centroids."""
+        return (self._sums / self._counts[:, None]).astype(np.float32)
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def intensity(self):
+        """Mean intensity per voxel."""
+        return (self._intensity_sums / self._counts).astype(np.float32)
+
+    @property
+    def colors(self):
+        """(voxels, 3) uint8 mean colour per voxel."""
+        if self._color_sums is None:
+            raise ValueError('VoxelAccumulator was created without colors')
+        return np.rint(self._color_sums / self._counts[:, None]).astype(np.uint8)
+
+    @property
+    def labels(self):
+        """Most frequent label per voxel."""
+        if self._label_counts is None:
+            raise ValueError('VoxelAccumulator was created without num_labels')
+        return np.argmax(self._label_counts, axis=1)
+
+    @property
+    def indices(self):
+        """(voxels, 3) integer voxel indices."""
+        return unpack_voxels(self._keys)
+
+    def add(self, measurement, transform=None):
+        """
+        Merge a LiDAR sweep, transformed to world coordinates with transform
+        (default: the sensor transform attached to the measurement). Returns
+        the transformed (N, 4) sweep.
+        """
+        points = lidar_points(measurement)
+        sweep = np.empty(points.shape, dtype=np.float32)
+        transform_points(points[:, :3], measurement.transform if transform is None else transform, sweep[:, :3])
+        sweep[:, 3] = points[:, 3]
+        self.add_points(sweep[:, :3], sweep[:, 3])
+        return sweep
+
+    def add_points(self, points, intensity=None, labels=None, colors=None):
+        """Merge (N, 3) world coordinate points with optional intensity, integer labels and (N, 3) colours."""
+        if len(points) == 0:
+            return
+        if (labels is None) != (self._label_counts is None):
+            raise ValueError('labels must be given exactly when num_labels is set')
+        if (colors is None) != (self._color_sums is None):
+            raise ValueError('colors must be given exactly when the accumulator was created with colors')
+
+        keys = pack_voxels(np.floor(points / self.voxel_size).astype(np.int64))
+        sweep_keys, inverse = np.unique(keys, return_inverse=True)
+        size = len(sweep_keys)
+        sums = np.stack([np.bincount(inverse, points[:, axis], size) for axis in range(3)], axis=1)
+        counts = np.bincount(inverse, minlength=size)
+        intensity_sums = np.zeros(size) if intensity is None else np.bincount(inverse, intensity, size)
+        label_counts = None
+        if labels is not None:
+            label_counts = np.zeros((size, self.num_labels), dtype=np.uint32)
+            np.add.at(label_counts, (inverse, labels), 1)
+        color_sums = None
+        if colors is not None:
+            color_sums = np.stack([np.bincount(inverse, colors[:, channel], size) for channel in range(3)], axis=1)
+
+        # voxels already occupied get the sums added, the others are inserted
+        positions = np.searchsorted(self._keys, sweep_keys)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == sweep_keys[found]
+        old = positions[found]
+        self._sums[old] += sums[found]
+        self._counts[old] += counts[found]
+        self._intensity_sums[old] += intensity_sums[found]
+        if label_counts is not None:
+            self._label_counts[old] += label_counts[found]
+        if color_sums is not None:
+            self._color_sums[old] += color_sums[found]
+
+        new = ~found
+        if new.any():
+            at = positions[new]
+            self._keys = np.insert(self._keys, at, sweep_keys[new])
+            self._sums = np.insert(self._sums, at, sums[new], axis=0)
+            self._counts = np.insert(self._counts, at, counts[new])
+            self._intensity_sums = np.insert(self._intensity_sums, at, intensity_sums[new])
+            if label_counts is not None:
+                self._label_counts = np.insert(self._label_counts, at, label_counts[new], axis=0)
+            if color_sums is not None:
+                self._color_sums = np.insert(self._color_sums, at, color_sums[new], axis=0)
+
+        self.sweeps += 1
+        self.total_points += len(points)
+
+    def to_point_cloud(self):
+        return to_point_cloud(self.points)
+
+    def write(self, path):
+        write_point_cloud(path, self.points)
@@ -1,14 +1,20 @@
-import copy
 import time
 import carla
-import numpy as np
 import open3d as o3d
 
-from im_seq_roundabout import CarlaSyncMode as syncer
+from carla_sync import CarlaSyncMode as syncer
+from lidar_accumulator import LidarAccumulator, VoxelAccumulator, write_point_cloud
+from point_tiles import write_tiles
 
 _HOST_ = '127.0.0.1'
 _PORT_ = 2000
 _SLEEP_TIME_ = 1
+# also write every sweep to _out/<i>.ply
+_SAVE_SWEEPS_ = False
+# merge the sweeps into voxels of this size in metres instead of keeping every point
+_VOXEL_SIZE_ = None
+# also write the cloud as a tiled octree (see point_tiles.py) to this directory
+_TILES_PATH_ = None
 
 
 def main():
@@ -51,7 +57,11 @@ def main():
 
     number_of_records = 170
 
-    full_pointcloud = o3d.geometry.PointCloud()
+    # sweeps in world coordinates, written once at the end
+    if _VOXEL_SIZE_ is None:
+        accumulator = LidarAccumulator()
+    else:
+        accumulator = VoxelAccumulator(_VOXEL_SIZE_)
 
     with syncer(world, *sensor_list, fps=30) as sync:
         for i in range(number_of_records):
@@ -60,33 +70,20 @@ def main():
                 if True:
                     lidar_output = sync.tick(timeout=2.0)[1]
 
-                    locations = np.array([-spectator.get_location().x,
-                                          -spectator.get_location().y,
-                                          -spectator.get_location().z])
+                    # placed with the sensor transform delivered with the sweep
+                    sweep = accumulator.add(lidar_output)
 
-                    lidar_output.save_to_disk(f'_out/{i}.ply')
-
-                    current_ply = o3d.io.read_point_cloud(f'_out/{i}.ply')
-                    point_cloud_in_numpy = np.asarray(current_ply.points)
-                    point_cloud_in_numpy += locations
-
-                    current_ply.points = o3d.utility.Vector3dVector(point_cloud_in_numpy)
-
-                    export_ply = copy.deepcopy(current_ply)
-
-                    o3d.io.write_point_cloud(f'_out/{i}.ply', current_ply)
-
-                    full_pointcloud += export_ply
+                    if _SAVE_SWEEPS_:
+                        write_point_cloud(f'_out/{i}.ply', sweep[:, :3])
             except:
                 continue
 
         lidar.destroy()
 
-        full_pointcloud_np = np.asarray(full_pointcloud.points)
-        full_pointcloud_np[:, 1] *= -1
-        full_pointcloud.points = o3d.utility.Vector3dVector(full_pointcloud_np)
-
+        full_pointcloud = accumulator.to_point_cloud()
         o3d.io.write_point_cloud("_out/pointcloud.pcd", full_pointcloud)
+        if _TILES_PATH_ is not None:
+            write_tiles(_TILES_PATH_, accumulator.points, {'intensity': accumulator.intensity})
         o3d.visualization.draw_geometries([full_pointcloud])
 
 
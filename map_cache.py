@@ -0,0 +1,159 @@
+"""
+Per-map cache of the static metadata the capture scripts ask the server for.
+
+world.get_map().get_spawn_points(), world.get_blueprint_library() and the
+scan of world.get_actors() for traffic lights each move a large payload over
+the connection, and the capture loops repeated them for every run. MapCache
+fetches them once per loaded map:
+
+    maps = MapCache(client)
+    ...
+        metadata = maps.get(world)
+        bp = maps.blueprints(world).find('vehicle.tesla.model3')
+        vehicle = world.spawn_actor(bp, metadata.spawn_points[spawn_position])
+        for light in metadata.traffic_lights(world):
+            light.set_state(carla.TrafficLightState.Green)
+
+Spawn points, blueprint attributes and waypoints sampled every
+waypoint_distance metres only depend on the map and the server version; they
+are pickled to <cache_dir>/<map>-<version>.pickle, so later sessions skip
+those RPCs too. Traffic light actor ids belong to one world and are only
+kept in memory, with its world id: world ids are episode counters that start
+again with every server process, so an id from an earlier session may name
+another map. Each session therefore asks world.get_map() for the map name
+once. Loading or reloading a map gives the world a new id, so the entry is
+replaced and the traffic lights are looked up again.
+"""
+
+import os
+import pickle
+import re
+
+import carla
+import numpy as np
+
+from spawn_index import SpawnPointIndex, transform_to_pose
+
+WAYPOINT_DTYPE = np.dtype([
+    ('road_id', np.int32),
+    ('lane_id', np.int32),
+    ('s', np.float32),
+    ('pose', np.float32, (6,)),
+])
+
+
+def pose_to_transform(pose):
+    """carla.Transform of x, y, z, roll, yaw, pitch."""
+    x, y, z, roll, yaw, pitch = (float(value) for value in pose)
+    return carla.Transform(carla.Location(x=x, y=y, z=z), carla.Rotation(pitch=pitch, yaw=yaw, roll=roll))
+
+
+class MapMetadata(object):
+    """Static metadata of one map on one server version, and the traffic light ids of one world."""
+
+    def __init__(self, state):
+        self.map_name = state['map_name']
+        self.server_version = state['server_version']
+        # (N, 6) float32 x, y, z, roll, yaw, pitch, in get_spawn_points() order
+        self.spawn_poses = state['spawn_poses']
+        # blueprint id -> attribute id -> (value, recommended values)
+        self.blueprint_attributes = state['blueprint_attributes']
+        # WAYPOINT_DTYPE records of carla.Map.generate_waypoints()
+        self.waypoints = state['waypoints']
+        self.spawn_points = [pose_to_transform(pose) for pose in self.spawn_poses]
+        self.world_id = None
+        self.traffic_light_ids = []
+        self._spawn_index = None
+
+    def state(self):
+        return {
+            'map_name': self.map_name,
+            'server_version': self.server_version,
+            'spawn_poses': self.spawn_poses,
+            'blueprint_attributes': self.blueprint_attributes,
+            'waypoints': self.waypoints,
+        }
+
+    @property
+    def spawn_index(self):
+        """spawn_index.SpawnPointIndex of the spawn points."""
+        if self._spawn_index is None:
+            self._spawn_index = SpawnPointIndex(self.spawn_poses, self.map_name)
+        return self._spawn_index
+
+    def traffic_lights(self, world):
+        """The traffic light actors of world, fetched by their cached ids."""
+        return world.get_actors(self.traffic_light_ids)
+
+
+class MapCache(object):
+    """MapMetadata of the map loaded on the server of client, in memory and in cache_dir."""
+
+    def __init__(self, client, cache_dir='_out/map_cache', waypoint_distance=2.0):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.waypoint_distance = waypoint_distance
+        self.server_version = client.get_server_version()
+        self._metadata = None
+        self._blueprints = None
+
+    def blueprints(self, world):
+        """The blueprint library, fetched once per session; find() returns copies."""
+        if self._blueprints is None:
+            self._blueprints = world.get_blueprint_library()
+        return self._blueprints
+
+    def get(self, world, refresh=False):
+        """MapMetadata of the map loaded in world; refresh fetches everything from the server again."""
+        if not refresh and self._metadata is not None and self._metadata.world_id == world.id:
+            return self._metadata
+
+        carla_map = world.get_map()
+        path = self._path(carla_map.name)
+        metadata = None
+        if not refresh and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                metadata = MapMetadata(pickle.load(f))
+        if metadata is None:
+            metadata = self._fetch(world, carla_map)
+            _write_atomic(path, pickle.dumps(metadata.state(), protocol=pickle.HIGHEST_PROTOCOL))
+
+        metadata.world_id = world.id
+        metadata.traffic_light_ids = [actor.id for actor in world.get_actors()
+                                      if actor.type_id == 'traffic.traffic_light']
+        self._metadata = metadata
+        return metadata
+
+    def _fetch(self, world, carla_map):
+        spawn_poses = np.array([transform_to_pose(transform) for transform in carla_map.get_spawn_points()],
+                               dtype=np.float32).reshape((-1, 6))
+        blueprint_attributes = {
+            blueprint.id: {attribute.id: (attribute.as_str(), list(attribute.recommended_values))
+                           for attribute in blueprint}
+            for blueprint in self.blueprints(world)
+        }
+        waypoints = carla_map.generate_waypoints(self.waypoint_distance)
+        records = np.empty(len(waypoints), dtype=WAYPOINT_DTYPE)
+        for record, waypoint in zip(records, waypoints):
+            record['road_id'] = waypoint.road_id
+            record['lane_id'] = waypoint.lane_id
+            record['s'] = waypoint.s
+            record['pose'] = transform_to_pose(waypoint.transform)
+        return MapMetadata({
+            'map_name': carla_map.name,
+            'server_version': self.server_version,
+            'spawn_poses': spawn_poses,
+            'blueprint_attributes': blueprint_attributes,
+            'waypoints': records,
+        })
+
+    def _path(self, map_name):
+        return os.path.join(self.cache_dir, re.sub(r'[^\w.-]+', '_', f'{map_name}-{self.server_version}') + '.pickle')
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+"""
+Streaming OpenDRIVE (.xodr) reader and lane centreline sampler, for planning
+spawn locations and routes on the maps in opendrive_maps/ without CARLA.
+
+The file is read with ElementTree.iterparse and every road is dropped from
+the tree once it has been read, so memory only holds the compact arrays:
+
+  roads        id, junction, length
+  geometries   planView records: road, s, x, y, hdg, length, kind
+               (line, arc, spiral, poly3, paramPoly3) and parameters
+  elevations,  cubic polynomials in s of the elevation profile, the lane
+  offsets      offset and (widths) the lane widths
+  sections,    lane sections of every road and their lanes (id, type)
+  lanes
+
+Sampling is vectorised over all samples of the map at once. For each sample
+the geometry, elevation, lane offset and width records are found with one
+searchsorted each; arcs are evaluated in closed form, spirals with Gauss-
+Legendre quadrature of their heading and poly3 through an arc length table.
+
+    xodr = OpenDriveMap.load('opendrive_maps/gellertter.xodr')
+    samples = xodr.lane_centrelines(spacing=2.0)             # LANE_SAMPLE_DTYPE
+    index = SpawnPointIndex(carla_poses(samples))            # offline spawn point queries
+
+Coordinates are OpenDRIVE's (right-handed, heading counter-clockwise from x);
+carla_poses() converts samples to CARLA's x, y, z, roll, yaw, pitch. The
+heading of a sample is its lane's direction of travel for right-hand traffic:
+right lanes (negative ids) follow the reference line, left lanes oppose it.
+Lanes outlined by <border> instead of <width> records count as zero width.
+
+    python opendrive.py opendrive_maps/gellertter.xodr --spacing 2 --output _out/gellertter_lanes.txt
+"""
+
+import argparse
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+GEOMETRY_KINDS = ('line', 'arc', 'spiral', 'poly3', 'paramPoly3')
+LINE, ARC, SPIRAL, POLY3, PARAM_POLY3 = range(len(GEOMETRY_KINDS))
+
+ROAD_DTYPE = np.dtype([
+    ('id', np.int32),
+    ('junction', np.int32),
+    ('length', np.float64),
+])
+GEOMETRY_DTYPE = np.dtype([
+    ('road', np.int32),
+    ('s', np.float64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('hdg', np.float64),
+    ('length', np.float64),
+    ('kind', np.int8),
+    # arc: curvature; spiral: curvStart, curvEnd; poly3: a, b, c, d;
+    # paramPoly3: aU, bU, cU, dU, aV, bV, cV, dV
+    ('params', np.float64, (8,)),
+    # paramPoly3 with pRange="normalized"
+    ('normalized', np.bool_),
+])
+# elevation, lane offset (owner: road index, s along the road) and lane
+# width records (owner: lane index, s: sOffset from the lane section start)
+POLY_DTYPE = np.dtype([
+    ('owner', np.int32),
+    ('s', np.float64),
+    ('coefficients', np.float64, (4,)),
+])
+SECTION_DTYPE = np.dtype([
+    ('road', np.int32),
+    ('s', np.float64),
+    ('length', np.float64),
+])
+LANE_DTYPE = np.dtype([
+    ('section', np.int32),
+    ('id', np.int16),
+    # index into OpenDriveMap.lane_types
+    ('type', np.int16),
+])
+LANE_SAMPLE_DTYPE = np.dtype([
+    ('road_id', np.int32),
+    ('section', np.int32),
+    ('lane_id', np.int16),
+    ('s', np.float32),
+    ('x', np.float32),
+    ('y', np.float32),
+    ('z', np.float32),
+    ('heading', np.float32),
+    ('width', np.float32),
+])
+
+# Gauss-Legendre nodes and weights on [0, 1] for the spiral integrals
+_GL_NODES, _GL_WEIGHTS = np.polynomial.legendre.leggauss(16)
+_GL_NODES = (_GL_NODES + 1) / 2
+_GL_WEIGHTS = _GL_WEIGHTS / 2
+# samples of the arc length tables of poly3 geometries
+_POLY3_TABLE = 1025
+
+
+def _floats(attributes, *names):
+    return tuple(float(attributes.get(name, 0.0)) for name in names)
+
+
+def _lookup(owners, starts, scale, owner, s):
+    """Row of the last record of owner starting at or before s, -1 where there is none."""
+    rows = np.searchsorted(owners * scale + starts, owner * scale + s, side='right') - 1
+    valid = rows >= 0
+    valid[valid] = owners[rows[valid]] == owner[valid]
+    return np.where(valid, rows, -1)
+
+
+def _cubic(records, rows, s):
+    """Value of the POLY_DTYPE records at rows at s (zero where rows is -1)."""
+    found = rows >= 0
+    out = np.zeros(len(rows))
+    a, b, c, d = records['coefficients'][rows[found]].T
+    ds = s[found] - records['s'][rows[found]]
+    out[found] = a + ds * (b + ds * (c + ds * d))
+    return out
+
+
+class OpenDriveMap(object):
+    """Roads, reference line geometries and lanes of an OpenDRIVE file, as structured arrays."""
+
+    def __init__(self, header, roads, geometries, elevations, offsets, sections, lanes, widths, lane_types):
+        self.header = header
+        self.roads = roads
+        self.geometries = geometries
+        self.elevations = elevations
+        self.offsets = offsets
+        self.sections = sections
+        self.lanes = lanes
+        self.widths = widths
+        self.lane_types = lane_types
+        # keys of the per road and per lane lookups are owner * _scale + s
+        self._scale = float(roads['length'].max() + 1.0) if len(roads) else 1.0
+
+    @classmethod
+    def load(cls, path):
+        """Parse an .xodr file."""
+        header = {}
+        roads, geometries, elevations, offsets, sections, lanes, widths = [], [], [], [], [], [], []
+        lane_types = []
+        lane_type_codes = {}
+        road = None
+        stack = []
+        root = None
+        for event, element in ET.iterparse(path, events=('start', 'end')):
+            if event == 'end':
+                stack.pop()
+                if element.tag == 'road':
+                    root.clear()
+                continue
+            tag = element.tag
+            parent = stack[-1] if stack else None
+            stack.append(tag)
+            attributes = element.attrib
+            if root is None:
+                root = element
+            elif tag == 'header' and parent == 'OpenDRIVE':
+                header = dict(attributes)
+            elif tag == 'road' and parent == 'OpenDRIVE':
+                road = len(roads)
+                roads.append((int(attributes['id']), int(attributes.get('junction', -1)),
+                              float(attributes['length'])))
+            elif tag == 'geometry' and parent == 'planView':
+                geometries.append([road, *_floats(attributes, 's', 'x', 'y', 'hdg', 'length'), LINE, (0.0,) * 8,
+                                   False])
+            elif parent == 'geometry' and tag in GEOMETRY_KINDS:
+                record = geometries[-1]
+                record[6] = GEOMETRY_KINDS.index(tag)
+                if tag == 'arc':
+                    params = _floats(attributes, 'curvature')
+                elif tag == 'spiral':
+                    params = _floats(attributes, 'curvStart', 'curvEnd')
+                elif tag == 'poly3':
+                    params = _floats(attributes, 'a', 'b', 'c', 'd')
+                elif tag == 'paramPoly3':
+                    params = _floats(attributes, 'aU', 'bU', 'cU', 'dU', 'aV', 'bV', 'cV', 'dV')
+                    record[8] = attributes.get('pRange', 'normalized') == 'normalized'
+                else:
+                    params = ()
+                record[7] = params + (0.0,) * (8 - len(params))
+            elif tag == 'elevation' and parent == 'elevationProfile':
+                elevations.append((road, *_floats(attributes, 's'), _floats(attributes, 'a', 'b', 'c', 'd')))
+            elif tag == 'laneOffset' and parent == 'lanes':
+                offsets.append((road, *_floats(attributes, 's'), _floats(attributes, 'a', 'b', 'c', 'd')))
+            elif tag == 'laneSection' and parent == 'lanes':
+                sections.append((road, float(attributes['s']), 0.0))
+            elif tag == 'lane' and parent in ('left', 'center', 'right'):
+                lane_type = attributes.get('type', 'none')
+                if lane_type not in lane_type_codes:
+                    lane_type_codes[lane_type] = len(lane_types)
+                    lane_types.append(lane_type)
+                lanes.append((len(sections) - 1, int(attributes['id']), lane_type_codes[lane_type]))
+            elif tag == 'width' and parent == 'lane':
+                widths.append((len(lanes) - 1, *_floats(attributes, 'sOffset'),
+                               _floats(attributes, 'a', 'b', 'c', 'd')))
+
+        roads = np.array(roads, dtype=ROAD_DTYPE)
+        sections = np.array(sections, dtype=SECTION_DTYPE)
+        # a section ends where the next one of its road starts, or at the road end
+        if len(sections):
+            ends = roads['length'][sections['road']]
+            same_road = sections['road'][1:] == sections['road'][:-1]
+            ends[:-1][same_road] = sections['s'][1:][same_road]
+            sections['length'] = np.maximum(ends - sections['s'], 0.0)
+        return cls(header, roads,
+                   np.array([tuple(record) for record in geometries], dtype=GEOMETRY_DTYPE),
+                   np.array(elevations, dtype=POLY_DTYPE),
+                   np.array(offsets, dtype=POLY_DTYPE),
+                   sections,
+                   np.array(lanes, dtype=LANE_DTYPE),
+                   np.array(widths, dtype=POLY_DTYPE),
+                   lane_types)
+
+    def reference_line(self, road, s):
+        """
+        x, y, z and heading (radians) of the reference line of the road
+        indices at s (arrays of the same length, or road a scalar).
+        """
+        s = np.atleast_1d(np.asarray(s, dtype=np.float64))
+        road = np.broadcast_to(np.asarray(road, dtype=np.int64), s.shape)
+        rows = _lookup(self.geometries['road'], self.geometries['s'], self._scale, road, s)
+        if (rows < 0).any():
+            raise ValueError('some roads have no planView geometry')
+        x, y, heading = self._evaluate(rows, s - self.geometries['s'][rows])
+        z = _cubic(self.elevations, _lookup(self.elevations['owner'], self.elevations['s'], self._scale, road, s), s)
+        return x, y, z, heading
+
+    def _evaluate(self, rows, ds):
+        # position and heading at ds along the geometries at rows, in the
+        # geometry's local frame (u along its start heading, v to the left)
+        geometries = self.geometries[rows]
+        kind = geometries['kind']
+        params = geometries['params']
+        u = ds.copy()
+        v = np.zeros(len(ds))
+        theta = np.zeros(len(ds))
+
+        arc = kind == ARC
+        if arc.any():
+            k = params[arc, 0]
+            turn = k * ds[arc]
+            # sin(kd) / k and (1 - cos(kd)) / k, also for k = 0
+            u[arc] = ds[arc] * np.sinc(turn / np.pi)
+            v[arc] = ds[arc] * np.sin(turn / 2) * np.sinc(turn / (2 * np.pi))
+            theta[arc] = turn
+
+        spiral = kind == SPIRAL
+        if spiral.any():
+            start = params[spiral, 0]
+            rate = (params[spiral, 1] - start) / geometries['length'][spiral]
+            length = ds[spiral]
+            t = length[:, None] * _GL_NODES
+            angles = start[:, None] * t + rate[:, None] * t * t / 2
+            u[spiral] = length * (np.cos(angles) @ _GL_WEIGHTS)
+            v[spiral] = length * (np.sin(angles) @ _GL_WEIGHTS)
+            theta[spiral] = start * length + rate * length * length / 2
+
+        poly3 = np.flatnonzero(kind == POLY3)
+        if len(poly3):
+            # ds is arc length, the polynomial is in u: invert an arc length table per geometry
+            for row in np.unique(rows[poly3]):
+                selected = poly3[rows[poly3] == row]
+                a, b, c, d = self.geometries['params'][row, :4]
+                table = np.linspace(0.0, self.geometries['length'][row], _POLY3_TABLE)
+                slopes = b + table * (2 * c + 3 * d * table)
+                lengths = np.concatenate([[0.0], np.cumsum(np.diff(table) * (np.hypot(1.0, slopes[1:])
+                                                                              + np.hypot(1.0, slopes[:-1])) / 2)])
+                u[selected] = np.interp(ds[selected], lengths, table)
+            local = u[poly3]
+            a, b, c, d = params[poly3, :4].T
+            v[poly3] = a + local * (b + local * (c + local * d))
+            theta[poly3] = np.arctan(b + local * (2 * c + 3 * d * local))
+
+        param_poly3 = kind == PARAM_POLY3
+        if param_poly3.any():
+            p = ds[param_poly3]
+            p = np.where(geometries['normalized'][param_poly3], p / geometries['length'][param_poly3], p)
+            au, bu, cu, du, av, bv, cv, dv = params[param_poly3].T
+            u[param_poly3] = au + p * (bu + p * (cu + p * du))
+            v[param_poly3] = av + p * (bv + p * (cv + p * dv))
+            theta[param_poly3] = np.arctan2(bv + p * (2 * cv + 3 * dv * p), bu + p * (2 * cu + 3 * du * p))
+
+        cos, sin = np.cos(geometries['hdg']), np.sin(geometries['hdg'])
+        x = geometries['x'] + u * cos - v * sin
+        y = geometries['y'] + u * sin + v * cos
+        return x, y, geometries['hdg'] + theta
+
+    def lane_centrelines(self, spacing=1.0, lane_types=('driving',), junctions=True, ends=False):
+        """
+        LANE_SAMPLE_DTYPE samples every spacing metres along the centre of
+        every lane of the given types (None: all lanes), optionally leaving
+        out the roads of junctions. With ends, every lane section also gets a
+        sample at its end.
+        """
+        sections = self.sections
+        keep = sections['length'] > 0
+        if not junctions:
+            keep &= self.roads['junction'][sections['road']] < 0
+        section_ids = np.flatnonzero(keep)
+
+        # samples of the reference line: every section from its start
+        counts = np.ceil(sections['length'][section_ids] / spacing).astype(np.int64) + bool(ends)
+        sample_section = np.repeat(section_ids, counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        s = sections['s'][sample_section] + (np.arange(len(sample_section)) - first) * spacing
+        if ends:
+            s = np.minimum(s, sections['s'][sample_section] + sections['length'][sample_section])
+        road = sections['road'][sample_section].astype(np.int64)
+        x, y, z, heading = self.reference_line(road, s)
+        offset = _cubic(self.offsets, _lookup(self.offsets['owner'], self.offsets['s'], self._scale, road, s), s)
+
+        # one pair per sample and lane of its section (the centre lane has no width)
+        lanes = self.lanes
+        side_lanes = np.flatnonzero(lanes['id'] != 0)
+        lane_counts = np.bincount(lanes['section'][side_lanes], minlength=len(sections))
+        lane_first = np.cumsum(lane_counts) - lane_counts
+        pairs_per_sample = lane_counts[sample_section]
+        pair_sample = np.repeat(np.arange(len(s)), pairs_per_sample)
+        within = np.arange(len(pair_sample)) - np.repeat(np.cumsum(pairs_per_sample) - pairs_per_sample,
+                                                         pairs_per_sample)
+        pair_lane = side_lanes[lane_first[sample_section][pair_sample] + within]
+        lane_ids = lanes['id'][pair_lane].astype(np.int64)
+
+        section_s = s[pair_sample] - sections['s'][sample_section][pair_sample]
+        width = _cubic(self.widths, _lookup(self.widths['owner'], self.widths['s'], self._scale, pair_lane,
+                                            section_s), section_s)
+        width = np.maximum(width, 0.0)
+
+        # distance of every lane's inner border from the lane offset: the widths
+        # of the lanes between it and the centre, on the same side
+        order = np.lexsort((np.abs(lane_ids), np.sign(lane_ids), pair_sample))
+        sorted_width = width[order]
+        group = np.sign(lane_ids[order]) + 3 * pair_sample[order]
+        starts = np.concatenate([[True], group[1:] != group[:-1]])[:len(group)]
+        exclusive = np.cumsum(sorted_width) - sorted_width
+        inner = np.empty(len(order))
+        inner[order] = exclusive - exclusive[np.flatnonzero(starts)][np.cumsum(starts) - 1]
+        lateral = offset[pair_sample] + np.sign(lane_ids) * (inner + width / 2)
+
+        selected = np.ones(len(pair_lane), dtype=bool)
+        if lane_types is not None:
+            codes = [self.lane_types.index(name) for name in lane_types if name in self.lane_types]
+            selected = np.isin(lanes['type'][pair_lane], codes)
+        selected = np.flatnonzero(selected)
+        pair_sample, lane_ids, lateral = pair_sample[selected], lane_ids[selected], lateral[selected]
+
+        reference_heading = heading[pair_sample]
+        samples = np.empty(len(selected), dtype=LANE_SAMPLE_DTYPE)
+        samples['road_id'] = self.roads['id'][road[pair_sample]]
+        samples['section'] = sample_section[pair_sample]
+        samples['lane_id'] = lane_ids
+        samples['s'] = s[pair_sample]
+        samples['x'] = x[pair_sample] - lateral * np.sin(reference_heading)
+        samples['y'] = y[pair_sample] + lateral * np.cos(reference_heading)
+        samples['z'] = z[pair_sample]
+        samples['heading'] = np.where(lane_ids < 0, reference_heading, reference_heading + np.pi)
+        samples['width'] = width[selected]
+        return samples
+
+
+def carla_poses(samples):
+    """(N, 6) float32 x, y, z, roll, yaw, pitch in CARLA coordinates (y mirrored, yaw in degrees) of lane samples."""
+    poses = np.zeros((len(samples), 6), dtype=np.float32)
+    poses[:, 0] = samples['x']
+    poses[:, 1] = -samples['y']
+    poses[:, 2] = samples['z']
+    poses[:, 4] = (-np.degrees(samples['heading']) + 180.0) % 360.0 - 180.0
+    return poses
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('xodr', help='OpenDRIVE file, e.g. opendrive_maps/gellertter.xodr')
+    argparser.add_argument('--spacing', type=float, default=2.0, help='metres between samples along a lane')
+    argparser.add_argument('--lane-types', nargs='*', default=['driving'], help='lane types to sample (none: all)')
+    argparser.add_argument('--no-junctions', action='store_true', help='leave out the roads of junctions')
+    argparser.add_argument('--output', default=None,
+                           help='.npy (LANE_SAMPLE_DTYPE samples) or .txt (CARLA x y z roll yaw pitch per row)')
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    xodr = OpenDriveMap.load(args.xodr)
+    parsed = time.perf_counter()
+    samples = xodr.lane_centrelines(args.spacing, args.lane_types or None, not args.no_junctions)
+    sampled = time.perf_counter()
+
+    kinds = np.bincount(xodr.geometries['kind'], minlength=len(GEOMETRY_KINDS))
+    print(f'{len(xodr.roads)} roads, {len(xodr.sections)} lane sections, {len(xodr.lanes)} lanes, '
+          f'{len(xodr.geometries)} geometries ('
+          + ', '.join(f'{count} {kind}' for kind, count in zip(GEOMETRY_KINDS, kinds) if count) + ')')
+    print(f'{len(samples)} lane samples every {args.spacing} m')
+    print(f'parsed in {1000 * (parsed - start):.1f} ms, sampled in {1000 * (sampled - parsed):.1f} ms')
+
+    if args.output is not None:
+        if args.output.endswith('.npy'):
+            np.save(args.output, samples)
+        else:
+            np.savetxt(args.output, carla_poses(samples))
+        print(f'written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
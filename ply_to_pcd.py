@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""
+Converts PLY point clouds to PCD without PCL.
+
+    python ply_to_pcd.py                          # every .ply in the current directory
+    python ply_to_pcd.py _out/ "_out/my cloud.ply" --format binary_compressed --workers 4
+
+Without arguments it does what ply_to_pcd.sh did with pcl_ply2pcd, without
+needing PCL. The vertex element of a binary PLY is memory mapped and copied
+to the PCD in chunks of --chunk-points, so a cloud is never held twice in
+memory; ASCII PLY files (as CARLA's LidarMeasurement.save_to_disk writes
+them) are parsed in chunks too. red/green/blue become PCL's packed rgb field,
+nx/ny/nz become normal_x/y/z and I becomes intensity; other scalar properties
+keep their names. Files are converted in parallel on a process pool and
+written next to their input, or into --output-dir.
+
+binary_compressed PCDs store each field as a column, LZF encoded. Every
+chunk of a column is compressed on its own and spooled to a temporary file,
+and the columns are copied into the PCD after the single pass over the PLY.
+The encoder is liblzf's greedy one: it takes the most recent earlier
+occurrence of the next three bytes within 8 KiB and extends it as far as
+it matches.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+_PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+_RENAMED = {'nx': 'normal_x', 'ny': 'normal_y', 'nz': 'normal_z', 'I': 'intensity'}
+_COLORS = ('red', 'green', 'blue')
+# LZF literal runs hold at most 32 bytes after their control byte, back
+# references reach 8192 bytes back and copy 3 to 264 bytes
+_LZF_RUN = 32
+_LZF_MAX_OFFSET = 8192
+_LZF_MAX_MATCH = 264
+
+
+def read_ply_header(f):
+    """
+    Parse the header of an open PLY file; returns (format, vertex count,
+    vertex properties as (name, numpy type) pairs, bytes before the vertices).
+    """
+    if f.readline().strip() != b'ply':
+        raise ValueError('not a PLY file')
+    fmt = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('PLY header has no end_header')
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            break
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append((words[4], None))
+            else:
+                elements[-1][2].append((words[2], _PLY_TYPES[words[1]]))
+    if not elements or elements[0][0] != 'vertex':
+        raise ValueError('the first PLY element must be the vertices')
+    _, count, properties = elements[0]
+    if any(ply_type is None for _, ply_type in properties):
+        raise ValueError('list properties of vertices are not supported')
+    return fmt, count, properties, f.tell()
+
+
+def _pcd_fields(properties):
+    # (name, numpy type) of the PCD fields for the PLY vertex properties
+    names = [name for name, _ in properties]
+    fields = [(_RENAMED.get(name, name), ply_type) for name, ply_type in properties
+              if name not in _COLORS and name != 'alpha']
+    if all(color in names for color in _COLORS):
+        fields.append(('rgb', 'f4'))
+    return np.dtype([(name, '<' + ply_type) for name, ply_type in fields])
+
+
+def _to_pcd(vertices, dtype):
+    out = np.empty(len(vertices), dtype=dtype)
+    for name in vertices.dtype.names:
+        target = _RENAMED.get(name, name)
+        if target in dtype.names:
+            out[target] = vertices[name]
+    if 'rgb' in dtype.names:
+        rgb = ((vertices['red'].astype(np.uint32) << 16) | (vertices['green'].astype(np.uint32) << 8)
+               | vertices['blue'].astype(np.uint32))
+        out['rgb'] = rgb.view(np.float32)
+    return out
+
+
+def _pcd_header(dtype, count, data):
+    types = {'f': 'F', 'i': 'I', 'u': 'U'}
+    fields = [dtype.fields[name][0] for name in dtype.names]
+    return (
+        '# .PCD v0.7 - Point Cloud Data file format\n'
+        'VERSION 0.7\n'
+        f'FIELDS {" ".join(dtype.names)}\n'
+        f'SIZE {" ".join(str(field.itemsize) for field in fields)}\n'
+        f'TYPE {" ".join(types[field.kind] for field in fields)}\n'
+        f'COUNT {" ".join("1" for _ in fields)}\n'
+        f'WIDTH {count}\n'
+        'HEIGHT 1\n'
+        'VIEWPOINT 0 0 0 1 0 0 0\n'
+        f'POINTS {count}\n'
+        f'DATA {data}\n'
+    ).encode('ascii')
+
+
+def _lzf_literals(data):
+    """data (bytes-like) as an LZF stream of literal runs."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    runs = -(-len(data) // _LZF_RUN)
+    out = np.zeros(runs * (_LZF_RUN + 1), dtype=np.uint8).reshape((runs, _LZF_RUN + 1))
+    full = len(data) // _LZF_RUN
+    out[:full, 0] = _LZF_RUN - 1
+    out[:full, 1:] = data[:full * _LZF_RUN].reshape((full, _LZF_RUN))
+    rest = len(data) - full * _LZF_RUN
+    if rest:
+        out[full, 0] = rest - 1
+        out[full, 1:rest + 1] = data[full * _LZF_RUN:]
+    out = out.reshape(-1)
+    return out[:len(out) - (_LZF_RUN - rest) if rest else len(out)]
+
+
+def lzf_compress(data):
+    """data (bytes-like) as an LZF stream, as PCL's lzfDecompress reads it."""
+    array = np.frombuffer(data, dtype=np.uint8)
+    size = len(array)
+    if size < 3:
+        return _lzf_literals(array).tobytes()
+    # the most recent earlier position starting with the same three bytes
+    triples = (array[:-2].astype(np.uint32) << 16) | (array[1:-1].astype(np.uint32) << 8) | array[2:]
+    order = np.argsort(triples, kind='stable')
+    same = triples[order[1:]] == triples[order[:-1]]
+    previous = np.full(size, -1, dtype=np.int64)
+    previous[order[1:][same]] = order[:-1][same]
+    positions = np.arange(size)
+    usable = (previous >= 0) & (positions - previous <= _LZF_MAX_OFFSET)
+    # the first usable position at or after every position, size if there is none
+    following = np.where(usable, positions, size)
+    following = np.minimum.accumulate(following[::-1])[::-1].tolist() + [size]
+    previous = previous.tolist()
+    raw = bytes(array)
+
+    out = bytearray()
+    literal_start = position = 0
+    while True:
+        position = following[position]
+        if position >= size:
+            break
+        reference = previous[position]
+        limit = min(_LZF_MAX_MATCH, size - position)
+        length = 3
+        while length < limit and length < 16 and raw[position + length] == raw[reference + length]:
+            length += 1
+        if length == 16 and length < limit:
+            mismatch = np.flatnonzero(array[position + 16:position + limit] != array[reference + 16:reference + limit])
+            length = 16 + int(mismatch[0]) if len(mismatch) else limit
+        for start in range(literal_start, position, _LZF_RUN):
+            stop = min(start + _LZF_RUN, position)
+            out.append(stop - start - 1)
+            out += raw[start:stop]
+        offset = position - reference - 1
+        if length < 9:
+            out += bytes(((length - 2) << 5 | offset >> 8, offset & 0xff))
+        else:
+            out += bytes((7 << 5 | offset >> 8, length - 9, offset & 0xff))
+        position = literal_start = position + length
+    if literal_start < size:
+        out += _lzf_literals(array[literal_start:]).tobytes()
+    return bytes(out)
+
+
+def iter_vertices(path, chunk_points=1 << 20):
+    """Yields (vertex count, properties, vertices) of a PLY file, chunk_points structured vertices at a time."""
+    with open(path, 'rb') as f:
+        fmt, count, properties, offset = read_ply_header(f)
+        if fmt == 'ascii':
+            dtype = np.dtype([(name, ply_type) for name, ply_type in properties])
+            for start in range(0, count, chunk_points):
+                rows = np.loadtxt(f, dtype=dtype, max_rows=min(chunk_points, count - start), ndmin=1)
+                yield count, properties, rows
+            return
+    byte_order = {'binary_little_endian': '<', 'binary_big_endian': '>'}.get(fmt)
+    if byte_order is None:
+        raise ValueError(f'unknown PLY format {fmt}')
+    dtype = np.dtype([(name, byte_order + ply_type) for name, ply_type in properties])
+    vertices = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)) if count else \
+        np.empty(0, dtype=dtype)
+    for start in range(0, max(count, 1), chunk_points):
+        yield count, properties, vertices[start:start + chunk_points]
+
+
+def convert(ply_path, pcd_path=None, data='binary', chunk_points=1 << 20):
+    """Convert one PLY file to PCD (data 'binary' or 'binary_compressed'); returns the PCD path."""
+    if data not in ('binary', 'binary_compressed'):
+        raise ValueError(f"data must be 'binary' or 'binary_compressed', got {data!r}")
+    if pcd_path is None:
+        pcd_path = os.path.splitext(ply_path)[0] + '.pcd'
+    tmp_path = pcd_path + '.tmp'
+
+    chunks = iter_vertices(ply_path, chunk_points)
+    with open(tmp_path, 'wb') as out:
+        if data == 'binary':
+            for i, (count, properties, vertices) in enumerate(chunks):
+                if i == 0:
+                    dtype = _pcd_fields(properties)
+                    out.write(_pcd_header(dtype, count, data))
+                out.write(_to_pcd(vertices, dtype).tobytes())
+        else:
+            # column-major: every chunk of a field is compressed into that
+            # field's spool, which is copied to the PCD once all are known
+            spools = []
+            try:
+                for count, properties, vertices in chunks:
+                    if not spools:
+                        dtype = _pcd_fields(properties)
+                        spools = [tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(tmp_path)))
+                                  for _ in dtype.names]
+                    if not len(vertices):
+                        continue
+                    points = _to_pcd(vertices, dtype)
+                    for name, spool in zip(dtype.names, spools):
+                        spool.write(lzf_compress(np.ascontiguousarray(points[name]).tobytes()))
+                out.write(_pcd_header(dtype, count, data))
+                out.write(np.array([sum(spool.tell() for spool in spools), count * dtype.itemsize],
+                                   dtype='<u4').tobytes())
+                for spool in spools:
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, out)
+            finally:
+                for spool in spools:
+                    spool.close()
+    os.replace(tmp_path, pcd_path)
+    return pcd_path
+
+
+def _find_ply_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith('.ply'))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('paths', nargs='*', default=['.'], help='PLY files or directories of them')
+    argparser.add_argument('--format', choices=('binary', 'binary_compressed'), default='binary',
+                           help='PCD data format')
+    argparser.add_argument('--output-dir', default=None, help='write the PCD files here instead of next to the input')
+    argparser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    argparser.add_argument('--chunk-points', type=int, default=1 << 20, help='points copied at a time')
+    args = argparser.parse_args()
+
+    ply_files = _find_ply_files(args.paths)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+        pcd_files = [os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0] + '.pcd')
+                     for path in ply_files]
+    else:
+        pcd_files = [None] * len(ply_files)
+
+    failed = False
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(convert, ply, pcd, args.format, args.chunk_points)
+                   for ply, pcd in zip(ply_files, pcd_files)]
+        for ply, future in zip(ply_files, futures):
+            try:
+                print(f'{ply} -> {future.result()}')
+            except Exception as e:
+                print(f'{ply}: {e}', file=sys.stderr)
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Spatially tiled octree storage for large point clouds.
+
+The bounding cube of the cloud is split into an octree; level d has 2^d
+tiles per axis. Each point is stored in exactly one level: level 0 holds a
+coarse subsample (one point per cell of a grid x grid x grid grid per tile),
+every further level a finer subsample of the points left over, and the
+deepest level the rest. Reading levels 0..lod therefore gives the whole
+cloud at a level of detail, and reading only the tiles that intersect a box
+or a camera frustum gives a region of it:
+
+    write_tiles('_out/pointcloud_tiles', accumulator.points, {'intensity': accumulator.intensity})
+
+    tiles = TileReader('_out/pointcloud_tiles')
+    cloud = tiles.query(bbox=([-50, -50, -5], [50, 50, 20]), lod=2)
+    cloud['xyz'], cloud['intensity']
+
+Layout:
+
+    <path>/meta.json              bounds, levels, record dtype, tiles with count and bbox
+    <path>/<level>/<x>_<y>_<z>.bin  raw records of one tile
+
+Coordinates are stored as given (CARLA coordinates for the accumulators).
+
+    python point_tiles.py _out/pointcloud.pcd _out/pointcloud_tiles
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import open3d as o3d
+
+_META = 'meta.json'
+_MAX_LEVELS = 12
+
+
+def _record_dtype(attributes):
+    fields = [('xyz', np.float32, (3,))]
+    for name, values in attributes.items():
+        values = np.asarray(values)
+        fields.append((name, values.dtype, values.shape[1:]) if values.ndim > 1 else (name, values.dtype))
+    return np.dtype(fields)
+
+
+def _dtype_to_json(dtype):
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+
+def _dtype_from_json(fields):
+    return np.dtype([(name, base, tuple(shape)) if shape else (name, base) for name, base, shape in fields])
+
+
+def _tile_indices(points, origin, size, level):
+    tiles = 1 << level
+    indices = np.floor((points - origin) / (size / tiles)).astype(np.int64)
+    return np.clip(indices, 0, tiles - 1)
+
+
+def _pack(indices, bits):
+    return (indices[:, 0] << (2 * bits)) | (indices[:, 1] << bits) | indices[:, 2]
+
+
+def _choose_levels(points, origin, size, max_tile_points):
+    for level in range(_MAX_LEVELS):
+        keys = _pack(_tile_indices(points, origin, size, level), level)
+        if np.unique(keys, return_counts=True)[1].max() <= max_tile_points:
+            return level + 1
+    return _MAX_LEVELS
+
+
+def write_tiles(path, points, attributes=None, levels=None, max_tile_points=100000, grid=64, seed=0):
+    """
+    Write (N, 3) points with optional per-point attributes ({name: (N, ...) array})
+    as a tiled octree to path, replacing what is there. Without levels, the
+    octree gets deep enough that no tile of the deepest level would hold more
+    than max_tile_points points. Returns the number of levels.
+    """
+    points = np.asarray(points, dtype=np.float32)
+    attributes = dict(attributes or {})
+    if len(points) == 0:
+        raise ValueError('no points to write')
+    grid_bits = int(np.log2(grid))
+    if 1 << grid_bits != grid:
+        raise ValueError(f'grid must be a power of two, got {grid}')
+
+    low = points.min(axis=0).astype(np.float64)
+    high = points.max(axis=0).astype(np.float64)
+    size = float((high - low).max()) * (1 + 1e-6) or 1.0
+    if levels is None:
+        levels = _choose_levels(points, low, size, max_tile_points)
+
+    records = np.empty(len(points), dtype=_record_dtype(attributes))
+    records['xyz'] = points
+    for name, values in attributes.items():
+        records[name] = values
+    # a random order makes the first point of a cell a random sample of it
+    records = records[np.random.default_rng(seed).permutation(len(records))]
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    tiles = {}
+    remaining = records
+    for level in range(levels):
+        if level < levels - 1:
+            cells = _tile_indices(remaining['xyz'], low, size, level + grid_bits)
+            _, first = np.unique(_pack(cells, level + grid_bits), return_index=True)
+            keep = np.zeros(len(remaining), dtype=bool)
+            keep[first] = True
+            selected, remaining = remaining[keep], remaining[~keep]
+        else:
+            selected = remaining
+
+        os.makedirs(os.path.join(path, str(level)))
+        indices = _tile_indices(selected['xyz'], low, size, level)
+        keys = _pack(indices, level)
+        order = np.argsort(keys, kind='stable')
+        selected, keys, indices = selected[order], keys[order], indices[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        for start, stop in zip(starts, np.r_[starts[1:], len(keys)]):
+            tile = selected[start:stop]
+            x, y, z = indices[start]
+            name = f'{level}/{x}_{y}_{z}'
+            tile.tofile(os.path.join(path, f'{name}.bin'))
+            tiles[name] = {
+                'count': int(stop - start),
+                'bbox': [tile['xyz'].min(axis=0).tolist(), tile['xyz'].max(axis=0).tolist()],
+            }
+
+    meta = {
+        'origin': low.tolist(),
+        'size': size,
+        'levels': levels,
+        'grid': grid,
+        'points': len(records),
+        'dtype': _dtype_to_json(records.dtype),
+        'tiles': tiles,
+    }
+    with open(os.path.join(path, _META), 'w') as f:
+        json.dump(meta, f)
+    return levels
+
+
+def frustum_planes(matrix, fov, width, height, near=0.1, far=1000.0):
+    """
+    (6, 4) planes a, b, c, d with a*x + b*y + c*z + d >= 0 inside the view
+    frustum of a CARLA camera (x forward, y right, z up) with horizontal fov
+    in degrees, whose camera-to-world 4x4 matrix is e.g. transform.get_matrix().
+    """
+    tan_h = np.tan(np.radians(fov) / 2)
+    tan_v = tan_h * height / width
+    camera_planes = np.array([
+        [1, 0, 0, -near],
+        [-1, 0, 0, far],
+        [tan_h, -1, 0, 0],
+        [tan_h, 1, 0, 0],
+        [tan_v, 0, -1, 0],
+        [tan_v, 0, 1, 0],
+    ], dtype=np.float64)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    rotation, translation = matrix[:3, :3], matrix[:3, 3]
+    normals = camera_planes[:, :3] @ rotation.T
+    offsets = camera_planes[:, 3] - normals @ translation
+    return np.column_stack([normals, offsets])
+
+
+def _box_in_planes(low, high, planes):
+    # the box is outside if all of it is behind one plane; the corner
+    # farthest along the normal decides
+    corner = np.where(planes[:, :3] >= 0, high, low)
+    return bool(np.all(np.einsum('ij,ij->i', planes[:, :3], corner) + planes[:, 3] >= 0))
+
+
+class TileReader(object):
+    """Reads regions of a point cloud written by write_tiles, one tile file per intersecting tile."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _META)) as f:
+            meta = json.load(f)
+        self.levels = meta['levels']
+        self.count = meta['points']
+        self.dtype = _dtype_from_json(meta['dtype'])
+        self.tiles = {name: (tile['count'], np.array(tile['bbox'][0]), np.array(tile['bbox'][1]))
+                      for name, tile in meta['tiles'].items()}
+
+    def select(self, bbox=None, planes=None, lod=None):
+        """Names of the tiles of levels 0..lod intersecting bbox (low, high) and the frustum planes."""
+        lod = self.levels - 1 if lod is None else min(lod, self.levels - 1)
+        if bbox is not None:
+            bbox_low, bbox_high = np.asarray(bbox[0]), np.asarray(bbox[1])
+        names = []
+        for name, (_, low, high) in self.tiles.items():
+            if int(name.split('/')[0]) > lod:
+                continue
+            if bbox is not None and (np.any(low > bbox_high) or np.any(high < bbox_low)):
+                continue
+            if planes is not None and not _box_in_planes(low, high, planes):
+                continue
+            names.append(name)
+        return sorted(names)
+
+    def read_tile(self, name):
+        return np.fromfile(os.path.join(self.path, f'{name}.bin'), dtype=self.dtype)
+
+    def query(self, bbox=None, planes=None, lod=None, crop=True):
+        """
+        Records of the selected tiles, as {field: array}. With crop, points
+        outside bbox and the frustum planes are dropped as well.
+        """
+        names = self.select(bbox, planes, lod)
+        if names:
+            records = np.concatenate([self.read_tile(name) for name in names])
+        else:
+            records = np.empty(0, dtype=self.dtype)
+        if crop and len(records):
+            inside = np.ones(len(records), dtype=bool)
+            xyz = records['xyz']
+            if bbox is not None:
+                inside &= np.all((xyz >= bbox[0]) & (xyz <= bbox[1]), axis=1)
+            if planes is not None:
+                inside &= np.all(xyz @ planes[:, :3].T + planes[:, 3] >= 0, axis=1)
+            records = records[inside]
+        return {name: records[name] for name in self.dtype.names}
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Convert a point cloud file into a tiled octree.')
+    argparser.add_argument('cloud', help='point cloud readable by open3d, e.g. _out/pointcloud.pcd')
+    argparser.add_argument('output', help='output directory')
+    argparser.add_argument('--max-tile-points', type=int, default=100000)
+    argparser.add_argument('--grid', type=int, default=64, help='cells per tile axis of the subsampled levels')
+    argparser.add_argument('--negate-y', action='store_true',
+                           help='undo the y negation of clouds written by lidar_accumulator')
+    args = argparser.parse_args()
+
+    points = np.asarray(o3d.io.read_point_cloud(args.cloud).points, dtype=np.float32)
+    if args.negate_y:
+        points[:, 1] *= -1
+    levels = write_tiles(args.output, points, max_tile_points=args.max_tile_points, grid=args.grid)
+    reader = TileReader(args.output)
+    print(f'{reader.count} points in {len(reader.tiles)} tiles over {levels} levels')
+
+
+if __name__ == '__main__':
+    main()
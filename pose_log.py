@@ -0,0 +1,77 @@
+"""
+Camera poses of a capture run, one record per exported tick.
+
+The pose is read from the transform attached to the synchronised sensor
+measurement, so it belongs to the same frame as the images and costs no
+RPC, unlike six camera.get_transform() calls per tick. Records are kept in
+a preallocated buffer and written once at the end of the run:
+
+    poses = PoseLog()
+    ...
+        poses.append(tick, image)
+    ...
+    poses.save(export_basepath)      # camera.npy and camera.txt
+
+camera.npy holds the tick, CARLA frame id, timestamp and the float32 pose
+(x, y, z, roll, yaw, pitch) of every record; camera.txt keeps the six pose
+columns of the previous export. CARLA transforms are float32 already, so
+the text file has the same values as before.
+"""
+
+import os
+
+import numpy as np
+
+POSE_DTYPE = np.dtype([
+    ('tick', np.int64),
+    ('frame', np.int64),
+    ('timestamp', np.float64),
+    ('pose', np.float32, (6,)),
+])
+
+
+class PoseLog(object):
+    """Growable buffer of POSE_DTYPE records."""
+
+    def __init__(self, capacity=256):
+        self._records = np.empty(capacity, dtype=POSE_DTYPE)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def records(self):
+        return self._records[:self.count]
+
+    @property
+    def poses(self):
+        """(count, 6) float32 x, y, z, roll, yaw, pitch."""
+        return self.records['pose']
+
+    def append(self, tick, measurement):
+        """Record the pose of a sensor measurement (carla.SensorData) taken at tick."""
+        if self.count == len(self._records):
+            self._records = np.resize(self._records, max(2 * self.count, 1))
+        transform = measurement.transform
+        location = transform.location
+        rotation = transform.rotation
+        record = self._records[self.count]
+        record['tick'] = tick
+        record['frame'] = measurement.frame
+        record['timestamp'] = measurement.timestamp
+        record['pose'] = (location.x, location.y, location.z, rotation.roll, rotation.yaw, rotation.pitch)
+        self.count += 1
+        return record['pose']
+
+    def save(self, basepath, name='camera'):
+        """Write <name>.npy and the <name>.txt pose table to basepath."""
+        np.save(os.path.join(basepath, f'{name}.npy'), self.records)
+        np.savetxt(fname=os.path.join(basepath, f'{name}.txt'), X=self.poses)
+
+
+def load_poses(path):
+    """POSE_DTYPE records from a camera.npy, or plain poses from a camera.txt."""
+    if path.endswith('.npy'):
+        return np.load(path)
+    return np.loadtxt(path, ndmin=2).astype(np.float32)
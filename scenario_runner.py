@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+
+"""
+Runs the capture scenarios of a scenario file, loading every map once.
+
+    python scenario_runner.py scenarios.json
+    python scenario_runner.py scenarios.json --only roundabout misc_loc --dry-run
+
+A scenario file is JSON with optional "defaults" and "weathers" and a list of
+"scenarios". Every scenario is the defaults updated with its own settings
+(the "camera" settings are merged key by key):
+
+    name           directory of the scenario's runs
+    map            map to load, e.g. "Town03" or "gardonyiter"
+    weather        a name from "weathers", a carla.WeatherParameters preset
+                   such as "ClearNoon", a dict of WeatherParameters
+                   attributes, or null to keep the current weather
+    spawns         spawn point indices of the map and/or
+                   [x, y, z, roll, yaw, pitch] transforms
+    num_runs       runs per spawn
+    len_run        ticks per run, warm-up included
+    warmup_ticks   ticks before the first exported frame
+    fps            simulated frames per second
+    camera         width, height, fov and the x, y, z mount on the vehicle;
+                   y and z may be [low, high] ranges drawn for every run
+    vehicle        blueprint id, in a colour drawn for every run
+    export_format  "png", "store" or "raw", as in im_seq_roundabout.py
+    seed           seed of the draws (null: random)
+
+Scenarios are grouped by map and then weather, in the order they first
+appear, so each map is loaded once and the weather set once per group. The
+client, MapCache, image writer and frame processors are shared by all
+scenarios. The runs of a scenario go to <output>/<timestamp>/<name>/<spawn>_<run>
+in the layout of im_seq_roundabout.py. report.json next to them records every
+scenario's simulated frames per second (ticks over the wall time of its
+synchronous loops) and the time spent loading maps; it is rewritten after
+each scenario, and a failed scenario is recorded there and skipped.
+"""
+
+import glob
+import os
+import sys
+from datetime import datetime
+
+try:
+    sys.path.append(glob.glob('/opt/carla-simulator/PythonAPI/carla/dist/carla-*%d.%d-%s.egg' % (
+        sys.version_info.major,
+        sys.version_info.minor,
+        'win-amd64' if os.name == 'nt' else 'linux-x86_64'))[0])
+except IndexError:
+    try:
+        sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
+            sys.version_info.major,
+            sys.version_info.minor,
+            'win-amd64' if os.name == 'nt' else 'linux-x86_64'))[0])
+    except IndexError:
+        pass
+
+import argparse
+import json
+import random
+import time
+
+import carla
+import numpy as np
+
+from carla_sync import CarlaSyncMode
+from frame_processor import FrameProcessor
+from image_writer import ImageWriter
+from map_cache import MapCache, pose_to_transform
+from pose_log import PoseLog
+from sequence_store import SequenceWriter
+
+# the settings of im_seq_roundabout.py
+_DEFAULTS = {
+    'weather': None,
+    'spawns': [0],
+    'num_runs': 1,
+    'len_run': 200,
+    'warmup_ticks': 50,
+    'fps': 30,
+    'camera': {'width': 1280, 'height': 720, 'fov': 120, 'x': 1.5, 'y': [-2.0, 2.0], 'z': [1.4, 3.4]},
+    'vehicle': 'vehicle.tesla.model3',
+    'export_format': 'png',
+    'seed': None,
+}
+_EXPORT_FORMATS = ('png', 'store', 'raw')
+_CAMERAS = ('sensor.camera.rgb', 'sensor.camera.depth', 'sensor.camera.semantic_segmentation')
+_PNG_DIRECTORIES = ('masked_rgb', 'depth', 'depth_16', 'rgb', 'semseg_masked', 'semseg')
+
+
+def _merge(base, update):
+    merged = dict(base)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _check_weather(path, name, weather):
+    if isinstance(weather, str):
+        if not isinstance(getattr(carla.WeatherParameters, weather, None), carla.WeatherParameters):
+            raise ValueError(f'{path}: weather {weather!r} of {name!r} is neither in "weathers" '
+                             f'nor a carla.WeatherParameters preset')
+    elif isinstance(weather, dict):
+        unknown = sorted(key for key in weather if not hasattr(carla.WeatherParameters(), key))
+        if unknown:
+            raise ValueError(f'{path}: unknown weather parameters {unknown} in scenario {name!r}')
+    elif weather is not None:
+        raise ValueError(f'{path}: weather of {name!r} must be a name, a dict or null, got {weather!r}')
+    return weather
+
+
+def load_scenarios(path):
+    """The scenarios of a scenario file, each a dict of all settings, with the weather names resolved."""
+    with open(path) as f:
+        document = json.load(f)
+    defaults = _merge(_DEFAULTS, document.get('defaults', {}))
+    weathers = document.get('weathers', {})
+    scenarios = []
+    for entry in document['scenarios']:
+        scenario = _merge(defaults, entry)
+        name = scenario.get('name')
+        if not name or 'map' not in scenario:
+            raise ValueError(f'{path}: every scenario needs a name and a map, got {entry}')
+        if any(other['name'] == name for other in scenarios):
+            raise ValueError(f'{path}: scenario {name!r} is defined twice')
+        unknown = set(scenario) - set(_DEFAULTS) - {'name', 'map'}
+        if unknown:
+            raise ValueError(f'{path}: unknown settings {sorted(unknown)} in scenario {name!r}')
+        if scenario['export_format'] not in _EXPORT_FORMATS:
+            raise ValueError(f"{path}: export_format of {name!r} must be one of {_EXPORT_FORMATS}")
+        if scenario['warmup_ticks'] >= scenario['len_run']:
+            raise ValueError(f'{path}: {name!r} has no ticks left after warmup_ticks')
+        weather = scenario['weather']
+        if isinstance(weather, str):
+            weather = weathers.get(weather, weather)
+        scenario['weather'] = _check_weather(path, name, weather)
+        scenarios.append(scenario)
+    return scenarios
+
+
+def plan(scenarios):
+    """(map, weather, scenarios) groups: maps together, everything in the order it first appears."""
+    groups = {}
+    for scenario in scenarios:
+        key = (scenario['map'], json.dumps(scenario['weather'], sort_keys=True))
+        groups.setdefault(key, []).append(scenario)
+    map_order = {}
+    for map_name, _ in groups:
+        map_order.setdefault(map_name, len(map_order))
+    ordered = sorted(groups.items(), key=lambda item: map_order[item[0][0]])
+    return [(map_name, group[0]['weather'], group) for (map_name, _), group in ordered]
+
+
+def load_map(client, map_name):
+    """(world, whether it was loaded) of map_name on the server; only loads it if another map is loaded."""
+    world = client.get_world()
+    if world.get_map().name.rsplit('/', 1)[-1] == map_name:
+        return world, False
+    client.load_world(map_name)
+    return client.get_world(), True
+
+
+def apply_weather(world, weather):
+    """Set a preset name or a dict of carla.WeatherParameters attributes; None keeps the weather."""
+    if weather is None:
+        return
+    if isinstance(weather, str):
+        world.set_weather(getattr(carla.WeatherParameters, weather))
+        return
+    parameters = world.get_weather()
+    for key, value in weather.items():
+        setattr(parameters, key, value)
+    world.set_weather(parameters)
+
+
+def _draw(rng, value):
+    return rng.uniform(*value) if isinstance(value, (list, tuple)) else float(value)
+
+
+def _open_export(scenario, basepath, frames):
+    # the sequence_store of a run, or None after creating the PNG directories
+    width, height = scenario['camera']['width'], scenario['camera']['height']
+    if scenario['export_format'] == 'raw':
+        return SequenceWriter(os.path.join(basepath, 'raw'), {
+            'rgb_raw': ((height, width, 4), 'uint8'),
+            'depth_raw': ((height, width, 4), 'uint8'),
+            'semseg_raw': ((height, width, 4), 'uint8'),
+            'carla_frame': ((), 'int64'),
+            'timestamp': ((), 'float64'),
+        }, capacity=frames)
+    if scenario['export_format'] == 'store':
+        return SequenceWriter(os.path.join(basepath, 'store'), {
+            'rgb': ((height, width, 4), 'uint8'),
+            'depth_16': ((height, width), 'uint16'),
+            'semseg': ((height, width), 'uint8'),
+            'depth_mask': ((height, width), 'uint8'),
+        }, capacity=frames)
+    for directory in _PNG_DIRECTORIES:
+        os.makedirs(os.path.join(basepath, directory))
+    return None
+
+
+def _export(scenario, store, writer, processor, basepath, tick, pose, image, depth_as_rgb, semseg_raw):
+    if scenario['export_format'] == 'raw':
+        shape = (scenario['camera']['height'], scenario['camera']['width'], 4)
+        store.append(tick, pose,
+                     rgb_raw=np.frombuffer(image.raw_data, dtype=np.uint8).reshape(shape),
+                     depth_raw=np.frombuffer(depth_as_rgb.raw_data, dtype=np.uint8).reshape(shape),
+                     semseg_raw=np.frombuffer(semseg_raw.raw_data, dtype=np.uint8).reshape(shape),
+                     carla_frame=image.frame,
+                     timestamp=image.timestamp)
+        return
+    frame = processor.process(image, depth_as_rgb, semseg_raw)
+    if store is not None:
+        store.append(tick, pose, rgb=frame.rgb, depth_16=frame.depth_16, semseg=frame.semseg_labels,
+                     depth_mask=frame.depth_mask)
+        return
+    writer.write(f'{basepath}/depth_16/{tick}_depth.png', frame.depth_16)
+    writer.write(f'{basepath}/depth/{tick}_depth.png', frame.depth_log)
+    writer.write(f'{basepath}/masked_rgb/{tick}_masked.png', frame.masked_rgb)
+    writer.write(f'{basepath}/rgb/{tick}.png', frame.rgb)
+    writer.write(f'{basepath}/semseg_masked/{tick}_semseg_masked.png', frame.semseg_masked)
+    writer.write(f'{basepath}/semseg/{tick}_semseg.png', frame.semseg)
+
+
+def run_capture(world, metadata, blueprints, scenario, spawn_transform, basepath, processor, writer, rng):
+    """One run of a scenario: spawn, drive on autopilot and export; returns (ticks, seconds in the sync loop)."""
+    camera = scenario['camera']
+    len_run, warmup_ticks = scenario['len_run'], scenario['warmup_ticks']
+    vehicle = sensors = store = None
+    try:
+        vehicle_bp = blueprints.find(scenario['vehicle'])
+        if vehicle_bp.has_attribute('color'):
+            vehicle_bp.set_attribute('color', rng.choice(vehicle_bp.get_attribute('color').recommended_values))
+        vehicle = world.spawn_actor(vehicle_bp, spawn_transform)
+        vehicle.set_autopilot(True)
+
+        # x-forward, y-right, z-up
+        camera_transform = carla.Transform(carla.Location(x=_draw(rng, camera['x']), y=_draw(rng, camera['y']),
+                                                          z=_draw(rng, camera['z'])))
+        sensors = []
+        for blueprint_id in _CAMERAS:
+            camera_bp = blueprints.find(blueprint_id)
+            camera_bp.set_attribute('fov', f"{camera['fov']}")
+            camera_bp.set_attribute('image_size_x', f"{camera['width']}")
+            camera_bp.set_attribute('image_size_y', f"{camera['height']}")
+            sensors.append(world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle))
+
+        os.makedirs(basepath)
+        for light in metadata.traffic_lights(world):
+            light.set_state(carla.TrafficLightState.Green)
+
+        store = _open_export(scenario, basepath, len_run - warmup_ticks)
+        poses = PoseLog(capacity=len_run - warmup_ticks)
+        focal = camera['width'] / (2 * np.tan(camera['fov'] * np.pi / 360))
+        np.savetxt(fname=f'{basepath}/focal.txt', X=np.array([focal]))
+
+        with CarlaSyncMode(world, *sensors, fps=scenario['fps'], pipelined=True) as synchronizer:
+            start = time.perf_counter()
+            for tick in range(len_run):
+                _, image, depth_as_rgb, semseg_raw = synchronizer.tick(timeout=2.0)
+                if tick < warmup_ticks:
+                    continue
+                pose = poses.append(tick, image)
+                _export(scenario, store, writer, processor, basepath, tick, pose, image, depth_as_rgb, semseg_raw)
+            seconds = time.perf_counter() - start
+
+        writer.flush()
+        poses.save(basepath)
+        return len_run, seconds
+    finally:
+        if store is not None:
+            store.close()
+        for sensor in sensors or ():
+            sensor.destroy()
+        if vehicle is not None:
+            vehicle.destroy()
+
+
+def run_scenario(world, maps, scenario, output, writer, processors):
+    """All runs of a scenario; returns its report entry."""
+    rng = random.Random(scenario['seed'])
+    metadata = maps.get(world)
+    blueprints = maps.blueprints(world)
+    camera = scenario['camera']
+    size = (camera['width'], camera['height'])
+    if size not in processors:
+        processors[size] = FrameProcessor(*size)
+
+    result = {'name': scenario['name'], 'map': scenario['map'], 'weather': scenario['weather'], 'runs': 0,
+              'ticks': 0, 'loop_seconds': 0.0}
+    for spawn in scenario['spawns']:
+        if isinstance(spawn, int) and not 0 <= spawn < len(metadata.spawn_points):
+            raise IndexError(f"spawn point {spawn} of {scenario['name']!r}: {metadata.map_name} has "
+                             f"{len(metadata.spawn_points)}")
+    start = time.perf_counter()
+    for j, spawn in enumerate(scenario['spawns'], 1):
+        spawn_transform = metadata.spawn_points[spawn] if isinstance(spawn, int) else pose_to_transform(spawn)
+        for i in range(scenario['num_runs']):
+            basepath = os.path.join(output, scenario['name'], f'{j}_{i + 1}')
+            ticks, seconds = run_capture(world, metadata, blueprints, scenario, spawn_transform, basepath,
+                                         processors[size], writer, rng)
+            result['runs'] += 1
+            result['ticks'] += ticks
+            result['loop_seconds'] += seconds
+            print(f"{scenario['name']}: run {j}_{i + 1}, {ticks / seconds:.1f} simulated fps")
+    result['seconds'] = time.perf_counter() - start
+    result['fps'] = result['ticks'] / result['loop_seconds'] if result['loop_seconds'] else 0.0
+    return result
+
+
+def _write_report(path, report):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('scenarios', help='scenario file, e.g. scenarios.json')
+    argparser.add_argument('--only', nargs='+', default=None, help='run only these scenarios')
+    argparser.add_argument('--output', default='_out/sequences', help='parent of the timestamped output directory')
+    argparser.add_argument('--host', default='localhost')
+    argparser.add_argument('--port', type=int, default=2000)
+    argparser.add_argument('--timeout', type=float, default=20.0, help='client timeout in seconds')
+    argparser.add_argument('--dry-run', action='store_true', help='print the plan without connecting')
+    args = argparser.parse_args()
+
+    scenarios = load_scenarios(args.scenarios)
+    if args.only is not None:
+        missing = set(args.only) - {scenario['name'] for scenario in scenarios}
+        if missing:
+            argparser.error(f'no scenarios named {", ".join(sorted(missing))}')
+        scenarios = [scenario for scenario in scenarios if scenario['name'] in args.only]
+    groups = plan(scenarios)
+    for map_name, weather, group in groups:
+        runs = sum(len(scenario['spawns']) * scenario['num_runs'] for scenario in group)
+        print(f"{map_name}, weather {json.dumps(weather)}: {', '.join(s['name'] for s in group)} ({runs} runs)")
+    if args.dry_run:
+        return
+
+    client = carla.Client(args.host, args.port)
+    client.set_timeout(args.timeout)
+    maps = MapCache(client)
+    blueprints = maps.blueprints(client.get_world())
+    unknown = set()
+    for scenario in scenarios:
+        try:
+            blueprints.find(scenario['vehicle'])
+        except IndexError:
+            unknown.add(scenario['vehicle'])
+    if unknown:
+        argparser.error(f'no vehicle blueprints {", ".join(sorted(unknown))}')
+
+    output = os.path.join(args.output, datetime.now().strftime("%m_%d_%H_%M_%S"))
+    os.makedirs(output)
+    print(output)
+    report_path = os.path.join(output, 'report.json')
+    report = {'scenario_file': args.scenarios, 'map_loads': [], 'scenarios': []}
+
+    writer = ImageWriter()
+    processors = {}
+    try:
+        for map_name, weather, group in groups:
+            start = time.perf_counter()
+            try:
+                world, loaded = load_map(client, map_name)
+                apply_weather(world, weather)
+            except Exception as e:
+                print(f'{map_name} failed: {e}')
+                report['map_loads'].append({'map': map_name, 'error': repr(e)})
+                report['scenarios'].extend({'name': scenario['name'], 'map': map_name, 'error': repr(e)}
+                                           for scenario in group)
+                _write_report(report_path, report)
+                continue
+            report['map_loads'].append({'map': map_name, 'loaded': loaded, 'seconds': time.perf_counter() - start})
+            for scenario in group:
+                try:
+                    result = run_scenario(world, maps, scenario, output, writer, processors)
+                except Exception as e:
+                    print(f"{scenario['name']} failed: {e}")
+                    result = {'name': scenario['name'], 'map': map_name, 'error': repr(e)}
+                report['scenarios'].append(result)
+                _write_report(report_path, report)
+    finally:
+        writer.close()
+
+    print(f"{'scenario':>20} {'runs':>5} {'ticks':>7} {'fps':>7}")
+    for result in report['scenarios']:
+        if 'error' in result:
+            print(f"{result['name']:>20} failed: {result['error']}")
+        else:
+            print(f"{result['name']:>20} {result['runs']:5d} {result['ticks']:7d} {result['fps']:7.1f}")
+    print(f"map loads: {sum(load.get('seconds', 0.0) for load in report['map_loads']):.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Memory-mapped columnar storage for captured sequences.
+
+Instead of one PNG per stream and tick, every stream of a run is a single
+preallocated raw file holding all its frames back to back, grown in chunks
+of frames as needed. The frame numbers and camera poses are stored next to
+them, and a meta.json describes the layout:
+
+    <path>/meta.json
+    <path>/frames.bin        int64 frame (tick) numbers
+    <path>/poses.bin         float64 x, y, z, roll, yaw, pitch per frame
+    <path>/<stream>.bin      one frame-sized record per frame
+
+    with SequenceWriter(f'{export_basepath}/store', {'rgb': ((720, 1280, 4), 'uint8')}) as store:
+        store.append(tick, pose, rgb=bgra)
+
+    store = SequenceReader(f'{export_basepath}/store')
+    rgb = store.get('rgb', tick)          # zero-copy view into the file
+"""
+
+import json
+import os
+
+import numpy as np
+
+_META = 'meta.json'
+_FRAMES = 'frames'
+_POSES = 'poses'
+_POSE_SIZE = 6
+
+
+class _Column(object):
+    """One growable memory-mapped file of fixed-shape records."""
+
+    def __init__(self, path, shape, dtype, capacity):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.capacity = 0
+        self.array = None
+        open(path, 'wb').close()
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+        record_size = int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * record_size)
+        self.capacity = capacity
+        if capacity:
+            self.array = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(capacity,) + self.shape)
+
+    def flush(self):
+        if self.array is not None:
+            self.array.flush()
+
+
+class SequenceWriter(object):
+    """
+    Writes the frames of one run into memory-mapped columns. streams maps the
+    stream name to the (shape, dtype) of one frame. Space for capacity frames
+    is allocated up front and grown chunk_frames at a time after that.
+    """
+
+    def __init__(self, path, streams, capacity=256, chunk_frames=64):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.count = 0
+        self._streams = {name: (tuple(shape), np.dtype(dtype).str) for name, (shape, dtype) in streams.items()}
+        for name in self._streams:
+            if name in (_FRAMES, _POSES):
+                raise ValueError(f'stream name {name!r} is reserved')
+        self._columns = {name: _Column(os.path.join(path, f'{name}.bin'), shape, dtype, capacity)
+                         for name, (shape, dtype) in self._streams.items()}
+        self._columns[_FRAMES] = _Column(os.path.join(path, f'{_FRAMES}.bin'), (), np.int64, capacity)
+        self._columns[_POSES] = _Column(os.path.join(path, f'{_POSES}.bin'), (_POSE_SIZE,), np.float64, capacity)
+        self._write_meta()
+
+    def append(self, frame, pose=None, **arrays):
+        """Store the arrays of every stream for frame, with an optional 6 value pose."""
+        if set(arrays) != set(self._streams):
+            raise ValueError(f'expected arrays for {sorted(self._streams)}, got {sorted(arrays)}')
+        if self.count == self._columns[_FRAMES].capacity:
+            for column in self._columns.values():
+                column.resize(column.capacity + self.chunk_frames)
+            self._write_meta()
+
+        i = self.count
+        for name, array in arrays.items():
+            self._columns[name].array[i] = array
+        self._columns[_FRAMES].array[i] = frame
+        self._columns[_POSES].array[i] = np.nan if pose is None else pose
+        self.count += 1
+
+    def close(self):
+        """Trim the columns to the frames written and finalize meta.json."""
+        for column in self._columns.values():
+            column.resize(self.count)
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def _write_meta(self):
+        meta = {
+            'frames': self.count,
+            'streams': {name: {'shape': list(shape), 'dtype': dtype} for name, (shape, dtype) in self._streams.items()},
+        }
+        with open(os.path.join(self.path, _META), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+class SequenceReader(object):
+    """
+    Read-only access to a run written by SequenceWriter. Streams are memory
+    maps, so indexing them reads only the pages that are touched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _META)) as f:
+            meta = json.load(f)
+        self.count = meta['frames']
+        self.streams = {name: (tuple(stream['shape']), np.dtype(stream['dtype']))
+                        for name, stream in meta['streams'].items()}
+        self._maps = {}
+        self.frames = self._map(_FRAMES, (), np.int64)
+        self.poses = self._map(_POSES, (_POSE_SIZE,), np.float64)
+        self._positions = {int(frame): i for i, frame in enumerate(self.frames)}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        """The whole stream as a (frames, ...) memory map."""
+        shape, dtype = self.streams[name]
+        return self._map(name, shape, dtype)
+
+    def position(self, frame):
+        """Index of frame number `frame` within the streams."""
+        return self._positions[frame]
+
+    def get(self, name, frame):
+        """Zero-copy view of stream `name` at frame number `frame`."""
+        return self[name][self.position(frame)]
+
+    def _map(self, name, shape, dtype):
+        if name not in self._maps:
+            if self.count == 0:
+                self._maps[name] = np.empty((0,) + tuple(shape), dtype=dtype)
+            else:
+                self._maps[name] = np.memmap(os.path.join(self.path, f'{name}.bin'), dtype=dtype, mode='r',
+                                             shape=(self.count,) + tuple(shape))
+        return self._maps[name]
@@ -0,0 +1,108 @@
+"""
+Nearest spawn point queries on a KD-tree of a map's spawn points.
+
+The spawn points of a map are kept as an (N, 6) float32 array of x, y, z,
+roll, yaw, pitch (the camera.txt pose order). map_cache.MapCache persists
+them per map and server version, so later runs on the same map skip the
+RPC, and its MapMetadata builds the index once per session:
+
+    index = MapCache(client).get(world).spawn_index
+    i = index.nearest(spectator.get_transform())          # index into get_spawn_points()
+    distances, indices = index.query(locations, k=5, dims=3)
+
+Queries are exact and batched: locations is an (M, 2) or (M, 3) array (or a
+list of carla.Location / carla.Transform). With yaw_weight the distance is
+
+    sqrt(|p - q|^2 + (yaw_weight * 2 sin(|yaw_p - yaw_q| / 2))^2)
+
+i.e. positions are extended by the heading on a circle of radius yaw_weight
+metres, so a spawn point facing the other way counts as 2 * yaw_weight
+metres further away. The trees for every (dims, yaw_weight) are built on
+first use and kept with the index.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def transform_to_pose(transform):
+    """x, y, z, roll, yaw, pitch of a carla.Transform."""
+    location = transform.location
+    rotation = transform.rotation
+    return location.x, location.y, location.z, rotation.roll, rotation.yaw, rotation.pitch
+
+
+def locations_array(locations):
+    """
+    (M, 3) float64 positions, (M,) yaws of carla.Transform / carla.Location
+    objects or of an (M, 2+) array (x, y[, z]); yaws are None unless known.
+    """
+    if isinstance(locations, np.ndarray):
+        locations = np.atleast_2d(np.asarray(locations, dtype=np.float64))
+        positions = np.zeros((len(locations), 3))
+        positions[:, :min(locations.shape[1], 3)] = locations[:, :3]
+        return positions, None
+    positions = np.empty((len(locations), 3))
+    yaws = np.empty(len(locations))
+    has_yaws = True
+    for i, location in enumerate(locations):
+        if hasattr(location, 'rotation'):
+            yaws[i] = location.rotation.yaw
+            location = location.location
+        else:
+            has_yaws = False
+        positions[i] = location.x, location.y, location.z
+    return positions, yaws if has_yaws else None
+
+
+class SpawnPointIndex(object):
+    """Exact k-nearest spawn point queries over (N, 6) poses."""
+
+    def __init__(self, poses, map_name=None):
+        self.map_name = map_name
+        self.poses = np.asarray(poses, dtype=np.float32).reshape((-1, 6))
+        self._trees = {}
+
+    def __len__(self):
+        return len(self.poses)
+
+    @classmethod
+    def from_spawn_points(cls, spawn_points, map_name=None):
+        """Index of a list of carla.Transform, e.g. carla.Map.get_spawn_points()."""
+        return cls([transform_to_pose(transform) for transform in spawn_points], map_name)
+
+    def _features(self, positions, yaws, dims, yaw_weight):
+        features = positions[:, :dims]
+        if yaw_weight:
+            yaws = np.radians(yaws)
+            features = np.column_stack([features, yaw_weight * np.cos(yaws), yaw_weight * np.sin(yaws)])
+        return features
+
+    def tree(self, dims=2, yaw_weight=0.0):
+        """KD-tree of the spawn points over x, y (dims 2) or x, y, z (dims 3), plus the weighted heading."""
+        if dims not in (2, 3):
+            raise ValueError(f'dims must be 2 or 3, got {dims}')
+        key = (dims, float(yaw_weight))
+        tree = self._trees.get(key)
+        if tree is None:
+            features = self._features(self.poses[:, :3].astype(np.float64), self.poses[:, 4], dims, yaw_weight)
+            tree = self._trees[key] = cKDTree(features)
+        return tree
+
+    def query(self, locations, k=1, dims=2, yaws=None, yaw_weight=0.0):
+        """
+        (M, k) distances and spawn point indices of the k nearest spawn points
+        of every location ((M,) arrays for k=1). yaws (degrees) default to
+        those of transforms; they are needed with yaw_weight.
+        """
+        positions, transform_yaws = locations_array(locations)
+        if yaw_weight:
+            yaws = transform_yaws if yaws is None else np.asarray(yaws, dtype=np.float64).reshape(-1)
+            if yaws is None:
+                raise ValueError('yaw_weight needs yaws or carla.Transform locations')
+        k = min(k, len(self.poses))
+        return self.tree(dims, yaw_weight).query(self._features(positions, yaws, dims, yaw_weight), k=k)
+
+    def nearest(self, location, dims=2, yaw_weight=0.0):
+        """Index of the spawn point nearest to a carla.Location or carla.Transform."""
+        return int(self.query([location], 1, dims, yaw_weight=yaw_weight)[1][0])
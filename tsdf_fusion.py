@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Incremental fusion of depth frames into a sparse truncated signed distance
+field (TSDF).
+
+Only voxels within the truncation distance of an observed surface exist.
+For every pixel, the voxels along its ray from truncation in front of the
+measured depth to truncation behind it get the signed distance of their
+centre to the surface along the ray, averaged over the frames that saw
+them. Voxels are kept sorted by their packed index (as in
+lidar_accumulator.VoxelAccumulator), so a frame costs one sort of its own
+samples and one pass over the occupied voxels, and memory grows with the
+observed surface, not with the number of frames.
+
+    fusion = TSDFFusion(voxel_size=0.1)
+    for tick, matrix, depth, bgr, _ in depth_projection.run_frames(run, colour=True):
+        fusion.integrate(depth, matrix, focal, bgr)
+    points, colors = fusion.extract_points()
+
+The same works during capture with FrameProcessor.depth * (1000 / 255) as the
+metric depth and pose_matrix() of the measurement's pose. The surface points
+lie on the zero crossings of the field between neighbouring voxels.
+
+    python tsdf_fusion.py _out/sequences/<timestamp>/1_1 --voxel-size 0.1 --output _out/1_1_tsdf.pcd
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from depth_projection import read_run, ray_table, run_frames
+from lidar_accumulator import pack_voxels, unpack_voxels, write_point_cloud
+from point_tiles import write_tiles
+
+# pixels this deep or deeper are sky
+_MAX_DEPTH = 990.0
+
+
+class TSDFFusion(object):
+    """
+    Sparse TSDF with voxel_size metres voxels and a truncation distance of
+    truncation metres (default three voxels). Distances are stored as
+    fractions of the truncation, positive in front of the surface.
+    """
+
+    def __init__(self, voxel_size=0.1, truncation=None, max_depth=_MAX_DEPTH):
+        self.voxel_size = float(voxel_size)
+        self.truncation = 3 * self.voxel_size if truncation is None else float(truncation)
+        self.max_depth = max_depth
+        self.frames = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._sdf_sums = np.empty(0, dtype=np.float32)
+        self._weights = np.empty(0, dtype=np.float32)
+        self._color_sums = np.empty((0, 3), dtype=np.float32)
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def tsdf(self):
+        """Fused signed distance of every voxel, in [-1, 1] of the truncation."""
+        return self._sdf_sums / self._weights
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @property
+    def centres(self):
+        """(voxels, 3) world coordinates of the voxel centres."""
+        return (unpack_voxels(self._keys) + 0.5) * self.voxel_size
+
+    def integrate(self, depth, matrix, focal, bgr=None, mask=None, pixel_stride=1):
+        """
+        Fuse a (H, W) metric depth frame seen with the camera-to-world matrix
+        and focal length, optionally with its (H, W, 3) BGR image. Pixels where
+        mask is zero, and every pixel_stride-th row and column in between,
+        are skipped.
+        """
+        height, width = depth.shape
+        rays = ray_table(width, height, focal)[::pixel_stride, ::pixel_stride].reshape((-1, 3))
+        depth = depth[::pixel_stride, ::pixel_stride].reshape(-1)
+        valid = (depth > 0) & (depth < self.max_depth)
+        if mask is not None:
+            valid &= mask[::pixel_stride, ::pixel_stride].reshape(-1) != 0
+        selected = np.flatnonzero(valid)
+        rays, depth = rays[selected], depth[selected]
+        colors = None
+        if bgr is not None:
+            colors = bgr[::pixel_stride, ::pixel_stride, 2::-1].reshape((-1, 3))[selected]
+
+        matrix = np.asarray(matrix, dtype=np.float32)
+        origin = matrix[:3, 3]
+        norms = np.linalg.norm(rays, axis=1)
+        directions = (rays / norms[:, None]) @ matrix[:3, :3].T
+        distances = depth * norms
+
+        # one sample per voxel step along each ray, through the truncation band
+        steps = int(np.ceil(self.truncation / self.voxel_size))
+        keys, sdf = [], []
+        for offset in np.arange(-steps, steps + 1) * self.voxel_size:
+            samples = origin + directions * (distances + offset)[:, None]
+            indices = np.floor(samples / self.voxel_size).astype(np.int64)
+            centres = (indices + 0.5) * self.voxel_size
+            # signed distance of the voxel centre to the surface along the ray
+            along = np.einsum('ij,ij->i', centres - origin, directions)
+            keys.append(pack_voxels(indices))
+            sdf.append(np.clip((distances - along) / self.truncation, -1.0, 1.0))
+        keys = np.concatenate(keys)
+        sdf = np.concatenate(sdf)
+
+        frame_keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(frame_keys))
+        # every frame counts once per voxel, with the mean of its samples
+        frame_sdf = (np.bincount(inverse, sdf, len(frame_keys)) / counts).astype(np.float32)
+        frame_colors = np.zeros((len(frame_keys), 3), dtype=np.float32)
+        if colors is not None:
+            sample_colors = np.tile(colors, (2 * steps + 1, 1)).astype(np.float64)
+            for channel in range(3):
+                frame_colors[:, channel] = np.bincount(inverse, sample_colors[:, channel], len(frame_keys)) / counts
+        self._merge(frame_keys, frame_sdf, frame_colors)
+        self.frames += 1
+
+    def _merge(self, keys, sdf, colors):
+        positions = np.searchsorted(self._keys, keys)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == keys[found]
+        old = positions[found]
+        self._sdf_sums[old] += sdf[found]
+        self._weights[old] += 1
+        self._color_sums[old] += colors[found]
+
+        new = ~found
+        if new.any():
+            at = positions[new]
+            self._keys = np.insert(self._keys, at, keys[new])
+            self._sdf_sums = np.insert(self._sdf_sums, at, sdf[new])
+            self._weights = np.insert(self._weights, at, np.ones(np.count_nonzero(new), dtype=np.float32))
+            self._color_sums = np.insert(self._color_sums, at, colors[new], axis=0)
+
+    def extract_points(self, min_weight=1):
+        """
+        (M, 3) float32 surface points where the field changes sign between
+        neighbouring voxels with at least min_weight frames, and their (M, 3)
+        uint8 RGB colours (black without colour input).
+        """
+        if len(self._keys) == 0:
+            return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.uint8)
+        tsdf = self.tsdf
+        usable = self._weights >= min_weight
+        centres = self.centres
+        colors = self._color_sums / self._weights[:, None]
+        points, point_colors = [], []
+        # key difference of a step of one voxel along x, y and z
+        steps = pack_voxels(np.eye(3, dtype=np.int64)) - pack_voxels(np.zeros((1, 3), dtype=np.int64))
+        for step in steps:
+            neighbours = np.searchsorted(self._keys, self._keys + step)
+            neighbours = np.minimum(neighbours, len(self._keys) - 1)
+            pairs = usable & (self._keys[neighbours] == self._keys + step) & usable[neighbours]
+            first = np.flatnonzero(pairs)
+            second = neighbours[first]
+            d0, d1 = tsdf[first], tsdf[second]
+            # a real crossing, not the jump at the back of the truncation band
+            crossing = (np.sign(d0) != np.sign(d1)) & (np.abs(d0 - d1) < 1.0)
+            first, second, d0, d1 = first[crossing], second[crossing], d0[crossing], d1[crossing]
+            t = (d0 / (d0 - d1))[:, None]
+            points.append(centres[first] + t * (centres[second] - centres[first]))
+            point_colors.append(colors[first] + t * (colors[second] - colors[first]))
+        points = np.concatenate(points).astype(np.float32)
+        point_colors = np.clip(np.rint(np.concatenate(point_colors)), 0, 255).astype(np.uint8)
+        return points, point_colors
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('run', help='run directory, e.g. _out/sequences/<timestamp>/1_1')
+    argparser.add_argument('--output', default=None,
+                           help='.npy (CARLA coordinates), a point_tiles directory (ending in /) or an open3d '
+                                'cloud file (y negated like the LiDAR export); default <run>/tsdf_cloud.pcd')
+    argparser.add_argument('--voxel-size', type=float, default=0.1, help='voxel size in metres')
+    argparser.add_argument('--truncation', type=float, default=None, help='truncation distance in metres')
+    argparser.add_argument('--stride', type=int, default=1, help='use every n-th frame')
+    argparser.add_argument('--pixel-stride', type=int, default=1, help='use every n-th pixel row and column')
+    argparser.add_argument('--min-weight', type=int, default=1, help='frames a voxel must have been seen in')
+    argparser.add_argument('--colour', action='store_true', help='colour the surface from rgb/')
+    args = argparser.parse_args()
+
+    output = args.output or os.path.join(args.run, 'tsdf_cloud.pcd')
+    focal = read_run(args.run)[2]
+    fusion = TSDFFusion(args.voxel_size, args.truncation)
+    for tick, matrix, depth, bgr, _ in run_frames(args.run, args.stride, args.colour):
+        fusion.integrate(depth, matrix, focal, bgr, pixel_stride=args.pixel_stride)
+        print(f'\rframe {tick}: {len(fusion)} voxels', end='', flush=True)
+    print()
+
+    points, colors = fusion.extract_points(args.min_weight)
+    if not args.colour:
+        colors = None
+    if output.endswith('.npy'):
+        np.save(output, points)
+    elif output.endswith('/') or os.path.isdir(output):
+        write_tiles(output, points, {} if colors is None else {'rgb': colors})
+    else:
+        write_point_cloud(output, points, colors)
+    print(f'{len(points)} surface points written to {output}')
+
+
+if __name__ == '__main__':
+    main()
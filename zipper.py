@@ -1,26 +1,392 @@
+#!/usr/bin/env python
+
+"""
+Packs captured sequences into zip archives.
+
+    python zipper.py _out/sequences/08_24_13_30_13 --types rgb semseg --output _out/rgb_semseg.zip
+    python zipper.py _out/sequences/08_24_13_30_13 --types rgb depth_16 --shard-size 2G --workers 4
+
+Every run directory under root contributes the files of its --types streams
+and its --extras (camera.txt, focal.txt). Members are named by their path as
+given, like ZipFile.write(path) names them, e.g.
+_out/sequences/08_24_13_30_13/<run>/rgb/12.png. The directories are scanned
+while archiving, one at a time, so the full file list is never built.
+
+Formats that are compressed already (PNG, JPEG, ...) are stored and copied
+by the writing process. Everything else is deflated in parallel by --workers
+processes, a window of members ahead of the writer, unless it is larger than
+64 MiB; the writer deflates such files itself, piece by piece. With
+--shard-size the archive is split into <output>_0000.zip, <output>_0001.zip,
+... of at most about that many bytes (a larger member gets a shard of its
+own).
+
+<output>.journal records every member with its place in the archive once it
+is synced to disk, and the end of every finished shard. Running the same
+command again after an interruption cuts the last shard back to its last
+recorded member and carries on from there; members of finished shards are
+skipped, and files added to the runs since are appended, after which the
+central directory is written again.
+"""
+
+import argparse
+import json
 import os
-from zipfile import ZipFile
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
 from tqdm import tqdm
 
-types_to_zip = ["rgb", "semseg"]
+# deflating these again costs time and saves nothing
+_STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.gz', '.bz2', '.xz', '.zip', '.7z', '.mp4'}
+_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END = struct.Struct('<IHHHHIIH')
+_END64 = struct.Struct('<IQHHIIQQQQ')
+_END64_LOCATOR = struct.Struct('<IIQI')
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+# files larger than this are deflated by the writer in pieces instead of in memory by a worker
+_STREAM_SIZE = 64 << 20
+_PIECE = 1 << 20
+# the archive and then the journal are synced after this many members or bytes
+_SYNC_MEMBERS = 256
+_SYNC_BYTES = 64 << 20
+
+
+def parse_size(text):
+    """Bytes of a size like 500M, 2G or 1048576."""
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in _SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * _SIZE_UNITS[unit])
+
+
+def _sorted_entries(directory):
+    with os.scandir(directory) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
+
+
+def _iter_files(directory):
+    for entry in _sorted_entries(directory):
+        if entry.is_dir():
+            yield from _iter_files(entry.path)
+        elif entry.is_file():
+            yield entry.path, entry.stat().st_size
+
+
+def archive_name(path):
+    """The member name ZipFile.write(path) would give path."""
+    name = os.path.normpath(os.path.splitdrive(path)[1])
+    while name[0] in (os.sep, os.altsep):
+        name = name[1:]
+    if os.sep != '/':
+        name = name.replace(os.sep, '/')
+    return name
+
+
+def iter_members(root, types, extras=('camera.txt', 'focal.txt')):
+    """Yield (path, archive name, size) of the files to archive, run by run."""
+    for run in _sorted_entries(root):
+        if not run.is_dir():
+            continue
+        for name in extras:
+            path = f'{root}/{run.name}/{name}'
+            if os.path.isfile(path):
+                yield path, archive_name(path), os.path.getsize(path)
+        for stream in types:
+            directory = f'{root}/{run.name}/{stream}'
+            if os.path.isdir(directory):
+                for path, size in _iter_files(directory):
+                    yield path, archive_name(path), size
+
+
+def _stored(path):
+    return os.path.splitext(path)[1].lower() in _STORED_EXTENSIONS
+
+
+def compress_member(path, level=6):
+    """(crc, uncompressed size, raw deflate data) of a file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+def _dos_time(mtime):
+    local = time.localtime(mtime)
+    if local.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2),
+            ((local.tm_year - 1980) << 9) | (local.tm_mon << 5) | local.tm_mday)
+
+
+def _local_header(entry, zip64):
+    name = entry['name'].encode('utf-8')
+    if zip64:
+        extra = struct.pack('<HHQQ', 1, 16, entry['usize'], entry['csize'])
+        csize = usize = _ZIP64_LIMIT
+    else:
+        extra = b''
+        csize, usize = entry['csize'], entry['usize']
+    version = 45 if zip64 else 20 if entry['method'] == ZIP_DEFLATED else 10
+    return _LOCAL_HEADER.pack(0x04034b50, version, entry['flags'], entry['method'], entry['time'], entry['date'],
+                              entry['crc'], csize, usize, len(name), len(extra)) + name + extra
+
+
+def _central_header(entry):
+    name = entry['name'].encode('utf-8')
+    fields = {'usize': entry['usize'], 'csize': entry['csize'], 'offset': entry['offset']}
+    large = [fields[key] for key in ('usize', 'csize', 'offset') if fields[key] >= _ZIP64_LIMIT]
+    extra = struct.pack(f'<HH{len(large)}Q', 1, 8 * len(large), *large) if large else b''
+    fields = {key: min(value, _ZIP64_LIMIT) for key, value in fields.items()}
+    version = 45 if large else 20 if entry['method'] == ZIP_DEFLATED else 10
+    return _CENTRAL_HEADER.pack(0x02014b50, 3 << 8 | version, version, entry['flags'], entry['method'],
+                                entry['time'], entry['date'], entry['crc'], fields['csize'], fields['usize'],
+                                len(name), len(extra), 0, 0, 0, entry['attributes'], fields['offset']) + name + extra
+
+
+class _ShardWriter(object):
+    """Appends members to one zip file, after the entries already in it, and writes its central directory."""
+
+    def __init__(self, path, index, entries=()):
+        self.path = path
+        self.index = index
+        self.entries = list(entries)
+        data_end = self.entries[-1]['end'] if self.entries else 0
+        self.file = open(path, 'r+b' if self.entries else 'wb')
+        self.file.truncate(data_end)
+        self.file.seek(data_end)
+
+    def tell(self):
+        return self.file.tell()
+
+    def add(self, path, name, compressed=None, level=6):
+        """Write a member, from a compress_member result or read from path; returns its journal entry."""
+        stat = os.stat(path)
+        mtime, mdate = _dos_time(stat.st_mtime)
+        entry = {
+            'shard': self.index,
+            'name': name,
+            'offset': self.file.tell(),
+            'method': ZIP_STORED if compressed is None and _stored(path) else ZIP_DEFLATED,
+            'flags': 0 if all(ord(c) < 128 for c in name) else 0x800,
+            'time': mtime,
+            'date': mdate,
+            'attributes': (stat.st_mode & 0xFFFF) << 16,
+            'crc': 0,
+            'csize': 0,
+            'usize': stat.st_size,
+        }
+        if compressed is not None:
+            entry['crc'], entry['usize'], data = compressed
+            entry['csize'] = len(data)
+            self.file.write(_local_header(entry, False))
+            self.file.write(data)
+        else:
+            # deflate can grow incompressible data by a few bytes per 16 KiB block
+            zip64 = stat.st_size + (stat.st_size >> 12) + 1024 >= _ZIP64_LIMIT
+            self.file.write(_local_header(entry, zip64))
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if entry['method'] == ZIP_DEFLATED else None
+            crc = usize = csize = 0
+            with open(path, 'rb') as f:
+                for piece in iter(lambda: f.read(_PIECE), b''):
+                    crc = zlib.crc32(piece, crc)
+                    usize += len(piece)
+                    if compressor is not None:
+                        piece = compressor.compress(piece)
+                    self.file.write(piece)
+                    csize += len(piece)
+            if compressor is not None:
+                piece = compressor.flush()
+                self.file.write(piece)
+                csize += len(piece)
+            entry.update(crc=crc, usize=usize, csize=csize)
+            end = self.file.tell()
+            self.file.seek(entry['offset'])
+            self.file.write(_local_header(entry, zip64))
+            self.file.seek(end)
+        entry['end'] = self.file.tell()
+        self.entries.append(entry)
+        return entry
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """Write the central directory and close the file; returns where the member data ends."""
+        data_end = self.file.tell()
+        directory = b''.join(_central_header(entry) for entry in self.entries)
+        count, size = len(self.entries), len(directory)
+        if count >= _ZIP64_COUNT_LIMIT or data_end >= _ZIP64_LIMIT or size >= _ZIP64_LIMIT:
+            directory += _END64.pack(0x06064b50, 44, 3 << 8 | 45, 45, 0, 0, count, count, size, data_end)
+            directory += _END64_LOCATOR.pack(0x07064b50, 0, data_end + size, 1)
+        self.file.write(directory)
+        self.file.write(_END.pack(0x06054b50, 0, 0, min(count, _ZIP64_COUNT_LIMIT), min(count, _ZIP64_COUNT_LIMIT),
+                                  min(size, _ZIP64_LIMIT), min(data_end, _ZIP64_LIMIT), 0))
+        self.sync()
+        self.file.close()
+        return data_end
+
+
+def read_journal(path):
+    """{shard index: {'entries': [...], 'closed': whether its central directory was written}} of a journal."""
+    shards = {}
+    if not os.path.isfile(path):
+        return shards
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted write
+                break
+            shard = shards.setdefault(record['shard'], {'entries': [], 'closed': False})
+            if record.get('closed'):
+                shard['closed'] = True
+            else:
+                shard['entries'].append(record)
+                shard['closed'] = False
+    return shards
+
+
+def _shard_path(output, index, sharded):
+    if not sharded and index == 0:
+        return output
+    stem, extension = os.path.splitext(output)
+    return f'{stem}_{index:04d}{extension or ".zip"}'
+
+
+def _resume(output, journal_path, sharded):
+    # rewrites the journal with the members still in their shard files, deletes the shards
+    # left without any; returns those members by shard and (index, entries) of the shard to append to
+    shards = read_journal(journal_path)
+    kept, records = {}, []
+    for index, shard in sorted(shards.items()):
+        path = _shard_path(output, index, sharded)
+        size = os.path.getsize(path) if os.path.isfile(path) else -1
+        entries = [entry for entry in shard['entries'] if entry['end'] <= size]
+        # a finished shard with members missing is written again, an unfinished one is cut back
+        if shard['closed'] and len(entries) < len(shard['entries']):
+            entries = []
+        if entries:
+            kept[index] = entries
+            records.extend(entries)
+            if shard['closed']:
+                records.append({'shard': index, 'closed': True, 'end': entries[-1]['end']})
+        elif size >= 0 and sharded:
+            os.remove(path)
+    tmp_path = f'{journal_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, journal_path)
+
+    if not sharded:
+        return kept, (0, kept.get(0, []))
+    last = max(shards) if shards else -1
+    if last in kept:
+        return kept, (last, kept[last])
+    return kept, (last + 1, [])
+
+
+def archive(root, output, types, extras=('camera.txt', 'focal.txt'), shard_size=None, workers=None, level=6):
+    """Archive the runs under root (see the module docstring); returns the paths of the shards written."""
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    journal_path = f'{output}.journal'
+    sharded = bool(shard_size)
+    kept, (index, entries) = _resume(output, journal_path, sharded)
+    done = {entry['name'] for shard_entries in kept.values() for entry in shard_entries}
+    if done:
+        print(f'resuming: {len(done)} files are archived already')
+    members = (member for member in iter_members(root, types, extras) if member[1] not in done)
+
+    workers = workers or os.cpu_count() or 1
+    written = []
+    state = {'writer': None, 'index': index, 'entries': entries, 'unsynced': [], 'bytes': 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(journal_path, 'a') as journal, \
+            tqdm(unit='B', unit_scale=True, unit_divisor=1024) as progress:
+
+        def log(records):
+            for record in records:
+                journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        def sync():
+            # the members reach the disk before the journal names them
+            state['writer'].sync()
+            log(state['unsynced'])
+            state['unsynced'], state['bytes'] = [], 0
+
+        def close():
+            sync()
+            writer = state['writer']
+            data_end = writer.close()
+            log([{'shard': writer.index, 'closed': True, 'end': data_end}])
+            written.append(writer.path)
+            state['writer'], state['index'], state['entries'] = None, writer.index + 1, []
+
+        def finish(job):
+            path, name, size, future = job
+            compressed = future.result() if future is not None else None
+            writer = state['writer']
+            expected = len(compressed[2]) if compressed is not None else size
+            if writer is not None and sharded and writer.entries and writer.tell() + expected > shard_size:
+                close()
+                writer = None
+            if writer is None:
+                writer = state['writer'] = _ShardWriter(_shard_path(output, state['index'], sharded),
+                                                        state['index'], state['entries'])
+            entry = writer.add(path, name, compressed, level)
+            state['unsynced'].append(entry)
+            state['bytes'] += entry['end'] - entry['offset']
+            if len(state['unsynced']) >= _SYNC_MEMBERS or state['bytes'] >= _SYNC_BYTES:
+                sync()
+            progress.update(size)
 
-base_path = "_out/sequences/08_24_13_30_13"
-folders = os.listdir(base_path)
-paths_to_zip = []
-for img_type in types_to_zip:
-    for i, folder in enumerate(folders):
-        imgs = os.listdir(f"{base_path}/{folder}/{img_type}/")
-        for img in imgs:
-            paths_to_zip.append(f"{base_path}/{folder}/{img_type}/{img}")
-        if i == 0:
-            paths_to_zip.append(f"{base_path}/{folder}/camera.txt")
-            paths_to_zip.append(f"{base_path}/{folder}/focal.txt")
+        pending = deque()
+        for path, name, size in members:
+            if _stored(path) or size > _STREAM_SIZE:
+                future = None
+            else:
+                future = executor.submit(compress_member, path, level)
+            pending.append((path, name, size, future))
+            # keeps the workers busy while bounding the data held in memory
+            if len(pending) >= 4 * workers:
+                finish(pending.popleft())
+        while pending:
+            finish(pending.popleft())
+        if state['writer'] is not None:
+            close()
+    return written
 
 
-length = len(paths_to_zip)
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('root', help='directory of run directories, e.g. _out/sequences/08_24_13_30_13')
+    argparser.add_argument('--types', nargs='+', default=['rgb', 'semseg'], help='stream directories to archive')
+    argparser.add_argument('--extras', nargs='*', default=['camera.txt', 'focal.txt'],
+                           help='files of every run directory to archive too')
+    argparser.add_argument('--output', default='_out/full_longpath_extra_rgb_semseg.zip', help='archive path')
+    argparser.add_argument('--shard-size', type=parse_size, default=None,
+                           help='split into archives of at most about this size, e.g. 2G')
+    argparser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    argparser.add_argument('--level', type=int, default=6, help='deflate level of the compressed files')
+    args = argparser.parse_args()
 
+    written = archive(args.root, args.output, args.types, args.extras, args.shard_size, args.workers, args.level)
+    for path in written:
+        print(path)
+    print(f'{len(written)} archives written')
 
-with ZipFile('_out/full_longpath_extra_rgb_semseg.zip', "w") as zip_object:
-    for path_to_zip in tqdm(paths_to_zip):
-        zip_object.write(path_to_zip)
 
+if __name__ == '__main__':
+    main()